@@ -0,0 +1,173 @@
+"""Benchmarks of the Python side of the ORM, run against `StubDatabase`."""
+
+import datetime
+
+from sparrow import *
+
+from .harness import Benchmark
+from .models import User, Message
+from .stub import StubDatabase, example_row, keys
+
+
+def example_user(**kwargs) -> User:
+    dct = dict(name="Evert", mail="evert@example.com", age=24, created=datetime.datetime(2016, 1, 1))
+    dct.update(kwargs)
+    return User(**dct)
+
+
+def sql_benchmarks() -> list:
+    select = User.get(User.name == Unsafe("Evert"), User.age >= 18).order(-User.created).limit(20)
+    where = And(User.name == Unsafe("Evert"), User.age >= 18)
+
+    def check():
+        # Parses the clause and its data into the query
+        select.check(where)
+
+    def build_select():
+        # Building a query is what applications do in their request handlers
+        User.get(User.name == Unsafe("Evert"), User.age >= 18).order(-User.created).limit(20)
+
+    def with_data_find():
+        User._find_by_key_query.with_data(key=1)
+
+    def with_data_insert():
+        Message._insert_command.with_data(text="Hi", sent=None, sender_UID=1, to_UID=2)
+
+    return [
+        Benchmark("sql.select_str", select.__str__),
+        Benchmark("sql.select_build", build_select),
+        Benchmark("sql.check", check),
+        Benchmark("sql.with_data_find", with_data_find),
+        Benchmark("sql.with_data_insert", with_data_insert),
+    ]
+
+
+def define_benchmarks() -> list:
+    def define():
+        # What importing a model costs per class
+        class Post(Entity):
+            title = Property(str)
+            body = Property(str)
+            views = Property(int, constraint=lambda v: v >= 0)
+            posted = Property(datetime.datetime, index=True)
+            author = Reference(User)
+            key = PID = KeyProperty()
+
+    def define_and_build():
+        class Post(Entity):
+            title = Property(str)
+            author = Reference(User)
+            key = PID = KeyProperty()
+        for k in lazy_statements:
+            getattr(Post, k)
+
+    return [
+        Benchmark("define.class", define, number=1000),
+        Benchmark("define.class_and_statements", define_and_build, number=500),
+    ]
+
+
+def hydration_benchmarks() -> list:
+    rows = [example_row(User, next(keys)) for _ in range(1000)]
+    it = [iter(rows)]
+
+    def hydrate():
+        # Objects are not kept, so every row goes through __metainit__ and the cache
+        try:
+            row = next(it[0])
+        except StopIteration:
+            it[0] = iter(rows)
+            row = next(it[0])
+        User(db_args=row)
+
+    kept = [User(db_args=r) for r in rows]
+
+    def hydrate_cached():
+        # The object with this key is still in memory, so it is replaced by the cached one
+        User(db_args=rows[0])
+
+    def construct():
+        example_user()
+
+    hydrate_cached.kept = kept
+    return [
+        Benchmark("hydrate.db_args", hydrate),
+        Benchmark("hydrate.db_args_cached", hydrate_cached),
+        Benchmark("hydrate.kwargs", construct),
+    ]
+
+
+def json_benchmarks() -> list:
+    u = example_user()
+    return [
+        Benchmark("json.json_repr", u.json_repr),
+        Benchmark("json.to_json", u.to_json, number=5000),
+    ]
+
+
+def rt_benchmarks(listeners: int = 100) -> list:
+    u = example_user()
+    for _ in range(listeners):
+        u.add_listener(Listener())
+    return [
+        Benchmark("rt.send_update_{}".format(listeners), u.send_update, number=2000),
+    ]
+
+
+def db_benchmarks(db=None, prefix: str = "stub") -> list:
+    """Insert, find and update. With a `StubDatabase` (the default) this measures the overhead
+    of the ORM itself; with a real `Database` it measures the whole round trip.
+    """
+
+    if db is None:
+        db = StubDatabase()
+    objs = []
+
+    async def insert():
+        u = example_user()
+        await u.insert(db)
+        objs.append(u)
+        if len(objs) > 1000:
+            del objs[:500]
+
+    async def last():
+        # The other benchmarks work on inserted objects, also when insert is not run (see -k)
+        if len(objs) == 0:
+            await insert()
+        return objs[-1]
+
+    async def find():
+        # Not in the cache: goes to the database
+        await User._find_by_key_query.with_data(key=(await last()).key).single(db)
+
+    async def find_cached():
+        await User.find_by_key((await last()).key, db)
+
+    async def update():
+        u = await last()
+        u.age += 1
+        await u.update(db)
+
+    async def select_all():
+        await User.get(User.age >= 18).limit(20).all(db)
+
+    number = 2000 if prefix == "stub" else 500
+    return [
+        Benchmark(prefix + ".insert", insert, True, number),
+        Benchmark(prefix + ".find_by_key_query", find, True, number),
+        Benchmark(prefix + ".find_by_key_cached", find_cached, True, number),
+        Benchmark(prefix + ".update", update, True, number),
+        Benchmark(prefix + ".select_all", select_all, True, number),
+    ]
+
+
+def all_benchmarks() -> list:
+    stub = StubDatabase()
+    stub_rows = StubDatabase(rows=20)
+    bs = sql_benchmarks() + define_benchmarks() + hydration_benchmarks() + json_benchmarks() + rt_benchmarks() + db_benchmarks(stub)
+
+    async def select_20():
+        await User.get(User.age >= 18).limit(20).all(stub_rows)
+
+    bs.append(Benchmark("stub.select_20_rows", select_20, True, 1000))
+    return bs
@@ -0,0 +1,110 @@
+"""Small harness to time benchmarks and count their allocations."""
+
+import gc
+import sys
+import time
+import tracemalloc
+
+
+class Benchmark:
+    """A named operation to measure. `func` is called without arguments; if `is_async`, it
+    returns an awaitable that is awaited (inside one event loop for all iterations).
+    """
+
+    def __init__(self, name: str, func, is_async: bool = False, number: int = 10000):
+        self.name = name
+        self.func = func
+        self.is_async = is_async
+        self.number = number
+
+
+def _time_sync(func, number: int) -> float:
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return time.perf_counter() - start
+
+
+async def _time_async(func, number: int) -> float:
+    start = time.perf_counter()
+    for _ in range(number):
+        await func()
+    return time.perf_counter() - start
+
+
+def run_benchmark(b: Benchmark, loop, repeat: int = 5, scale: float = 1.0) -> dict:
+    """Run `b` `repeat` times (after a warm-up) and return the best timing and the allocations
+    per operation. `peak_bytes_per_op` needs ``tracemalloc.reset_peak`` (Python 3.9) and is
+    `None` otherwise.
+    """
+
+    number = max(1, int(b.number * scale))
+
+    def timed(n):
+        if b.is_async:
+            return loop.run_until_complete(_time_async(b.func, n))
+        return _time_sync(b.func, n)
+
+    timed(max(1, number // 10))  # Warm up caches
+    gc.collect()
+    gc.disable()
+    try:
+        best = min(timed(number) for _ in range(repeat))
+    finally:
+        gc.enable()
+
+    # Allocations: blocks left behind (until the garbage collector runs) and the memory
+    # allocated on top of what was in use before, per operation.
+    gc.collect()
+    gc.disable()
+    try:
+        blocks_before = sys.getallocatedblocks()
+        timed(number)
+        blocks_after = sys.getallocatedblocks()
+        peak_bytes = None
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.start()
+            n = min(number, 1000)
+            total = 0
+            for _ in range(n):
+                (start, _peak) = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+                timed(1)
+                total += tracemalloc.get_traced_memory()[1] - start
+            tracemalloc.stop()
+            peak_bytes = total / n
+    finally:
+        gc.enable()
+
+    return {
+        "number": number,
+        "ops_per_sec": number / best,
+        "usec_per_op": best / number * 1e6,
+        "net_blocks_per_op": (blocks_after - blocks_before) / number,
+        "peak_bytes_per_op": peak_bytes,
+    }
+
+
+def run_all(benchmarks: list, loop, repeat: int = 5, scale: float = 1.0, only: str = None,
+            verbose: bool = True) -> dict:
+    results = {}
+    for b in benchmarks:
+        if only is not None and only not in b.name:
+            continue
+        r = results[b.name] = run_benchmark(b, loop, repeat, scale)
+        if verbose:
+            print("{:<40} {:>14,.0f} ops/s {:>10.2f} us/op {:>8.2f} blocks/op".format(
+                b.name, r["ops_per_sec"], r["usec_per_op"], r["net_blocks_per_op"]), flush=True)
+    return results
+
+
+def compare(old: dict, new: dict):
+    """Print the speedup of every benchmark in `new` relative to `old`."""
+    print("\n{:<40} {:>14} {:>14} {:>8}".format("benchmark", "old ops/s", "new ops/s", "ratio"))
+    for (name, r) in new["results"].items():
+        o = old["results"].get(name)
+        if o is None:
+            print("{:<40} {:>14} {:>14,.0f} {:>8}".format(name, "-", r["ops_per_sec"], "-"))
+        else:
+            print("{:<40} {:>14,.0f} {:>14,.0f} {:>7.2f}x".format(
+                name, o["ops_per_sec"], r["ops_per_sec"], r["ops_per_sec"] / o["ops_per_sec"]))
@@ -0,0 +1,24 @@
+"""Entity classes used by the benchmarks."""
+
+import datetime
+
+from sparrow import *
+
+
+class User(RTEntity):
+    name = Property(str)
+    mail = Property(str)
+    age = Property(int, constraint=lambda a: a >= 0)
+    created = Property(datetime.datetime, json=False)
+    key = UID = KeyProperty()
+
+
+class Message(Entity):
+    text = Property(str)
+    sent = Property(datetime.datetime)
+    sender = Reference(User)
+    to = RTReference(User)
+    key = MID = KeyProperty()
+
+
+classes = [User, Message]
@@ -0,0 +1,109 @@
+"""Run the benchmarks and write the results as JSON, so they can be compared between commits.
+
+Usage (from the root of the repository)::
+
+    python -m benchmarks.run -o before.json
+    # ... change things ...
+    python -m benchmarks.run -o after.json --compare before.json
+
+By default only the Python side of the ORM is measured, against an in-memory stub database.
+Pass ``--backend`` to also run insert, find and update end-to-end: ``--backend sqlite`` uses an
+in-memory SQLite database, ``momoko`` and ``asyncpg`` a local Postgres server (see ``--dbname``,
+``--user``, ...). Warning: this (re)creates the tables of `benchmarks.models`.
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import subprocess
+import sys
+import time
+
+from .harness import run_all, compare
+from .bench_orm import all_benchmarks, db_benchmarks
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def database_benchmarks(loop, args) -> list:
+    from sparrow import Database, RawSql, AsyncpgBackend, SqliteBackend
+    from .models import classes
+
+    if args.backend == "sqlite":
+        db = Database(None, args.dbname or ":memory:", backend=SqliteBackend())
+    elif args.backend == "asyncpg":
+        db = Database(None, args.dbname or "sparrow_bench", args.user, args.password, args.host,
+                      args.port, backend=AsyncpgBackend())
+    else:
+        import tornado.ioloop
+        db = Database(tornado.ioloop.IOLoop.current(), args.dbname or "sparrow_bench", args.user,
+                      args.password, args.host, args.port)
+
+    async def setup():
+        # Wait for the pool to connect
+        for i in range(50):
+            try:
+                await RawSql("SELECT 1").raw(db)
+                break
+            except Exception:
+                if i == 49:
+                    raise
+                await asyncio.sleep(0.1)
+        for c in reversed(classes):
+            await c._drop_table_command.exec(db)
+        for c in classes:
+            await c._create_table_command.exec(db)
+
+    loop.run_until_complete(setup())
+    return db_benchmarks(db, args.backend)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths of sparrow.")
+    parser.add_argument("-o", "--output", help="Write the results as JSON to this file.")
+    parser.add_argument("--compare", help="Compare with the results in this JSON file.")
+    parser.add_argument("-k", dest="only", help="Only run benchmarks whose name contains this.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply the number of iterations.")
+    parser.add_argument("--backend", choices=["sqlite", "momoko", "asyncpg"],
+                        help="Also run end-to-end against a database with this backend.")
+    parser.add_argument("--dbname")
+    parser.add_argument("--user", default="postgres")
+    parser.add_argument("--password", default="postgres")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5432)
+    args = parser.parse_args(argv)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    benchmarks = all_benchmarks()
+    if args.backend is not None:
+        benchmarks += database_benchmarks(loop, args)
+
+    results = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "results": run_all(benchmarks, loop, args.repeat, args.scale, args.only),
+    }
+    loop.close()
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
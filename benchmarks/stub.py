@@ -0,0 +1,40 @@
+"""An in-memory stand-in for `sparrow.Database`, so the Python side of the ORM can be measured
+without a database server. It does not interpret SQL: every SELECT returns `rows` rows of
+representative values, every INSERT ... RETURNING returns a new key.
+"""
+
+import itertools
+
+from sparrow import RowCursor, CodecRegistry
+
+
+keys = itertools.count(10 ** 9)
+"""New keys, shared by all stub databases so that objects never collide in the cache (also not
+with the objects of a real database used in the same run).
+"""
+
+
+def example_row(cls, key):
+    """A row with the columns of `cls` (see `_select_columns`) and the given (single) key."""
+    props = {p.name: p for p in cls._props}
+    key_name = cls.key.single_prop.name
+    return tuple([key if n == key_name else props[n].type.example() for n in cls._select_columns])
+
+
+class StubDatabase:
+    errors = ()
+    codecs = CodecRegistry()
+    
+    def __init__(self, rows: int = 1):
+        self.rows = rows
+        self.executed = 0
+
+    async def get_cursor(self, statement, unsafe_dict: dict):
+        self.executed += 1
+        text = str(statement)
+        if text.startswith("SELECT"):
+            cls = statement.cls
+            return RowCursor([example_row(cls, next(keys)) for _ in range(self.rows)])
+        if "RETURNING" in text:
+            return RowCursor([(next(keys),)])
+        return RowCursor([])
@@ -27,3 +27,10 @@ from .model import *
 from .sql import *
 from .entity import *
 from .util import *
+from .stats import *
+from .backend import *
+from .schema import *
+from .cache import *
+from .partition import *
+from .buffer import *
+from .sharding import *
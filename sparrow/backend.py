@@ -0,0 +1,877 @@
+
+import asyncio
+import concurrent.futures
+import csv
+import datetime
+import io
+import json
+import re
+import sqlite3
+
+from .util import *
+
+# Both backends are optional, only the one that is used needs to be installed.
+try:
+    import psycopg2
+    import psycopg2.extras
+    import momoko
+    import tornado.concurrent
+    import tornado.gen
+    import tornado.ioloop
+except ImportError:
+    psycopg2 = momoko = None
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+
+# Helpers
+# =======
+
+def make_dsn(args: dict) -> str:
+    """Build a libpq connection string from a dictionary of connection arguments."""
+    return "dbname={dbname} user={user} password={password} host={host} port={port}".format(**args)
+
+
+_placeholder_re = re.compile(r"%\((\w+)\)s|%%")
+_placeholder_cache = {}
+_placeholder_cache_size = 10000
+
+def numbered_placeholders(text: str, prefix: str = "$") -> tuple:
+    """Translate the ``%(name)s`` parameters of psycopg2 (used by `Unsafe` and `Field`) to the
+    ``$1``, ``$2``, ... parameters of Postgres itself (or ``?1``, ... for SQLite with
+    ``prefix="?"``). Returns the new text and the list of names, in the order of their number.
+    A name used more than once gets the same number.
+    """
+    
+    try:
+        return _placeholder_cache[(text, prefix)]
+    except KeyError:
+        pass
+    names = []
+    numbers = {}
+    def replace(m):
+        name = m.group(1)
+        if name is None:
+            return "%"
+        if name not in numbers:
+            names.append(name)
+            numbers[name] = len(names)
+        return prefix + str(numbers[name])
+    result = (_placeholder_re.sub(replace, text), names)
+    if len(_placeholder_cache) >= _placeholder_cache_size:
+        _placeholder_cache.clear()
+    _placeholder_cache[(text, prefix)] = result
+    return result
+
+
+def status_rowcount(status: str) -> int:
+    """Get the number of rows from a command status like ``UPDATE 3`` or ``INSERT 0 1``.
+    Returns -1 if there is none.
+    """
+    
+    last = status.rsplit(" ", 1)[-1] if status else ""
+    return int(last) if last.isdigit() else -1
+
+
+_returns_rows_re = re.compile(r"^\s*(SELECT|WITH|VALUES|SHOW|EXPLAIN|TABLE)\b|\bRETURNING\b", re.IGNORECASE)
+
+def returns_rows(text: str) -> bool:
+    """Guess whether the statement returns rows."""
+    return _returns_rows_re.search(text) is not None
+
+
+# Codecs
+# ======
+
+class Codec:
+    """How values of a sparrow `Type` are converted for a database library. `encode` converts
+    a Python value to a parameter, `decode` a value from a row to Python. Both may be `None`,
+    meaning the library handles the value natively. `None` values are never converted.
+    """
+    
+    def __init__(self, encode=None, decode=None):
+        self.encode = encode
+        self.decode = decode
+
+
+class CodecRegistry:
+    """Chooses a `Codec` for every `Type`. Every backend has one (`Backend.codecs`, also
+    available as `Database.codecs`). Codecs are registered for a key, which is (in order of
+    lookup) a `Type` instance, a `Type` subclass, a ``codec_key`` of a type (like ``"json"``,
+    ``"list"`` or ``"enum"``) or a Python type (like `datetime.datetime`)::
+    
+        db.codecs.register(Money, encode=lambda m: m.cents, decode=Money.from_cents)
+    
+    Instead of a codec, you can register a function that takes the `Type` and returns a
+    `Codec` (or `None` to continue looking), see `register_factory`. Types that override
+    `Type.to_sql` or `Type.from_sql` themselves use those if no codec is registered.
+    
+    Per Entity class, the encoders and decoders of all properties are looked up once.
+    """
+    
+    def __init__(self):
+        self.factories = {}
+        self._codecs = {}
+        self._class_encoders = {}
+        self._class_decoders = {}
+    
+    def register(self, key, encode=None, decode=None):
+        self.register_factory(key, lambda typ, _codec=Codec(encode, decode): _codec)
+    
+    def register_factory(self, key, factory):
+        self.factories[key] = factory
+        self._codecs.clear()
+        self._class_encoders.clear()
+        self._class_decoders.clear()
+    
+    def _find(self, typ) -> Codec:
+        keys = [typ] + list(type(typ).__mro__) + [getattr(typ, "codec_key", None), getattr(typ, "python_type", None)]
+        for k in keys:
+            try:
+                factory = self.factories[k]
+            except (KeyError, TypeError):
+                continue
+            codec = factory(typ)
+            if codec is not None:
+                return codec
+        # Bound methods of the base `Type` do nothing, everything else (also functions set on
+        # the instance) converts
+        encode = typ.to_sql if getattr(typ.to_sql, "__func__", None) is not base_to_sql(typ) else None
+        decode = typ.from_sql if getattr(typ.from_sql, "__func__", None) is not base_from_sql(typ) else None
+        return Codec(encode, decode)
+    
+    def lookup(self, typ) -> Codec:
+        """Return the `Codec` for the type `typ`."""
+        try:
+            return self._codecs[id(typ)][1]
+        except KeyError:
+            codec = self._find(typ)
+            self._codecs[id(typ)] = (typ, codec)  # Keep typ alive, its id is the key
+            return codec
+    
+    def encode(self, typ, value):
+        encode = self.lookup(typ).encode
+        return encode(value) if encode is not None and value is not None else value
+    
+    def decode(self, typ, value):
+        decode = self.lookup(typ).decode
+        return decode(value) if decode is not None and value is not None else value
+    
+    def encoders(self, cls) -> list:
+        """For the `_complete_props` of the Entity class `cls`: a list of tuples `(name,
+        dataname, encode)`, where `encode` may be `None`.
+        """
+        
+        try:
+            return self._class_encoders[cls]
+        except KeyError:
+            l = self._class_encoders[cls] = [(p.name, p.dataname, self.lookup(p.type).encode)
+                                             for p in cls._complete_props]
+            return l
+    
+    def encode_object(self, obj) -> dict:
+        """The parameters to insert or update the Entity `obj` (without its key if that is a
+        `KeyProperty`).
+        """
+        
+        d = {}
+        for (name, dataname, encode) in self.encoders(type(obj)):
+            val = obj.__dict__[dataname]
+            d[name] = encode(val) if encode is not None and val is not None else val
+        return d
+    
+    def encode_key(self, props: list, key):
+        """A key (of an object, or referred to by a `Reference`) as a parameter, like
+        `encode_object` encodes it. `props` are the properties of the key: with more than one,
+        `key` is a tuple.
+        """
+        
+        if len(props) == 1:
+            return self.encode(props[0].type, key)
+        return tuple([self.encode(p.type, v) for (p, v) in zip(props, key)])
+    
+    def decoders(self, cls) -> list:
+        """A list of `(index, decode)` for the columns of rows of `cls` (see `_select_columns`)
+        that need decoding.
+        """
+        
+        try:
+            return self._class_decoders[cls]
+        except KeyError:
+            props = {p.name: p for p in cls._props}
+            l = []
+            for (i, name) in enumerate(cls._select_columns):
+                decode = self.lookup(props[name].type).decode
+                if decode is not None:
+                    l.append((i, decode))
+            self._class_decoders[cls] = l
+            return l
+    
+    def decode_row(self, cls, row):
+        """Decode a row with the columns of `cls`."""
+        decoders = self.decoders(cls)
+        if len(decoders) == 0:
+            return row
+        row = list(row)
+        for (i, decode) in decoders:
+            if row[i] is not None:
+                row[i] = decode(row[i])
+        return row
+
+
+def base_to_sql(typ):
+    # The to_sql of `Type` itself (the first class in the MRO that defines one)
+    return [c for c in type(typ).__mro__ if "to_sql" in c.__dict__][-1].__dict__["to_sql"]
+
+def base_from_sql(typ):
+    return [c for c in type(typ).__mro__ if "from_sql" in c.__dict__][-1].__dict__["from_sql"]
+
+
+# Exports
+# =======
+
+export_chunk_size = 64 * 1024
+"""Approximate size in bytes of the chunks written by exports (see `Backend.copy_out`)."""
+
+
+def postgres_copy(query: str, format: str) -> tuple:
+    """The query and options to stream the results of `query` with ``COPY ... TO STDOUT``.
+    Returns a tuple `(query, options)`, where `options` is a dictionary like the keyword
+    arguments of asyncpg's ``copy_from_query``.
+    """
+    
+    if format == "ndjson":
+        # The CSV format without quoting or delimiting (the control characters never occur in the
+        # output of row_to_json) gives the JSON as it is
+        return ("SELECT row_to_json(_sparrow_row) FROM ({}) AS _sparrow_row".format(query),
+                dict(format="csv", quote="\x01", delimiter="\x02"))
+    if format == "csv":
+        return (query, dict(format="csv", header=True))
+    return (query, dict(format="binary"))
+
+
+def copy_statement(query: str, options: dict) -> str:
+    """The ``COPY`` statement for the result of `postgres_copy`."""
+    opts = []
+    for (k, v) in sorted(options.items()):
+        if v is True:
+            opts.append(k.upper())
+        elif k == "format":
+            opts.append("FORMAT " + v)
+        elif len(v) == 1 and ord(v) < 32:
+            opts.append("{} E'\\x{:02x}'".format(k.upper(), ord(v)))
+        else:
+            opts.append("{} '{}'".format(k.upper(), v.replace("'", "''")))
+    return "COPY ({}) TO STDOUT WITH ({})".format(query, ", ".join(opts))
+
+
+class ThreadWriter:
+    """File-like object for a blocking library running in another thread: collects what is
+    written in chunks and passes every chunk to the coroutine `write` on the event loop `loop`
+    (waiting for it, so a slow sink slows down the export instead of filling the memory).
+    """
+    
+    def __init__(self, loop, write):
+        self.loop = loop
+        self.write_async = write
+        self.buffer = []
+        self.size = 0
+    
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= export_chunk_size:
+            self.flush()
+        return len(data)
+    
+    def flush(self):
+        if self.size > 0:
+            chunk = b"".join(self.buffer)
+            self.buffer = []
+            self.size = 0
+            asyncio.run_coroutine_threadsafe(self.write_async(chunk), self.loop).result()
+
+
+def _json_default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    raise TypeError("Can't convert {} to JSON".format(type(obj).__name__))
+
+
+_pg_array_plain_re = re.compile(r'^[^\s{},"\\]+$')
+
+def _csv_value(typ, value):
+    """A (decoded) value as Postgres writes it in the CSV format of ``COPY``: booleans as
+    ``t``/``f``, lists as arrays and JSON as JSON.
+    """
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if getattr(typ, "codec_key", None) == "list":
+        return "{" + ",".join([_pg_array_element(v) for v in value]) + "}"
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=_json_default)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(" ")
+    return value
+
+
+def _pg_array_element(value) -> str:
+    if value is None:
+        return "NULL"
+    value = _csv_value(None, value)
+    if isinstance(value, str) and not (_pg_array_plain_re.match(value) and value.upper() != "NULL"):
+        return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+    return str(value)
+
+
+# Cursors
+# =======
+
+class RowCursor:
+    """A cursor over rows that were already fetched, with the same interface as the cursors
+    of psycopg2 (as far as sparrow uses them).
+    """
+    
+    def __init__(self, rows: list, rowcount: int = None):
+        self.rows = rows
+        self.rowcount = len(rows) if rowcount is None else rowcount
+        self.pos = 0
+    
+    def fetchone(self):
+        if self.pos >= len(self.rows):
+            return None
+        row = self.rows[self.pos]
+        self.pos += 1
+        return row
+    
+    def fetchmany(self, size: int = 1) -> list:
+        rows = self.rows[self.pos:self.pos + size]
+        self.pos += len(rows)
+        return rows
+    
+    def fetchall(self) -> list:
+        rows = self.rows[self.pos:]
+        self.pos = len(self.rows)
+        return rows
+
+
+# Backends
+# ========
+
+class Backend:
+    """Interface between `Database` and a database library.
+    
+    A backend creates *pools*. A pool can be anything with a coroutine method
+    ``execute(text, data)`` that executes `text` (with ``%(name)s`` parameters, filled in from
+    the dictionary `data`) and returns a cursor (see `RowCursor`).
+    """
+    
+    errors = ()
+    """Exception classes raised by the database library for errors of the database (e.g. a
+    violated constraint). `Sql.exec` wraps them in a `SqlError`.
+    """
+    
+    codecs = None
+    """The `CodecRegistry` of this backend (set by every backend, see `default_codecs`)."""
+    
+    def default_codecs(self) -> CodecRegistry:
+        """Create the registry with the codecs this backend needs for the types of sparrow."""
+        return CodecRegistry()
+    
+    def create_pool(self, conn, size: int):
+        """Create a pool of `size` connections. `conn` is either a DSN string or a dictionary
+        with the keys `dbname`, `user`, `password`, `host` and `port`.
+        """
+        raise NotImplementedError()
+    
+    def transaction(self, pool):
+        """Return an asynchronous context manager that takes a connection of `pool` and starts a
+        transaction. Entering it gives an object with a coroutine method ``execute(text, data)``
+        (like a pool). The transaction is committed at the end, or rolled back on an exception.
+        """
+        raise NotImplementedError()
+    
+    async def copy_out(self, pool, query: str, data: dict, format: str, write, columns: list):
+        """Stream the results of the SELECT `query` in `format` (``"csv"``, ``"ndjson"`` or
+        ``"binary"``, see `Select.export`), in chunks of bytes given to the coroutine `write`.
+        `columns` is a list of `(name, type)` tuples for the columns of `query` (the type may be
+        `None` if the column needs no decoding).
+        """
+        raise NotImplementedError()
+    
+    # Scheduling, for the work sparrow does in the background (see `WriteBuffer`). By default
+    # on the asyncio event loop.
+    
+    def create_future(self):
+        """Create a future that can be awaited on the event loop of this backend."""
+        return asyncio.Future()
+    
+    def call_later(self, delay: float, callback, *args):
+        """Call `callback(*args)` after `delay` seconds. Returns a handle with a method
+        ``cancel()``.
+        """
+        return asyncio.get_event_loop().call_later(delay, callback, *args)
+    
+    def spawn(self, coro):
+        """Run the coroutine `coro` in the background."""
+        asyncio.ensure_future(coro)
+
+
+class IOLoopTimeout:
+    """Handle of `MomokoBackend.call_later`."""
+    
+    def __init__(self, ioloop, timeout):
+        self.ioloop = ioloop
+        self.timeout = timeout
+    
+    def cancel(self):
+        self.ioloop.remove_timeout(self.timeout)
+
+
+class MomokoBackend(Backend):
+    """Backend using momoko (and psycopg2) on a tornado IOLoop. This is the default."""
+    
+    def __init__(self, ioloop):
+        if momoko is None:
+            raise ImportError("MomokoBackend needs psycopg2 and momoko")
+        self.ioloop = ioloop
+        self.errors = (psycopg2.Error,)
+        self.codecs = self.default_codecs()
+    
+    def default_codecs(self) -> CodecRegistry:
+        # psycopg2 adapts lists to arrays and decodes arrays, JSONB and timestamps itself, in C
+        codecs = CodecRegistry()
+        codecs.register("json", encode=psycopg2.extras.Json)
+        codecs.register("list")
+        return codecs
+    
+    def create_pool(self, conn, size: int):
+        dsn = conn if isinstance(conn, str) else make_dsn(conn)
+        pool = momoko.Pool(dsn=dsn, size=size, ioloop=self.ioloop)
+        pool.connect()
+        return pool
+    
+    def transaction(self, pool) -> "MomokoTransaction":
+        return MomokoTransaction(pool)
+    
+    async def copy_out(self, pool, query: str, data: dict, format: str, write, columns: list):
+        # COPY does not work on the asynchronous connections of momoko, so this uses a separate
+        # blocking connection in a thread
+        loop = asyncio.get_event_loop()
+        statement = copy_statement(*postgres_copy(query, format))
+        
+        def run():
+            con = psycopg2.connect(pool.dsn)
+            try:
+                cur = con.cursor()
+                writer = ThreadWriter(loop, write)
+                cur.copy_expert(cur.mogrify(statement, data), writer)
+                writer.flush()
+            finally:
+                con.close()
+        
+        await loop.run_in_executor(None, run)
+    
+    # The IOLoop of tornado doesn't necessarily run an asyncio event loop
+    
+    def get_ioloop(self):
+        return self.ioloop if self.ioloop is not None else tornado.ioloop.IOLoop.current()
+    
+    def create_future(self):
+        return tornado.concurrent.Future()
+    
+    def call_later(self, delay: float, callback, *args) -> IOLoopTimeout:
+        ioloop = self.get_ioloop()
+        return IOLoopTimeout(ioloop, ioloop.call_later(delay, callback, *args))
+    
+    def spawn(self, coro):
+        ioloop = self.get_ioloop()
+        # Errors are logged by the IOLoop
+        ioloop.add_callback(lambda: ioloop.add_future(tornado.gen.convert_yielded(coro), lambda f: f.result()))
+
+
+class MomokoTransaction:
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = None
+    
+    async def __aenter__(self):
+        self.conn = await self.pool.getconn()
+        try:
+            await self.conn.execute("BEGIN")
+        except:
+            self.pool.putconn(self.conn)
+            raise
+        return self.conn
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await self.conn.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        finally:
+            self.pool.putconn(self.conn)
+
+
+async def asyncpg_execute(con, text: str, data: dict) -> RowCursor:
+    """Execute `text` on the asyncpg connection `con`."""
+    (query, names) = numbered_placeholders(text)
+    args = [data[n] for n in names]
+    # Both use the cache of prepared statements of the connection
+    if returns_rows(query):
+        return RowCursor([tuple(r) for r in await con.fetch(query, *args)])
+    return RowCursor([], status_rowcount(await con.execute(query, *args)))
+
+
+class AsyncpgConnection:
+    """A single connection of an `AsyncpgPool`, used for transactions."""
+    
+    def __init__(self, con):
+        self.con = con
+    
+    async def execute(self, text: str, data: dict) -> RowCursor:
+        return await asyncpg_execute(self.con, text, data)
+
+
+class AsyncpgTransaction:
+    def __init__(self, pool: "AsyncpgPool"):
+        self.pool = pool
+        self.con = None
+        self.transaction = None
+    
+    async def __aenter__(self):
+        pool = self.pool.pool if self.pool.pool is not None else await self.pool.connect()
+        self.con = await pool.acquire()
+        try:
+            self.transaction = self.con.transaction()
+            await self.transaction.start()
+        except:
+            await pool.release(self.con)
+            raise
+        return AsyncpgConnection(self.con)
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                await self.transaction.commit()
+            else:
+                await self.transaction.rollback()
+        finally:
+            await self.pool.pool.release(self.con)
+
+
+class AsyncpgPool:
+    """Pool of `AsyncpgBackend`. The underlying `asyncpg.Pool` is created on first use, since
+    that needs a running event loop.
+    """
+    
+    def __init__(self, kwargs: dict):
+        self.kwargs = kwargs
+        self.pool = None
+        self._connecting = None
+    
+    async def connect(self):
+        if self.pool is None:
+            if self._connecting is None:
+                self._connecting = asyncio.ensure_future(asyncpg.create_pool(**self.kwargs))
+            self.pool = await self._connecting
+        return self.pool
+    
+    async def execute(self, text: str, data: dict) -> RowCursor:
+        pool = self.pool if self.pool is not None else await self.connect()
+        async with pool.acquire() as con:
+            return await asyncpg_execute(con, text, data)
+    
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+
+class AsyncpgBackend(Backend):
+    """Backend using asyncpg, on plain asyncio (or uvloop). It talks the binary protocol of
+    Postgres and uses prepared statements, which makes it a lot faster than momoko.
+    
+    Parameters:
+        - `pool_kwargs`: Extra arguments for ``asyncpg.create_pool``, for example
+          ``statement_cache_size``. An ``init`` function is called after `init_connection`.
+    """
+    
+    def __init__(self, **pool_kwargs):
+        if asyncpg is None:
+            raise ImportError("AsyncpgBackend needs asyncpg")
+        self.user_init = pool_kwargs.pop("init", None)
+        self.pool_kwargs = pool_kwargs
+        self.errors = (asyncpg.PostgresError,)
+        self.codecs = self.default_codecs()
+    
+    def default_codecs(self) -> CodecRegistry:
+        # asyncpg handles all types natively, with binary codecs. JSON is set up for each
+        # connection, see `init_connection`.
+        codecs = CodecRegistry()
+        codecs.register("json")
+        codecs.register("list")
+        return codecs
+    
+    async def init_connection(self, con):
+        """Called for every new connection: lets JSON columns take and give Python objects."""
+        for t in ("json", "jsonb"):
+            await con.set_type_codec(t, encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+        if self.user_init is not None:
+            await self.user_init(con)
+    
+    def create_pool(self, conn, size: int) -> AsyncpgPool:
+        if isinstance(conn, str):
+            kwargs = dict(dsn=conn)
+        else:
+            kwargs = dict(database=conn["dbname"], user=conn["user"], password=conn["password"],
+                          host=conn["host"], port=conn["port"])
+        kwargs.update(min_size=size, max_size=size, init=self.init_connection)
+        kwargs.update(self.pool_kwargs)
+        return AsyncpgPool(kwargs)
+    
+    def transaction(self, pool: AsyncpgPool) -> AsyncpgTransaction:
+        return AsyncpgTransaction(pool)
+    
+    async def copy_out(self, pool, query: str, data: dict, format: str, write, columns: list):
+        (query, options) = postgres_copy(query, format)
+        (query, names) = numbered_placeholders(query)
+        con_pool = pool.pool if pool.pool is not None else await pool.connect()
+        async with con_pool.acquire() as con:
+            await con.copy_from_query(query, *[data[n] for n in names], output=write, **options)
+
+
+_sqlite_skip_re = re.compile(r"^\s*((CREATE|DROP)\s+TYPE|CREATE\s+TABLE\s+\w+\s+PARTITION\s+OF)\b", re.IGNORECASE)
+_sqlite_replacements = [
+    # Types
+    (re.compile(r"\bSERIAL\b"), "INTEGER"),
+    (re.compile(r"\b(DOUBLE PRECISION|\w+)\[\]"), "TEXT"),  # Arrays (stored as text)
+    (re.compile(r"(%\(\w+\)s)::(DOUBLE PRECISION|\w+)"), r"\1"),  # Casts of parameters
+    (re.compile(r"\bJSONB?\b"), "TEXT"),
+    # Statements
+    (re.compile(r"\s+CASCADE\s*$"), ""),  # DROP TABLE ... CASCADE
+    (re.compile(r"\)\s+PARTITION BY \w+ \(\w+\);"), ");"),  # Partitions are not created either
+    (re.compile(r"(\bINDEX\b.*\bON\s+\w+)\s+USING\s+\w+"), r"\1"),
+    # Lists of keys (see `Reference.key_condition`), lists are passed as JSON
+    (re.compile(r"= ANY\((%\(\w+\)s)\)"), r"IN (SELECT value FROM json_each(\1))"),
+]
+_sqlite_unnest_re = re.compile(r"SELECT \* FROM unnest\(((?:%\(\w+\)s::[\w ]+\[\],?\s*)+)\)")
+_sqlite_array_param_re = re.compile(r"(%\(\w+\)s)::[\w ]+\[\]")
+_sqlite_row_param_re = re.compile(r"(\)\s*(?:=|<>|!=|<=|>=|<|>)\s*)%\((\w+)\)s")
+_sqlite_cache = {}
+_sqlite_cache_size = 10000
+
+def _sqlite_unnest(m) -> str:
+    params = _sqlite_array_param_re.findall(m.group(1))
+    return "SELECT {} FROM {}".format(
+        ", ".join(["j{}.value".format(i) for i in range(len(params))]),
+        " JOIN ".join(["json_each({}) AS j{}".format(p, i) + (" ON j{}.key = j0.key".format(i) if i > 0 else "")
+                       for (i, p) in enumerate(params)]))
+
+def sqlite_sql(text: str) -> str:
+    """Translate the (Postgres) SQL generated by sparrow to SQLite. Returns `None` for
+    statements that have no meaning in SQLite (like ``CREATE TYPE``; enums are stored as text).
+    """
+    
+    try:
+        return _sqlite_cache[text]
+    except KeyError:
+        pass
+    if _sqlite_skip_re.match(text):
+        result = None
+    else:
+        result = _sqlite_unnest_re.sub(_sqlite_unnest, text)
+        for (regex, replacement) in _sqlite_replacements:
+            result = regex.sub(replacement, result)
+    if len(_sqlite_cache) >= _sqlite_cache_size:
+        _sqlite_cache.clear()
+    _sqlite_cache[text] = result
+    return result
+
+
+def expand_row_params(text: str, data: dict) -> tuple:
+    """SQLite can't bind a tuple, so a tuple parameter compared with a row value (like
+    ``(a, b) = %(key)s`` of a composite `Key`) is split into one parameter per element:
+    ``(a, b) = (%(key__0)s, %(key__1)s)``. Returns the new text and data.
+    """
+    
+    if not any(isinstance(v, tuple) for v in data.values()):
+        return (text, data)
+    data = dict(data)
+    def replace(m):
+        name = m.group(2)
+        value = data.get(name)
+        if not isinstance(value, tuple):
+            return m.group(0)
+        names = ["{}__{}".format(name, i) for i in range(len(value))]
+        data.update(zip(names, value))
+        return m.group(1) + "(" + ", ".join(["%({})s".format(n) for n in names]) + ")"
+    return (_sqlite_row_param_re.sub(replace, text), data)
+
+
+def parse_timestamp(text: str) -> datetime.datetime:
+    """Parse a timestamp as stored by `SqliteBackend`."""
+    return datetime.datetime.strptime(text, "%Y-%m-%d %H:%M:%S.%f" if "." in text else "%Y-%m-%d %H:%M:%S")
+
+
+class SqlitePool:
+    """Pool of `SqliteBackend`: a single connection, used by a dedicated thread so that the
+    event loop never blocks.
+    """
+    
+    def __init__(self, path: str, kwargs: dict):
+        self.path = path
+        self.kwargs = kwargs
+        self.con = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.lock = None  # Held during a transaction, created on first use (needs the event loop)
+    
+    def _execute(self, text: str, args: list) -> RowCursor:
+        # Runs in the thread of the executor
+        cur = self._open_cursor(text, args)
+        rows = cur.fetchall()
+        return RowCursor(rows, len(rows) if cur.description is not None else cur.rowcount)
+    
+    def prepare(self, text: str, data: dict) -> tuple:
+        """Translate `text` and `data` to a query and arguments for sqlite3 (or `None`)."""
+        translated = sqlite_sql(text)
+        if translated is None:
+            return None
+        (translated, data) = expand_row_params(translated, data)
+        (query, names) = numbered_placeholders(translated, "?")
+        # Lists (see `Reference.key_condition`) are passed as JSON
+        args = [json.dumps(data[n]) if isinstance(data[n], list) else data[n] for n in names]
+        return (query, args)
+    
+    async def run(self, func, *args):
+        """Run `func` in the thread of the connection."""
+        return await asyncio.wrap_future(self.executor.submit(func, *args))
+    
+    async def execute_unlocked(self, text: str, data: dict) -> RowCursor:
+        prepared = self.prepare(text, data)
+        if prepared is None:
+            return RowCursor([], -1)
+        return await self.run(self._execute, *prepared)
+    
+    def _open_cursor(self, query: str, args: list):
+        if self.con is None:
+            self.con = sqlite3.connect(self.path, check_same_thread=False, **self.kwargs)
+        return self.con.execute(query, args)
+    
+    async def execute(self, text: str, data: dict) -> RowCursor:
+        if self.lock is not None and self.lock.locked():
+            # Wait for the transaction to finish, the connection is shared
+            async with self.lock:
+                return await self.execute_unlocked(text, data)
+        return await self.execute_unlocked(text, data)
+    
+    async def close(self):
+        if self.con is not None:
+            await asyncio.wrap_future(self.executor.submit(self.con.close))
+            self.con = None
+        self.executor.shutdown(wait=False)
+
+
+class SqliteConnection:
+    """The connection of a `SqlitePool` during a transaction."""
+    
+    def __init__(self, pool: SqlitePool):
+        self.pool = pool
+    
+    async def execute(self, text: str, data: dict) -> RowCursor:
+        return await self.pool.execute_unlocked(text, data)
+
+
+class SqliteTransaction:
+    def __init__(self, pool: SqlitePool):
+        self.pool = pool
+    
+    async def __aenter__(self):
+        if self.pool.lock is None:
+            self.pool.lock = asyncio.Lock()
+        await self.pool.lock.acquire()
+        try:
+            await self.pool.execute_unlocked("BEGIN", {})
+        except:
+            self.pool.lock.release()
+            raise
+        return SqliteConnection(self.pool)
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await self.pool.execute_unlocked("COMMIT" if exc_type is None else "ROLLBACK", {})
+        finally:
+            self.pool.lock.release()
+
+
+class SqliteBackend(Backend):
+    """Backend using an embedded SQLite database, for single node deployments and tests. The
+    `dbname` (or DSN) given to `Database` is the path of the database file (or ``":memory:"``).
+    
+    The SQL generated by sparrow is translated to SQLite (see `sqlite_sql`), but raw queries
+    are not. Enums and arrays are stored as text, and some Postgres-only features (like
+    `Entity.estimated_count` and time buckets of aggregates) are not available.
+    
+    Parameters:
+        - `connect_kwargs`: Extra arguments for ``sqlite3.connect``. By default, the connection
+          is in autocommit mode.
+    """
+    
+    errors = (sqlite3.Error,)
+    
+    def __init__(self, **connect_kwargs):
+        self.connect_kwargs = dict(isolation_level=None)
+        self.connect_kwargs.update(connect_kwargs)
+        self.codecs = self.default_codecs()
+    
+    def default_codecs(self) -> CodecRegistry:
+        # Lists and JSON are stored as JSON text, timestamps as ISO 8601 text
+        codecs = CodecRegistry()
+        codecs.register("json", encode=json.dumps, decode=json.loads)
+        codecs.register("list", encode=json.dumps, decode=json.loads)
+        codecs.register(bool, decode=bool)
+        codecs.register(datetime.datetime, encode=lambda d: d.isoformat(" "), decode=parse_timestamp)
+        return codecs
+    
+    def create_pool(self, conn, size: int) -> SqlitePool:
+        return SqlitePool(conn if isinstance(conn, str) else conn["dbname"], self.connect_kwargs)
+    
+    def transaction(self, pool: SqlitePool) -> SqliteTransaction:
+        return SqliteTransaction(pool)
+    
+    async def copy_out(self, pool: SqlitePool, query: str, data: dict, format: str, write, columns: list):
+        # Emulated: the rows are fetched in batches and formatted in Python
+        if format == "binary":
+            raise ValueError("SQLite has no binary export format")
+        # The connection is shared: hold the lock (like a transaction) so no other statement
+        # runs on it while the cursor is open
+        if pool.lock is None:
+            pool.lock = asyncio.Lock()
+        async with pool.lock:
+            cur = await pool.run(pool._open_cursor, *pool.prepare(query, data))
+            decoders = [self.codecs.lookup(typ).decode if typ is not None else None for (name, typ) in columns]
+            names = [name for (name, typ) in columns]
+            types = [typ for (name, typ) in columns]
+            first = True
+            while True:
+                rows = await pool.run(cur.fetchmany, 1000)
+                out = io.StringIO()
+                if format == "csv":
+                    writer = csv.writer(out, lineterminator="\n")
+                    if first:
+                        writer.writerow(names)
+                    for row in rows:
+                        writer.writerow([v if d is None or v is None else _csv_value(t, d(v))
+                                         for (d, t, v) in zip(decoders, types, row)])
+                else:
+                    for row in rows:
+                        out.write(json.dumps({n: (d(v) if d is not None and v is not None else v)
+                                              for (n, d, v) in zip(names, decoders, row)}, default=_json_default))
+                        out.write("\n")
+                first = False
+                if out.tell() > 0:
+                    await write(out.getvalue().encode())
+                if len(rows) == 0:
+                    break
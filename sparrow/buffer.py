@@ -0,0 +1,320 @@
+
+import asyncio
+import collections
+import logging
+
+from .util import *
+from .sql import *
+
+
+# Helpers
+# =======
+
+def cast_type(prop) -> str:
+    """The type to cast a parameter for `prop` to (serial types are only for columns)."""
+    t = prop.type.sql_type
+    return {"SERIAL": "INTEGER", "BIGSERIAL": "BIGINT"}.get(t, t)
+
+
+def row_params(i: int, names: list) -> list:
+    return ["%(r{}_{})s".format(i, n) for n in names]
+
+
+def write_target(cls, obj, db):
+    """The database a write of `obj` goes to: for a `ShardedDatabase`, the shard of its key
+    (`None` if the key is not known yet).
+    """
+    if not hasattr(db, "shard_for"):
+        return db
+    if obj.key is None and db.is_sharded(cls):
+        return None
+    return db.shard_for(cls, obj.key)
+
+
+write_behind_logger = logging.getLogger("sparrow.write_behind")
+"""Logs the writes of a `WriteBehind` that failed."""
+
+
+# Write buffer
+# ============
+
+class PendingWrites:
+    """The writes of one kind (``"insert"`` or ``"update"``) to one database waiting in a
+    `WriteBuffer`. `entries` is a list of `(object, parameters, future)`, `updates` maps the key
+    of every updated object to its index in `entries`.
+    """
+    
+    def __init__(self, kind: str, db):
+        self.kind = kind
+        self.db = db
+        self.entries = []
+        self.updates = {}
+        self.handle = None
+
+
+class WriteBuffer:
+    """Merges the inserts (and optionally the updates) of a class that are made around the same
+    time, by independent coroutines, into a single statement. Enable it per class with
+    ``__write_buffer__``::
+    
+        class Reading(Entity):
+            __write_buffer__ = WriteBuffer(window=0.005, max_size=500)
+            
+            sensor = Property(int)
+            value = Property(float)
+            key = RID = KeyProperty()
+    
+    `Entity.insert` then waits until the buffer is written (after `window` seconds, or as soon as
+    `max_size` writes are waiting), with a multi-row ``INSERT ... RETURNING``. The timers run
+    on the event loop of the backend (see `Backend.call_later`), so this also works on the
+    IOLoop of tornado. Every caller
+    gets its own result (like the key of a `KeyProperty`). If the statement fails, the writes
+    are retried one by one, so only the callers whose row is wrong get an error.
+    
+    Writes in a `Transaction` and inserts with ``replace=True`` are never buffered. With a
+    `ShardedDatabase`, the writes are merged per shard. Updates of the same object in one
+    window are written once, with the latest state.
+    
+    Parameters:
+        - `window`: The time (in seconds) to wait for other writes.
+        - `max_size`: The maximum number of rows in one statement.
+        - `updates`: Also merge `Entity.update` (into one ``UPDATE ... FROM (VALUES ...)``).
+    """
+    
+    def __init__(self, window: float = 0.002, max_size: int = 100, updates: bool = False):
+        assert max_size >= 1
+        self.window = window
+        self.max_size = max_size
+        self.updates = updates
+        self.cls = None
+        self.pending = {}  # (kind, id(db)) -> PendingWrites
+        self.statements = {}  # (kind, number of rows) -> text
+    
+    def for_class(self, cls) -> "WriteBuffer":
+        """An empty copy, for a class (each class has its own)."""
+        b = WriteBuffer(self.window, self.max_size, self.updates)
+        b.cls = cls
+        return b
+    
+    def applies(self, kind: str, obj, db) -> bool:
+        """Whether a write of `kind` of `obj` to `db` goes through the buffer."""
+        return (kind == "insert" or self.updates) and not isinstance(db, Transaction) \
+            and write_target(self.cls, obj, db) is not None
+    
+    async def add(self, kind: str, obj, params: dict, db):
+        """Write `obj` (with the parameters `params`) with the next batch. Returns the key for
+        inserts of a class with a `KeyProperty`, otherwise `None`.
+        """
+        
+        db = write_target(self.cls, obj, db)
+        k = (kind, id(db))
+        batch = self.pending.get(k)
+        if batch is None:
+            batch = self.pending[k] = PendingWrites(kind, db)
+            batch.handle = db.backend.call_later(self.window, self.start, k)
+        i = batch.updates.get(obj.key) if kind == "update" else None
+        if i is not None:
+            # Updated again in the same window: only write the latest state (with two rows for
+            # one key, Postgres doesn't define which one UPDATE ... FROM uses)
+            future = batch.entries[i][2]
+            batch.entries[i] = (obj, params, future)
+            return await future
+        future = db.backend.create_future()
+        if kind == "update":
+            batch.updates[obj.key] = len(batch.entries)
+        batch.entries.append((obj, params, future))
+        if len(batch.entries) >= self.max_size:
+            self.start(k)
+        return await future
+    
+    def start(self, k: tuple):
+        batch = self.pending.pop(k, None)
+        if batch is not None:
+            batch.handle.cancel()
+            batch.db.backend.spawn(self.write(batch))
+    
+    async def flush(self):
+        """Write all waiting writes now (e.g. at shutdown)."""
+        batches = list(self.pending.values())
+        self.pending = {}
+        for b in batches:
+            b.handle.cancel()
+        for b in batches:
+            await self.write(b)
+    
+    def statement(self, kind: str, n: int) -> str:
+        """The text of the statement to write `n` rows."""
+        try:
+            return self.statements[(kind, n)]
+        except KeyError:
+            pass
+        cls = self.cls
+        names = [p.name for p in cls._complete_props]
+        if kind == "insert":
+            text = "INSERT INTO {} ({}) VALUES {}".format(cls._table_name, ", ".join(names), ", ".join(
+                ["(" + ", ".join(row_params(i, names)) + ")" for i in range(n)]))
+            if cls._incomplete:
+                text += " RETURNING " + cls.key.name
+        else:
+            props = list(cls._complete_props)
+            if cls._incomplete:
+                props.append(cls.key)
+            # The parameters are cast, as VALUES doesn't know the types of the columns
+            casts = ["::" + cast_type(p) for p in props]
+            key_names = [p.name for p in cls.key.referencing_props()]
+            text = "WITH _sparrow_rows ({}) AS (VALUES {}) UPDATE {} SET {} FROM _sparrow_rows WHERE {}".format(
+                ", ".join([p.name for p in props]),
+                ", ".join(["(" + ", ".join([p + c for (p, c) in zip(row_params(i, [p.name for p in props]), casts)]) + ")"
+                           for i in range(n)]),
+                cls._table_name,
+                ", ".join(["{0} = _sparrow_rows.{0}".format(c) for c in names if c not in key_names]),
+                " AND ".join(["{0}.{1} = _sparrow_rows.{1}".format(cls._table_name, c) for c in key_names]))
+        self.statements[(kind, n)] = text
+        return text
+    
+    async def write(self, batch: PendingWrites):
+        entries = batch.entries
+        if len(entries) > 1:
+            data = {}
+            for (i, (obj, params, future)) in enumerate(entries):
+                for (name, value) in params.items():
+                    data["r{}_{}".format(i, name)] = value
+            statement = RawClassedSql(self.cls, self.statement(batch.kind, len(entries)), data, read_only=False)
+            try:
+                if batch.kind == "insert" and self.cls._incomplete:
+                    results = [r[0] for r in await statement.raw_all(batch.db)]
+                else:
+                    await statement.exec(batch.db)
+                    results = [None] * len(entries)
+            except SqlError:
+                pass  # Retry the rows one by one below
+            except Exception as e:
+                for (obj, params, future) in entries:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            else:
+                for ((obj, params, future), result) in zip(entries, results):
+                    if not future.done():
+                        future.set_result(result)
+                return
+        for (obj, params, future) in entries:
+            try:
+                result = await self.write_one(batch.kind, obj, params, batch.db)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+    
+    async def write_one(self, kind: str, obj, params: dict, db):
+        cls = self.cls
+        if kind == "update":
+            await obj._statement_for(cls._update_command, params).exec(db)
+        elif cls._incomplete:
+            return (await obj._statement_for(cls._insert_command, params).raw(db))[0]
+        else:
+            await obj._statement_for(cls._insert_command, params).exec(db)
+
+
+# Write-behind
+# ============
+
+class WriteBehind:
+    """Makes `Entity.update` return (and `RTEntity` notify its listeners) right away, and
+    writes the changes to the database later. Meant for objects that change many times per
+    second (like positions or counters), where only the latest state matters::
+    
+        class Player(RTEntity):
+            __write_behind__ = WriteBehind(interval=1.0)
+            
+            x = Property(float)
+            y = Property(float)
+            key = PID = KeyProperty()
+    
+    Only the latest state of each object is written, within `interval` seconds after its first
+    pending change (or sooner, once `max_pending` objects have changes). Call `flush` (or
+    `SparrowModel.flush_writes`) at shutdown: changes that are not written yet are lost when the
+    process stops. Writes that fail are logged (see `write_behind_logger`); the object is
+    written again with its next update.
+    
+    Updates in a `Transaction` are written immediately. Like for `WriteBuffer`, the timers run
+    on the event loop of the backend, and the writes are merged per shard of a
+    `ShardedDatabase`.
+    
+    Parameters:
+        - `interval`: The maximum time (in seconds) a change waits before it is written.
+        - `max_pending`: The number of objects with pending changes that triggers a write.
+        - `batch_size`: The maximum number of rows in one statement (see `WriteBuffer`).
+    """
+    
+    def __init__(self, interval: float = 1.0, max_pending: int = 1000, batch_size: int = 100):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.cls = None
+        self.writer = None  # A WriteBuffer that writes the batches
+        self.pending = {}  # key -> (object, db)
+        self.backend = None  # Of the last database written to, for the timers
+        self.handle = None
+        self.running = None  # A future while a flush runs, so writes of an object don't overtake each other
+        self.queued = False  # Whether a flush is started but didn't take the pending changes yet
+    
+    def for_class(self, cls) -> "WriteBehind":
+        """An empty copy, for a class (each class has its own)."""
+        b = WriteBehind(self.interval, self.max_pending, self.batch_size)
+        b.cls = cls
+        b.writer = WriteBuffer(max_size=self.batch_size, updates=True).for_class(cls)
+        return b
+    
+    def applies(self, db) -> bool:
+        return not isinstance(db, Transaction)
+    
+    def add(self, obj, db):
+        """Remember that `obj` has to be written to `db`."""
+        db = write_target(self.cls, obj, db)
+        self.pending[obj.key] = (obj, db)
+        self.backend = db.backend
+        if self.handle is None:
+            self.handle = self.backend.call_later(self.interval, self.start)
+        if len(self.pending) >= self.max_pending:
+            self.start()
+    
+    def discard(self, obj):
+        """Forget the pending changes of `obj` (e.g. because it is deleted)."""
+        self.pending.pop(obj.key, None)
+    
+    def start(self):
+        if not self.queued:
+            self.queued = True
+            self.backend.spawn(self.flush())
+    
+    async def flush(self):
+        """Write all pending changes now."""
+        while self.running is not None:
+            await self.running
+        self.queued = False  # Changes from now on need another flush
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if len(self.pending) == 0:
+            return
+        self.running = self.backend.create_future()
+        try:
+            (pending, self.pending) = (self.pending, {})
+            by_db = collections.OrderedDict()
+            for (obj, db) in pending.values():
+                by_db.setdefault(id(db), (db, []))[1].append(obj)
+            for (db, objs) in by_db.values():
+                for i in range(0, len(objs), self.batch_size):
+                    batch = PendingWrites("update", db)
+                    for obj in objs[i:i + self.batch_size]:
+                        batch.entries.append((obj, obj._update_params(db), db.backend.create_future()))
+                    await self.writer.write(batch)
+                    for (obj, params, future) in batch.entries:
+                        if future.exception() is not None:
+                            write_behind_logger.error("Writing %r failed: %s", obj, future.exception())
+        finally:
+            (running, self.running) = (self.running, None)
+            running.set_result(None)
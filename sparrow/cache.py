@@ -0,0 +1,233 @@
+
+import bisect
+
+from .util import *
+from .sql import *
+
+
+# Indexes
+# =======
+
+class CacheIndex:
+    """Declares an index on the objects of a fully cached class (see `FullCache`), so queries
+    answered from the cache don't have to go through all objects::
+    
+        class Country(Entity):
+            __fully_cached__ = True
+            
+            code = Property(str)
+            population = Property(int)
+            key = CID = KeyProperty()
+            
+            by_code = CacheIndex(code)
+            by_population = CacheIndex(population, sorted=True)
+    
+    Parameters:
+        - `prop`: The property (or reference) to index.
+        - `sorted`: Without it, the index only helps for `property == value`. A sorted index
+          also helps for `<`, `<=`, `>` and `>=`, in the order of the database (see
+          `operand_ordering`), so not for text.
+    
+    The index only lives in memory, it has nothing to do with the indexes of the database
+    (see `Index`).
+    """
+    
+    def __init__(self, prop, sorted: bool = False):
+        self.prop = prop
+        self.sorted = sorted
+        # Set by `fresh`, once the properties of a reference are known
+        self.props = None  # See `operand_props`
+        self.getter = None  # See `operand_getter`
+        self.order_key = None  # Gives the value to sort on (see `operand_ordering`), if not the value itself
+        self.values = {}  # key -> indexed value
+        self.by_value = {}  # value -> {key: obj}
+        self.ordered_values = []  # For a sorted index: the values in order ...
+        self.ordered_keys = []  # ... and the key for each of them
+    
+    def fresh(self) -> "CacheIndex":
+        """An empty copy, for a class (each class has its own)."""
+        i = CacheIndex(self.prop, self.sorted)
+        i.props = operand_props(self.prop)
+        assert i.props is not None, "CacheIndex needs a property or reference"
+        i.getter = operand_getter(self.prop)
+        if len(i.props) > 1:
+            i.sorted = False  # Composite references are only compared with =
+        elif i.sorted:
+            try:
+                i.order_key = operand_ordering(i.props[0])
+            except CantEvaluate:
+                i.sorted = False  # Text is ordered by the collation of the database
+        return i
+    
+    def add(self, key, obj):
+        value = self.getter(obj)
+        try:
+            old = self.values[key]
+        except KeyError:
+            pass
+        else:
+            if old == value:
+                return
+            self.remove(key)
+        self.values[key] = value
+        try:
+            self.by_value.setdefault(value, {})[key] = obj
+        except TypeError:  # Unhashable value, can't be found through the index
+            return
+        value = self.ordered_value(value)
+        if self.sorted and value is not None:
+            i = bisect.bisect_right(self.ordered_values, value)
+            self.ordered_values.insert(i, value)
+            self.ordered_keys.insert(i, key)
+    
+    def remove(self, key):
+        try:
+            value = self.values.pop(key)
+        except KeyError:
+            return
+        try:
+            objs = self.by_value[value]
+        except (KeyError, TypeError):
+            return
+        objs.pop(key, None)
+        if len(objs) == 0:
+            del self.by_value[value]
+        value = self.ordered_value(value)
+        if self.sorted and value is not None:
+            i = bisect.bisect_left(self.ordered_values, value)
+            j = bisect.bisect_right(self.ordered_values, value)
+            i += self.ordered_keys[i:j].index(key)
+            del self.ordered_values[i]
+            del self.ordered_keys[i]
+    
+    def ordered_value(self, value):
+        """The value to sort on for `value`."""
+        if self.sorted and self.order_key is not None and value is not None:
+            return self.order_key(value)
+        return value
+    
+    def lookup(self, op: str, value) -> list:
+        """The objects for which `property op value` may hold (`None` if the index can't
+        help).
+        """
+        
+        if op == "=":
+            try:
+                return list(self.by_value.get(value, {}).values())
+            except TypeError:
+                return None
+        if not self.sorted or value is None or op not in ("<", "<=", ">", ">="):
+            return None
+        value = self.ordered_value(value)
+        if value is None:
+            return []  # Not an option of the Enum
+        values = self.ordered_values
+        if op == "<":
+            (start, end) = (0, bisect.bisect_left(values, value))
+        elif op == "<=":
+            (start, end) = (0, bisect.bisect_right(values, value))
+        elif op == ">":
+            (start, end) = (bisect.bisect_right(values, value), len(values))
+        else:
+            (start, end) = (bisect.bisect_left(values, value), len(values))
+        return [self.by_value[self.values[k]][k] for k in self.ordered_keys[start:end]]
+
+
+# Cache
+# =====
+
+class FullCache:
+    """Keeps all objects of a class marked with ``__fully_cached__ = True`` in memory, so
+    queries (see `Select.exec`, `Select.count` and `Select.exists`) are answered without the
+    database. Meant for small tables that are read a lot, like lookup tables.
+    
+    The objects are loaded with `load` (see `SparrowModel.warm_caches`). Until then, queries go
+    to the database. Afterwards the cache follows the inserts, updates and deletes of this
+    process (writes by other processes are not seen). Queries that can't be evaluated in Python
+    (see `Condition.predicate`), with joins or keysets, or ordered by text, still go to the
+    database.
+    """
+    
+    def __init__(self, cls, indexes: list):
+        self.cls = cls
+        self.indexes = indexes
+        self.objects = {}  # key -> object, strong references
+        self.loaded = False
+    
+    async def load(self, db: Database = None):
+        """Load all objects of the class."""
+        self.clear()
+        for obj in await Select(self.cls).all(db):
+            self.written(obj)
+        self.loaded = True
+    
+    def clear(self):
+        """Forget all objects, queries go to the database again until the next `load`."""
+        self.loaded = False
+        self.objects = {}
+        self.indexes = [i.fresh() for i in self.indexes]
+    
+    def written(self, obj):
+        """Add or reindex `obj` (which is in the database)."""
+        key = obj.key
+        self.objects[key] = obj
+        for i in self.indexes:
+            i.add(key, obj)
+    
+    def deleted(self, obj):
+        key = obj.key
+        self.objects.pop(key, None)
+        for i in self.indexes:
+            i.remove(key)
+    
+    def candidates(self, query: Select) -> list:
+        comparisons = query.comparisons()
+        for (prop, op, value) in comparisons:
+            for i in self.indexes:
+                if len(i.props) == 1 and i.props[0].dataname == prop.dataname:
+                    found = i.lookup(op, value)
+                    if found is not None:
+                        return found
+        equalities = {p.dataname: v for (p, op, v) in comparisons if op == "="}
+        for i in self.indexes:
+            if len(i.props) > 1 and all(p.dataname in equalities for p in i.props):
+                found = i.lookup("=", tuple([equalities[p.dataname] for p in i.props]))
+                if found is not None:
+                    return found
+        return list(self.objects.values())
+    
+    def query(self, query: Select) -> list:
+        """The results of `query` (also respecting its order, offset and limit), or `None` if
+        it has to go to the database.
+        """
+        
+        if not self.loaded or len(query.joined_classes) > 0 or query._keyset is not None:
+            return None
+        try:
+            pred = query.predicate()
+        except CantEvaluate:
+            return None
+        objs = [o for o in self.candidates(query) if pred(o)]
+        
+        if query._order is not None:
+            order = getattr(query._order, "source", None) or query._order
+            props = operand_props(order.field) if isinstance(order, Order) else None
+            if props is None or len(props) != 1:
+                return None
+            try:
+                key = operand_ordering(props[0])
+            except CantEvaluate:
+                return None  # Text, ordered by the collation of the database
+            get = operand_getter(props[0])
+            if key is not None:
+                get = ordered_getter(get, key)
+            # Like Postgres: NULL is larger than any value
+            objs.sort(key=lambda o: (get(o) is None, get(o)), reverse=order.op == "DESC")
+        
+        offset = query._offset if query._offset is not None else 0
+        limit = query._limit
+        if not isinstance(offset, int) or not (limit is None or isinstance(limit, int)):
+            return None
+        if offset > 0 or limit is not None:
+            objs = objs[offset:None if limit is None else offset + limit]
+        return objs
@@ -7,11 +7,14 @@ import itertools
 import json
 import weakref  # This is some serious next-level stuff :D
 import types  # For annotations
-
-import pdb
+import time
+import zlib
 
 from .util import *
 from .sql import *
+from .cache import *
+from .partition import *
+from .buffer import *
 
 
 # Exceptions
@@ -71,8 +74,23 @@ default_sqltypes = {
     datetime.datetime: "TIMESTAMP",  # but consider perhaps amount of seconds since UNIX epoch
 }
 
+default_examples = {
+    int: 1,
+    str: "",
+    float: 0.0,
+    bool: False,
+    datetime.datetime: datetime.datetime(2000, 1, 1),
+}
+
 
 class Type:        
+    """The type of a `Property`: a Python type and the SQL type it is stored as. How values are
+    converted for the database library is up to the `CodecRegistry` of the backend. By default,
+    a codec is looked up by `python_type` (or `codec_key`, if a subclass sets one).
+    """
+    
+    codec_key = None
+    
     def __init__(self, python_type, sql_type=None):
         if sql_type is not None:
             self.python_type = python_type
@@ -82,11 +100,22 @@ class Type:
             self.sql_type = default_sqltypes[python_type]
     
     def to_sql(self, obj: "self.python_type"):
+        """Convert a value for the database, if no codec is registered (see `CodecRegistry`)."""
         return obj
     
     def from_sql(self, obj):
+        """Convert a value from the database, if no codec is registered."""
         return obj
     
+    operand_to_sql = None
+    """If set, `Unsafe` values compared to a property of this type (see `Where`) are converted
+    with this function. For types that store values differently from how Python sees them.
+    """
+    
+    def example(self):
+        """Return a representative value of this type (e.g. to EXPLAIN statements)."""
+        return default_examples.get(self.python_type)
+    
     constraint = None
     
     def __str__(self):
@@ -96,17 +125,17 @@ class StaticType(Type):
     pass
 
 class _Json(StaticType):
-    @staticmethod
-    def to_sql(obj):
-        return json.dumps(obj)
+    codec_key = "json"
     
-    #@staticmethod
-    #def from_sql(obj):
-        #return json.loads(obj)
+    @staticmethod
+    def example():
+        return {}
 
 Json = _Json(str, "JSONB")
 
 class List(Type):
+    codec_key = "list"
+    
     def __init__(self, inner_type):
         self.python_type = list
         if not isinstance(inner_type, Type):
@@ -114,32 +143,59 @@ class List(Type):
         self.inner_type = inner_type
         self.sql_type = inner_type.sql_type + "[]"
     
-    def to_sql(self, obj: "self.python_type", f=repr):
-        return "{" + ", ".join([f(o) for o in obj]) + "}"
+    def example(self):
+        return []
     
     def __str__(self):
         return "List(" + str(self.inner_type) + ")"
 
 
 class Enum(Type):
-    def __init__(self, *args):
+    """A value out of a fixed set of strings. By default it is stored as a Postgres ``ENUM``
+    type (named after the class attribute it is assigned to). With ``storage="smallint"``, the
+    position of the value in `options` is stored instead, in a ``SMALLINT`` column.
+    
+    Parameters:
+        - `args`: The possible values.
+        - `storage`: Either ``"enum"`` or ``"smallint"``.
+    """
+    
+    codec_key = "enum"
+    
+    def __init__(self, *args, storage="enum"):
+        assert storage in ("enum", "smallint"), "Unknown storage for Enum: " + repr(storage)
         self.options = args
         self.inv_options = {val: num for num, val in enumerate(self.options)}
+        self.option_set = frozenset(self.options)
         self.python_type = str
+        self.storage = storage
+        if storage == "smallint":
+            # Precomputed lookups, no Python function calls in between
+            self.to_sql = self.operand_to_sql = self.inv_options.__getitem__
+            self.from_sql = self.options.__getitem__
+            self.sql_type = "SMALLINT"
     
     @property
     def constraint(self):
-        def _constraint(val, _self=self):
-            return val in self.options
+        def _constraint(val, _options=self.option_set):
+            try:
+                return val in _options
+            except TypeError:  # Unhashable, certainly not an option
+                return False
         return _constraint
     
     def __postinit__(self):
         self.__postinited__ = True
+        if self.storage != "enum":
+            return
         self._create_type_command = RawSql("CREATE TYPE {s.name} AS ENUM ({opt})".format(
             s=self, opt=", ".join(["'" + str(s) + "'" for s in self.options])))
         self._drop_type_command = RawSql("DROP TYPE IF EXISTS {s.name} CASCADE".format(s=self))
         self.sql_type = self.name
     
+    def example(self):
+        return self.options[0]
+    
     def __str__(self):
         return "Enum(" + ", ".join([repr(o) for o in self.options]) + ")"
 
@@ -202,11 +258,13 @@ class Queryable:
         
         Queryable._use_own_overloads = use_own
 
+Queryable._set_overloads(True)
         
 
 class Property(Queryable):
     def __init__(self, typ, constraint: types.FunctionType = None, sql_extra: str = "", 
-                 required: bool = True, json: bool = True):
+                 required: bool = True, json: bool = True, index: bool = False, unique: bool = False):
+        """`index` and `unique` create a (unique) `Index` on this property."""
         if not isinstance(typ, (Type, StaticType)):
             typ = Type(typ)
         self.type = typ
@@ -220,6 +278,8 @@ class Property(Queryable):
         self.sql_extra = sql_extra
         self.required = required
         self.json = json
+        self.index = index
+        self.unique = unique
         self.name = None  # Set by the metaclass
         self.dataname = None  # Idem, where to find the actual stored data inside an object
         self.cls = None  # Idem
@@ -228,6 +288,10 @@ class Property(Queryable):
         self.__postinited__ = True
         # ...
     
+    def query_columns(self):
+        """The properties (columns) this stands for in a query."""
+        return [self]
+    
     def sql_def(self):
         return "\t" + self.name + " " + self.type_sql_def()
     
@@ -265,6 +329,9 @@ class Key(Queryable):
     def referencing_props(self):
         yield from self.props
     
+    def query_columns(self):
+        return list(self.referencing_props())
+    
     def sql_constraint(self) -> str:
         """Returns the SQL needed to define the PRIMARY KEY constraint."""
         return "\tPRIMARY KEY " + str(self)
@@ -328,9 +395,13 @@ class KeyProperty(SingleKey, Property):
         
 
 class Reference(Queryable):
-    """A reference to another Entity type."""
+    """A reference to another Entity type.
+    
+    With `index=True`, an `Index` is created on the referencing properties. By default (`None`),
+    this is decided by the class attribute `__index_references__` of the referencing class.
+    """
     
-    def __init__(self, ref: "MetaEntity", json=True, cascade=True):
+    def __init__(self, ref: "MetaEntity", json=True, cascade=True, index=None):
         self.ref = ref
         self.json = json
         self.ref_props = list(ref.key.referencing_props())
@@ -338,7 +409,10 @@ class Reference(Queryable):
         self.props = []
         self.single_prop = None
         self.name = None  # Set by metaclass
+        self.cls = None  # Idem, the referencing class
         self.cascade = cascade
+        self.index = index
+        self._prefetch_query = None
     
     @classmethod
     def single_upgrade(cls):
@@ -346,9 +420,11 @@ class Reference(Queryable):
     
     def __postinit__(self):  # called by metaclass
         self.__postinited__ = True
+        self._prefetch_query = None
         self.props = []
         for rp in self.ref_props:
-            p = Property(Type(rp.type.python_type, rp.type.sql_type if not rp.type.sql_type == "SERIAL" else None), json=self.json)
+            # The same type as the key (so also the same codec), but a SERIAL is just an integer
+            p = Property(rp.type if rp.type.sql_type != "SERIAL" else Type(rp.type.python_type), json=self.json)
             p.cls = rp.cls
             p.name = self.name + "_" + rp.name
             p.dataname = self.name + "_" + rp.dataname
@@ -358,16 +434,123 @@ class Reference(Queryable):
             self.single_prop = self.props[0]
             self.__class__ = self.single_upgrade()
     
+    def query_columns(self):
+        return list(self.props)
+    
     def sql_constraint(self) -> str:
         """Will only generate the SQL constraint. The metaclass will take care of the properties."""
         return "\tFOREIGN KEY ({own_props}) REFERENCES {ref_name}".format(
             own_props=", ".join([p.name for p in self.props]),
             ref_name=self.ref._table_name,
-        ) + " ON DELETE CASCADE" if self.cascade else ""
+        ) + (" ON DELETE CASCADE" if self.cascade else "")
     
     def __str__(self):
         return "(" + ", ".join([str(p) for p in self.props]) + ")"
     
+    def resolve(self, obj: "Entity") -> "Entity":
+        """Returns the object `obj` refers to, if it is in memory (for example because of
+        `Select.prefetch`), otherwise `None`.
+        """
+        
+        key = self.__get__(obj)
+        target = obj.__dict__.get("_ref_" + self.name)
+        if target is not None and target.key == key:
+            return target
+        return self.ref.cache.get(key)
+    
+    async def prefetch(self, objs: list, db: Database = None, rest: tuple = ()):
+        """Load the objects referred to by `objs` (objects of the referencing class) in a single
+        query, and keep them in memory as long as `objs` are. Afterwards, continue with the
+        references in `rest` (starting from the loaded objects). See `Select.prefetch`.
+        """
+        
+        keys = set()
+        for o in objs:
+            key = self.__get__(o)
+            # Objects that don't refer to anything have None in all referencing properties
+            if key is not None and not (isinstance(key, tuple) and all(k is None for k in key)):
+                keys.add(key)
+        missing = [k for k in keys if k not in self.ref.cache]
+        if len(missing) > 0:
+            if self._prefetch_query is None:
+                self._prefetch_query = RawClassedSql(self.ref, "SELECT {props} FROM {t} WHERE {cond}".format(
+                    props=self.ref._select_props, t=self.ref._table_name,
+                    cond=self.key_condition(self.ref_props, "keys")))
+            loaded = await self._prefetch_query.with_data(**self.key_data(self.ref_props, missing, "keys", db)).all(db)
+        
+        targets = []
+        for o in objs:
+            target = self.ref.cache.get(self.__get__(o))
+            o.__dict__["_ref_" + self.name] = target
+            if target is not None:
+                targets.append(target)
+        
+        if len(rest) > 0:
+            assert rest[0].cls is self.ref, "Path of references does not connect"
+            await rest[0].prefetch(list(set(targets)), db, rest[1:])
+    
+    def key_condition(self, props: list, param: str) -> str:
+        """SQL condition that checks whether `props` (properties matching the key of `ref`) are
+        in the list of keys given by the field `param` (see `key_data`).
+        """
+        
+        if len(props) == 1:
+            return "{} = ANY(%({})s)".format(props[0].name, param)
+        # Composite keys are passed as one array per property, which works with every backend
+        arrays = ["%({}_{})s::{}[]".format(param, i, default_sqltypes[int] if p.type.sql_type == "SERIAL" else p.type.sql_type)
+                  for (i, p) in enumerate(props)]
+        return "({}) IN (SELECT * FROM unnest({}))".format(", ".join([p.name for p in props]), ", ".join(arrays))
+    
+    def key_data(self, props: list, keys: list, param: str, db: Database = None) -> dict:
+        """Data for `key_condition`, encoded with the codecs of `db` (see `CodecRegistry`)."""
+        if db is None:
+            db = GlobalDb.get()
+        keys = [db.codecs.encode_key(props, k) for k in keys]
+        if len(props) == 1:
+            return {param: keys}
+        return {"{}_{}".format(param, i): [k[i] for k in keys] for i in range(len(props))}
+    
+    async def load_referencing(self, parents: list, order: "Order" = None, limit: int = None,
+                               db: Database = None) -> collections.OrderedDict:
+        """Find the objects (of the referencing class) that refer to any of `parents` (objects
+        of `ref`), with a single query. Returns an ordered dictionary from the key of every parent
+        to a list of the objects referring to it::
+        
+            comments = await Comment.thread.load_referencing(threads, order=-Comment.posted, limit=3)
+            for t in threads:
+                latest = comments[t.key]
+        
+        With `limit`, only the first `limit` objects (according to `order`, by default the key)
+        per parent are returned.
+        """
+        
+        result = collections.OrderedDict([(p.key, []) for p in parents])
+        keys = list(result)
+        if len(keys) == 0:
+            return result
+        
+        if order is None:
+            order = Order(self.cls.key, "ASC")
+        elif not isinstance(order, Order):
+            order = +order
+        cond = self.key_condition(self.props, "keys")
+        data = self.key_data(self.props, keys, "keys", db)
+        data.update(order.data)
+        if limit is None:
+            text = "SELECT {props} FROM {t} WHERE {cond} ORDER BY {order}".format(
+                props=self.cls._select_props, t=self.cls._table_name, cond=cond, order=order)
+        else:
+            text = ("SELECT {props} FROM (SELECT {props}, ROW_NUMBER() OVER (PARTITION BY {fk} ORDER BY {order}) "
+                    + "AS _sparrow_rank FROM {t} WHERE {cond}) AS _sparrow_ranked "
+                    + "WHERE _sparrow_rank <= %(limit)s ORDER BY {fk}, _sparrow_rank").format(
+                props=self.cls._select_props, t=self.cls._table_name, cond=cond, order=order,
+                fk=", ".join([p.name for p in self.props]))
+            data["limit"] = limit
+        
+        for child in await RawClassedSql(self.cls, text, data).all(db):
+            result[self.__get__(child)].append(child)
+        return result
+    
     def __get__(self, obj, type=None):
         if obj is None:
             return self
@@ -386,10 +569,10 @@ class Reference(Queryable):
 class RTReference(Reference):
     """Reference that automatically notifies the referencing object."""
     
-    def __init__(self, ref: "MetaEntity"):
+    def __init__(self, ref: "MetaEntity", index=None):
         """`ref` needs to be a subclass of `RTEntity`."""
         assert issubclass(ref, RTEntity)
-        Reference.__init__(self, ref)
+        Reference.__init__(self, ref, index=index)
     
     @classmethod
     def single_upgrade(cls):
@@ -451,6 +634,72 @@ class RTSingleReference(RTReference, SingleReference):
 
 
 
+class Index:
+    """Declares a secondary index on an Entity class::
+    
+        class User(Entity):
+            firstname = Property(str)
+            lastname = Property(str)
+            mail = Property(str, unique=True)  # Shorthand for a unique index on one property
+            active = Property(bool)
+            tags = Property(List(str))
+            key = UID = KeyProperty()
+            
+            by_name = Index(lastname, firstname)
+            active_mail = Index("lower(mail)", unique=True, where="active")
+            by_tag = Index(tags, method="gin")
+    
+    Parameters:
+        - `columns`: Properties, references, keys or SQL expressions (as strings).
+        - `unique`: Create a UNIQUE index.
+        - `where`: SQL condition (string) to create a partial index.
+        - `method`: The index method, like 'btree' (the default), 'hash', 'gin', 'gist' or 'brin'.
+        - `name`: Name of the index in the database. By default it is derived from the name of
+          the table and the attribute.
+    """
+    
+    def __init__(self, *columns, unique=False, where=None, method=None, name=None):
+        assert len(columns) >= 1
+        self.columns = columns
+        self.unique = unique
+        self.where = where
+        self.method = method
+        self.explicit_name = name
+        self.name = name  # Set by the metaclass if None
+    
+    def column_names(self):
+        """Yields the names of the properties in this index (and None for expressions)."""
+        for c in self.columns:
+            if isinstance(c, Reference):
+                yield from [p.name for p in c.props]
+            elif isinstance(c, Key):
+                yield from [p.name for p in c.referencing_props()]
+            elif isinstance(c, Property):
+                yield c.name
+            else:
+                yield None
+    
+    def column_sql(self):
+        l = []
+        for c in self.columns:
+            if isinstance(c, str):
+                l.append(c if c.isidentifier() else "(" + c + ")")
+            else:
+                l.extend([n for n in Index(c).column_names()])
+        return l
+    
+    def __str__(self):
+        return "Index({})".format(", ".join(self.column_sql()))
+
+
+def index_name(table_name: str, name: str) -> str:
+    """Name for an index, shortened to fit in Postgres' 63 character limit."""
+    s = table_name + "_" + name + "_idx"
+    if len(s) > 63:
+        s = s[:54] + "_" + format(zlib.crc32(s.encode()), "08x")
+    return s
+
+
 # This is a better way of doing things than python's native property
 class ConstrainedProperty(Property):
     # No init, just hack around it by setting __class__
@@ -467,6 +716,42 @@ class ConstrainedProperty(Property):
             obj.__dict__[self.dataname] = val
 
 
+class LazyStatement:
+    """Non-data descriptor for a statement of an Entity class (like `_insert_command`) that is
+    only built on first use. It then replaces itself by the statement in the class.
+    """
+    
+    def __init__(self, name: str, build: types.FunctionType):
+        self.name = name
+        self.build = build
+    
+    def __get__(self, obj, cls):
+        start = time.perf_counter()
+        stat = self.build(cls)
+        setattr(cls, self.name, stat)
+        cls._statements_time += time.perf_counter() - start
+        return stat
+
+
+def _insert_command(cls, replace=False):
+    if cls._incomplete:
+        return Insert(cls, returning=cls.key, replace=replace).to_raw()
+    return Insert(cls, replace=replace).to_raw()
+
+lazy_statements = collections.OrderedDict([(s.name, s) for s in [
+    LazyStatement("_create_table_command", lambda cls: CreateTable(cls).to_raw()),
+    LazyStatement("_drop_table_command", lambda cls: DropTable(cls).to_raw()),
+    LazyStatement("_create_index_commands", lambda cls: [CreateIndex(cls, i).to_raw() for i in cls._indexes]),
+    LazyStatement("_drop_index_commands", lambda cls: [DropIndex(cls, i).to_raw() for i in cls._indexes]),
+    LazyStatement("_insert_command", _insert_command),
+    LazyStatement("_replace_command", lambda cls: _insert_command(cls, replace=True)),
+    LazyStatement("_update_command", lambda cls: Update(cls).to_raw()),
+    LazyStatement("_delete_command", lambda cls: Delete(cls).to_raw()),
+    LazyStatement("_find_by_key_query", lambda cls: Select(cls, [cls.key == Field("key")])),
+]])
+"""The statements every Entity class has, see `LazyStatement`."""
+
+
 def classitems(dct, bases):
     """Helper function to allow for inheritance"""
     for b in bases:
@@ -485,7 +770,9 @@ class MetaEntity(type):
         return collections.OrderedDict()
 
     def __new__(self, name, bases, dct):
-        Queryable._set_overloads(False)
+        # Note: the operators of `Queryable` build queries, so properties are compared with
+        # `is` (and not `==` or `in`) here.
+        start = time.perf_counter()
         
         # TODO test inheritance?
         all_items = list(classitems(dct, bases))
@@ -503,17 +790,22 @@ class MetaEntity(type):
                 if isinstance(v, Enum):
                     v.name = k
                     v.__postinit__()
-                    enums.append(v)
+                    if v.storage == "enum":
+                        enums.append(v)
             
             dct["_enums"] = enums
             
+            # Properties (and references) that already belong to another class (e.g. a base class)
+            # are copied. `copies` maps the id of the original to the copy.
+            copies = {}
             props = []
             json_props = []
             init_properties = []
             for k in ordered_props:
                 p = full_dct[k]
                 if hasattr(p, "__postinited__") and p.__postinited__:
-                    p = copy.deepcopy(p)
+                    copies[id(p)] = copy.copy(p)
+                    p = copies[id(p)]
                     full_dct[k] = p
                     dct[k] = p
                 # Set some stuff of properties that are not known at creation time
@@ -539,7 +831,8 @@ class MetaEntity(type):
             for k in ordered_refs:
                 r = full_dct[k]
                 if hasattr(r, "__postinited__") and r.__postinited__:
-                    r = copy.deepcopy(r)
+                    copies[id(r)] = copy.copy(r)
+                    r = copies[id(r)]
                     full_dct[k] = r
                     dct[k] = r
                 r.name = k
@@ -553,6 +846,7 @@ class MetaEntity(type):
             dct["_json_props"] = json_props  # see below for _edit_json_props
             dct["_refs"] = refs
             dct["_rt_refs"] = [r for r in refs if isinstance(r, RTReference)]
+            dct["_live"] = None  # LiveQueries, created by the first subscription
             
             def __metainit__(obj, db_args=None, json_dict=None, **kwargs):
                 # TODO document and test three ways of initialisation
@@ -561,7 +855,7 @@ class MetaEntity(type):
                     obj.in_db = True
                     start = 0
                     for (i, (p, constrained)) in enumerate(init_properties):
-                        val = p.type.from_sql(db_args[i])
+                        val = db_args[i]  # Already decoded, see SqlResult
                         if constrained and (not p.constraint(val)):
                             raise PropertyConstraintFail(obj, p)
                         obj.__dict__[p.dataname] = val
@@ -618,8 +912,15 @@ class MetaEntity(type):
             
             if "key" in full_dct:
                 the_key = full_dct["key"]
-                if hasattr(the_key, "__postinited__") and the_key.__postinited__:
-                    the_key = copy.deepcopy(the_key)
+                if id(the_key) in copies:
+                    # A KeyProperty, already copied above
+                    the_key = copies[id(the_key)]
+                elif any(p is the_key for p in props):
+                    pass  # A KeyProperty of this class
+                elif hasattr(the_key, "__postinited__") and the_key.__postinited__:
+                    the_key = copy.copy(the_key)
+                    if not isinstance(the_key, Property):
+                        the_key.props = [copies.get(id(p), p) for p in the_key.orig_props]
                 the_key.__postinit__()
                 dct["key"] = the_key
                 full_dct["key"] = the_key
@@ -631,36 +932,64 @@ class MetaEntity(type):
             
             dct["_table_name"] = "table_" + name
             
-            edit_json_props = json_props[:]
-            for p in the_key.referencing_props():
-                if p in edit_json_props:
-                    edit_json_props.remove(p)
-            dct["_edit_json_props"] = edit_json_props
+            indexes = []
+            for (k, v) in full_dct.items():
+                if isinstance(v, Index):
+                    i = copy.copy(v)
+                    if i.explicit_name is None:
+                        i.name = index_name(dct["_table_name"], k)
+                    indexes.append(i)
+            for p in props:
+                if p.index or p.unique:
+                    indexes.append(Index(p, unique=p.unique, name=index_name(dct["_table_name"], p.name)))
+            key_names = [p.name for p in the_key.referencing_props()]
+            for r in refs:
+                index_ref = r.index if r.index is not None else full_dct.get("__index_references__", False)
+                # The primary key already serves as index if it starts with the reference
+                if index_ref and key_names[:len(r.props)] != [p.name for p in r.props]:
+                    indexes.append(Index(r, name=index_name(dct["_table_name"], r.name)))
+            dct["_indexes"] = indexes
+            
+            partitioning = full_dct.get("__partition__", None)
+            if partitioning is not None:
+                partitioning = partitioning.for_class(copies)
+                # Postgres needs the partition column in the primary key (and unique indexes)
+                assert partitioning.column.name in key_names, "The partition column must be part of the key"
+            dct["_partitioning"] = partitioning
+            
+            cache_indexes = [v.fresh() for v in full_dct.values() if isinstance(v, CacheIndex)]
+            fully_cached = full_dct.get("__fully_cached__", False)
+            assert fully_cached or len(cache_indexes) == 0, "CacheIndex needs __fully_cached__ = True"
             
-            Queryable._set_overloads(True)
+            key_ids = {id(p) for p in the_key.referencing_props()}
+            dct["_edit_json_props"] = [p for p in json_props if id(p) not in key_ids]
+            
+            # The statements of the class are built on first use, see `LazyStatement`
+            for (k, v) in lazy_statements.items():
+                dct[k] = v
             
             cls = type.__new__(self, name, bases, dct)
             
             for p in props:
                 p.cls = cls
+            for r in refs:
+                r.cls = cls
             if isinstance(cls.key, Property):
                 cls.key.cls = cls
             
-            cls._select_props = ", ".join([p.name for p in itertools.chain([p for p, c in init_properties], init_raw_ref_properties)])
-            cls._create_table_command = CreateTable(cls).to_raw()
-            cls._drop_table_command = DropTable(cls).to_raw()
-            if cls._incomplete:
-                cls._insert_command = Insert(cls, returning=cls.key).to_raw()
-                cls._replace_command = Insert(cls, returning=cls.key, replace=True).to_raw()
-            else:
-                cls._insert_command = Insert(cls).to_raw()
-                cls._replace_command = Insert(cls, replace=True).to_raw()
-            cls._update_command = Update(cls).to_raw()
-            cls._delete_command = Delete(cls).to_raw()
-            cls._find_by_key_query = Select(cls, [cls.key == Field("key")])
+            cls._select_columns = [p.name for p in itertools.chain([p for p, c in init_properties], init_raw_ref_properties)]
+            cls._select_props = ", ".join(cls._select_columns)
             
             # FANCYYYY
             cls.cache = weakref.WeakValueDictionary()
+            cls._full_cache = FullCache(cls, cache_indexes) if fully_cached else None
+            write_buffer = full_dct.get("__write_buffer__", None)
+            cls._write_buffer = write_buffer.for_class(cls) if write_buffer is not None else None
+            write_behind = full_dct.get("__write_behind__", None)
+            cls._write_behind = write_behind.for_class(cls) if write_behind is not None else None
+            
+            cls._define_time = time.perf_counter() - start
+            cls._statements_time = 0.0
             
         else:
             cls = type.__new__(self, name, bases, dct)
@@ -674,6 +1003,8 @@ class MetaEntity(type):
                 return self.cache[inst.key]
             else:
                 self.cache[inst.key] = inst
+                if self._full_cache is not None and inst.in_db and self._full_cache.loaded:
+                    self._full_cache.written(inst)
         return inst
     
 
@@ -705,25 +1036,49 @@ class Entity(metaclass=MetaEntity):
             # So be careful with replace!
         else:
             await self._simple_insert(db, replace)
+        if type(self)._full_cache is not None:
+            type(self)._full_cache.written(self)
+        if type(self)._live is not None:
+            type(self)._live.written(self)
     
     async def _simple_insert(self, db: Database = None, replace=False):
         if db is None:
             db = GlobalDb.get()
+        cls = type(self)
+        dct = self._insert_params(db)
+        if cls._write_buffer is not None and not replace and cls._write_buffer.applies("insert", self, db):
+            key = await cls._write_buffer.add("insert", self, dct, db)
+        else:
+            if replace:
+                insert = self._statement_for(cls._replace_command, dct)
+            else:
+                insert = self._statement_for(cls._insert_command, dct)
+            if cls._incomplete:
+                (key,) = await insert.raw(db)
+            else:
+                await insert.exec(db)
+                key = None
+        self._after_insert(key)
+    
+    def _statement_for(self, command: Sql, params: dict) -> Sql:
+        """`command` with the data `params`, to write this object. Remembers the key of the
+        object (the values in `params` may be encoded, see `CodecRegistry`).
+        """
+        statement = command.with_data(**params)
+        statement.object_key = self.key
+        return statement
+    
+    def _insert_params(self, db: Database) -> dict:
+        """Check the object and return the parameters to insert it."""
         self.check()
         assert not self.in_db
+        return db.codecs.encode_object(self)
+    
+    def _after_insert(self, key):
+        """Mark the object as inserted, `key` is the value of its `KeyProperty` (if any)."""
         cls = type(self)
-        dct = {}
-        for p in self._complete_props:
-            dct[p.name] = p.type.to_sql(self.__dict__[p.dataname])
-        if replace:
-            insert = cls._replace_command.with_data(**dct)
-        else:
-            insert = cls._insert_command.with_data(**dct)
         if cls._incomplete:
-            result = await insert.raw(db)
-            self.__dict__[cls.key.dataname] = result[0]
-        else:
-            await insert.exec(db)
+            self.__dict__[cls.key.dataname] = key
         self.in_db = True
         
         for rt_ref in self._rt_refs:
@@ -739,24 +1094,43 @@ class Entity(metaclass=MetaEntity):
             db = GlobalDb.get()
         self.check()
         assert self.in_db
-        dct = {}
-        for p in self._complete_props:
-            dct[p.name] = p.type.to_sql(self.__dict__[p.dataname])
+        behind = type(self)._write_behind
+        buffer = type(self)._write_buffer
+        if behind is not None and behind.applies(db):
+            behind.add(self, db)
+        elif buffer is not None and buffer.applies("update", self, db):
+            await buffer.add("update", self, self._update_params(db), db)
+        else:
+            await self._statement_for(type(self)._update_command, self._update_params(db)).exec(db)
+        if type(self)._full_cache is not None:
+            type(self)._full_cache.written(self)
+        if type(self)._live is not None:
+            type(self)._live.written(self)
+    
+    
+    def _update_params(self, db: Database) -> dict:
+        """The parameters to update the object."""
+        dct = db.codecs.encode_object(self)
         if type(self)._incomplete:
             dct[type(self).key.name] = self.__dict__[type(self).key.dataname]
-        await type(self)._update_command.with_data(**dct).exec(db)
-    
+        return dct
     
     async def delete(self, db=None):
         """Delete object from the database."""
         if db is None:
             db = GlobalDb.get()
         assert self.in_db
+        if type(self)._write_behind is not None:
+            type(self)._write_behind.discard(self)
         dct = {}
         for p in type(self).key.referencing_props():
-            dct[p.name] = self.__dict__[p.dataname]
-        await type(self)._delete_command.with_data(**dct).exec(db)
+            dct[p.name] = db.codecs.encode(p.type, self.__dict__[p.dataname])
+        await self._statement_for(type(self)._delete_command, dct).exec(db)
         self.in_db = False
+        if type(self)._full_cache is not None:
+            type(self)._full_cache.deleted(self)
+        if type(self)._live is not None:
+            type(self)._live.deleted(self)
     
     
     constraint = None
@@ -775,14 +1149,44 @@ class Entity(metaclass=MetaEntity):
                 raise ObjectConstraintFail(self)
 
     @classmethod
-    def raw(cls: MetaEntity, text: str, dct={}) -> RawSql:
-        """Return a RawSql where the results will be interpreted as objects of `cls`."""
-        return RawClassedSql(cls, text, dct)
+    def raw(cls: MetaEntity, text: str, dct={}, read_only=None) -> RawSql:
+        """Return a RawSql where the results will be interpreted as objects of `cls`.
+        See `RawSql` for `read_only`.
+        """
+        return RawClassedSql(cls, text, dct, read_only)
     
     @classmethod
     def get(cls: MetaEntity, *where_clauses: list) -> Sql:
         return Select(cls, where_clauses)
     
+    @classmethod
+    async def estimated_count(cls: MetaEntity, db: Database = None) -> int:
+        """Fast estimate of the number of objects in the database, based on the statistics of
+        Postgres (``pg_class.reltuples``). Returns `None` if there is no estimate yet.
+        """
+        
+        (n,) = await RawSql("SELECT reltuples::BIGINT FROM pg_class WHERE oid = %(t)s::regclass",
+                            {"t": cls._table_name}).raw(db)
+        return n if n >= 0 else None
+    
+    @classmethod
+    def _create_partition_commands(cls: MetaEntity, now: datetime.datetime = None) -> list:
+        """The `(name, statement)` of every partition that should exist at `now` (see
+        `Partitioning.partitions`). Not a `LazyStatement`: the partitions change over time.
+        """
+        
+        if cls._partitioning is None:
+            return []
+        return [(name, CreatePartition(cls, name, bound).to_raw())
+                for (name, bound) in cls._partitioning.partitions(cls._table_name, now)]
+    
+    @classmethod
+    async def _subscribe(cls: MetaEntity, query: Select, listener: "QueryListener", db: Database = None) -> "Subscription":
+        # See Select.subscribe
+        if cls._live is None:
+            cls._live = LiveQueries()
+        return await Subscription(cls._live, query, listener).start(db)
+    
     @classmethod
     async def find_by_key(cls: MetaEntity, key, db: Database = None) -> "cls":
         """Works different from `get`, as it will immediatly return the object"""
@@ -792,7 +1196,9 @@ class Entity(metaclass=MetaEntity):
         try:
             return cls.cache[key]
         except KeyError:
-            return await cls._find_by_key_query.with_data(key=key).single(db)
+            query = cls._find_by_key_query.with_data(key=db.codecs.encode_key(list(cls.key.referencing_props()), key))
+            query.object_key = key
+            return await query.single(db)
     
     def __setprop__(self, prop, val):
         if isinstance(prop, ConstrainedProperty) and (not prop.constraint(val)):
@@ -846,12 +1252,14 @@ class Entity(metaclass=MetaEntity):
 
 class RTEntity(Entity):
     """Subclass of Entity that sends live updates!
-    Listeners should follow the interface of `Listener`.
+    Listeners should follow the interface of `Listener`. With a `WriteBehind`, the listeners
+    are notified before the update is written to the database.
     """
     __no_meta__ = True
     
     def __init__(self, *args, **kwargs):
         self._listeners = set()
+        self._notified = None  # The json properties at the last notification, see `Delta`
         super(RTEntity, self).__init__(*args, **kwargs)
     
     async def update(self, db: Database = None):
@@ -859,15 +1267,41 @@ class RTEntity(Entity):
             db = GlobalDb.get()
             
         await super(RTEntity, self).update(db)
-        for l in self._listeners:
-            l.update(self)
+        self._notify_update()
     
     def send_update(self, db = None):
+        """To manually send messages to all listeners. Won't save to database."""
         if db is None:
             db = GlobalDb.get()
-        """To manually send messages to all listeners. Won't save to database."""
+        self._notify_update()
+    
+    def _notify_update(self):
+        if len(self._listeners) == 0:
+            return
+        delta = self.delta()
         for l in self._listeners:
-            l.update(self)
+            update_fields = getattr(l, "update_fields", None)
+            if update_fields is not None:
+                update_fields(self, delta)
+            else:
+                l.update(self)
+        for (name, (old, new)) in delta.changes.items():
+            self._notified[name] = snapshot_value(new)
+    
+    def delta(self) -> "Delta":
+        """The changes of the json properties since the listeners were last notified."""
+        if self._notified is None:
+            self._take_snapshot()
+        changes = {}
+        for p in type(self)._json_props:
+            old = self._notified[p.name]
+            new = self.__dict__[p.dataname]
+            if old != new:
+                changes[p.name] = (old, new)
+        return Delta(self, changes)
+    
+    def _take_snapshot(self):
+        self._notified = {p.name: snapshot_value(self.__dict__[p.dataname]) for p in type(self)._json_props}
     
     async def delete(self, db = None):
         if db is None:
@@ -888,6 +1322,8 @@ class RTEntity(Entity):
     
     def add_listener(self, l: "Listener"):
         """Add listeners to this object."""
+        if self._notified is None:
+            self._take_snapshot()
         self._listeners.add(l)
         l._add_listenee(self)
     
@@ -924,6 +1360,12 @@ class Listener:
     def update(self, obj: RTEntity):
         """Handle updates to the object."""
     
+    def update_fields(self, obj: RTEntity, delta: "Delta"):
+        """Handle updates to the object, `delta` tells which json properties changed. This
+        method is optional: listeners without it get `update` instead.
+        """
+        self.update(obj)
+    
     def delete(self, obj: RTEntity):
         """Handle deletions of the object."""
     
@@ -937,3 +1379,207 @@ class Listener:
         have to be a `RTEntity`.
         """
     
+
+
+immutable_types = (str, int, float, bool, type(None), datetime.datetime, datetime.date, datetime.time,
+                   datetime.timedelta, tuple, frozenset)
+
+def snapshot_value(value):
+    """A copy of `value` that doesn't change when `value` is changed in place (like a list)."""
+    return value if type(value) in immutable_types else copy.deepcopy(value)
+
+
+class Delta:
+    """The json properties (see `Entity.json_repr`) of a `RTEntity` that changed since its
+    listeners were last notified, given to `Listener.update_fields`.
+    
+    Parameters:
+        - `obj`: The object.
+        - `changes`: Dictionary from the name of each changed property to `(old, new)`.
+    """
+    
+    def __init__(self, obj: RTEntity, changes: dict):
+        self.obj = obj
+        self.changes = changes
+        self._json = None
+    
+    def __len__(self):
+        return len(self.changes)
+    
+    def values(self) -> dict:
+        """Dictionary from the name of each changed property to its new value."""
+        return {name: new for (name, (old, new)) in self.changes.items()}
+    
+    @property
+    def json(self) -> str:
+        """The new values as JSON (serialized once, for all listeners): the changed names of
+        `Entity.json_repr`, so a client can apply this to the `Entity.to_json` it got before. If
+        `json_repr` is overridden to return something else than a dictionary, it is the whole
+        `json_repr`.
+        """
+        if self._json is None:
+            r = self.obj.json_repr()
+            if isinstance(r, dict):
+                r = {name: r[name] for name in self.changes if name in r}
+            self._json = json.dumps(r)
+        return self._json
+
+
+# Live queries
+# ============
+
+class QueryListener:
+    """Interface for listeners of live queries (see `Select.subscribe`). Like `Listener`, it
+    is mainly documentation.
+    """
+    
+    def snapshot(self, objs: list):
+        """The results of the query when the subscription starts."""
+    
+    def added(self, obj: Entity):
+        """`obj` was inserted or updated, and is now in the results."""
+    
+    def changed(self, obj: Entity):
+        """`obj` was updated, and is still in the results."""
+    
+    def removed(self, obj: Entity):
+        """`obj` was deleted, or updated and no longer in the results."""
+
+
+class Subscription:
+    """A live query, see `Select.subscribe`. `members` maps the keys of the objects in the
+    results to the objects (which are kept in memory).
+    """
+    
+    def __init__(self, live: "LiveQueries", query: Select, listener: QueryListener):
+        self.live = live
+        self.query = query
+        self.listener = listener
+        self.predicate = query.predicate()  # Fails early for conditions Python can't evaluate
+        self.equalities = [(p.dataname, v) for (p, v) in query.equalities()]
+        self.members = {}
+        self.pending = None  # Writes seen while loading the snapshot
+        self.active = False
+    
+    async def start(self, db: Database = None) -> "Subscription":
+        self.pending = []
+        self.active = True
+        self.live.add(self)
+        try:
+            objs = await self.query.all(db)
+        except:
+            self.cancel()
+            raise
+        for o in objs:
+            self.members[o.key] = o
+            self.live.add_member(self, o.key)
+        self.listener.snapshot(objs)
+        pending = self.pending
+        self.pending = None
+        for (obj, deleted) in pending:
+            self.seen(obj, deleted)
+        return self
+    
+    def seen(self, obj: Entity, deleted: bool = False):
+        """Handle a write of `obj` that may concern this query."""
+        if not self.active:
+            return
+        if self.pending is not None:
+            self.pending.append((obj, deleted))
+            return
+        key = obj.key
+        was = key in self.members
+        now = (not deleted) and self.predicate(obj)
+        if now:
+            if was:
+                self.listener.changed(obj)
+            else:
+                self.members[key] = obj
+                self.live.add_member(self, key)
+                self.listener.added(obj)
+        elif was:
+            del self.members[key]
+            self.live.remove_member(self, key)
+            self.listener.removed(obj)
+    
+    def cancel(self):
+        """Stop following the query."""
+        if self.active:
+            self.active = False
+            self.live.remove(self)
+            for key in self.members:
+                self.live.remove_member(self, key)
+            self.members = {}
+
+
+class LiveQueries:
+    """The subscriptions (see `Select.subscribe`) of one Entity class. They are indexed by
+    one of their `property = value` conditions, so a write only checks the subscriptions whose
+    condition holds for the object, the ones the object already belongs to and the ones without
+    such a condition.
+    """
+    
+    def __init__(self):
+        self.by_value = {}  # (dataname, value) -> set of subscriptions
+        self.indexed = {}  # dataname -> number of subscriptions indexed by it
+        self.scan = set()  # Subscriptions without an equality condition
+        self.by_member = {}  # key -> set of subscriptions with that object in their results
+    
+    @staticmethod
+    def index_entry(sub: Subscription):
+        for (name, value) in sub.equalities:
+            try:
+                hash(value)
+            except TypeError:
+                continue
+            return (name, value)
+        return None
+    
+    def add(self, sub: Subscription):
+        entry = self.index_entry(sub)
+        if entry is None:
+            self.scan.add(sub)
+        else:
+            self.by_value.setdefault(entry, set()).add(sub)
+            self.indexed[entry[0]] = self.indexed.get(entry[0], 0) + 1
+    
+    def remove(self, sub: Subscription):
+        entry = self.index_entry(sub)
+        if entry is None:
+            self.scan.discard(sub)
+            return
+        subs = self.by_value[entry]
+        subs.discard(sub)
+        if len(subs) == 0:
+            del self.by_value[entry]
+        self.indexed[entry[0]] -= 1
+        if self.indexed[entry[0]] == 0:
+            del self.indexed[entry[0]]
+    
+    def add_member(self, sub: Subscription, key):
+        self.by_member.setdefault(key, set()).add(sub)
+    
+    def remove_member(self, sub: Subscription, key):
+        subs = self.by_member.get(key)
+        if subs is not None:
+            subs.discard(sub)
+            if len(subs) == 0:
+                del self.by_member[key]
+    
+    def candidates(self, obj: Entity) -> set:
+        subs = set(self.scan)
+        for name in self.indexed:
+            try:
+                subs.update(self.by_value.get((name, obj.__dict__[name]), ()))
+            except TypeError:  # Unhashable value
+                pass
+        subs.update(self.by_member.get(obj.key, ()))
+        return subs
+    
+    def written(self, obj: Entity):
+        for sub in self.candidates(obj):
+            sub.seen(obj)
+    
+    def deleted(self, obj: Entity):
+        for sub in self.candidates(obj):
+            sub.seen(obj, deleted=True)
@@ -1,10 +1,12 @@
 
 import json
+import re
 from collections import OrderedDict
 
 from .util import *
 from .sql import *
 from .entity import *
+from .schema import *
 
 # Helpers
 # =======
@@ -17,6 +19,129 @@ def indent(s, i=4, code=True):
 def inline(s):
     return "``" + str(s) + "``"
 
+_field_re = re.compile(r"%\(([^)]*)\)s")
+_explainable = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "VALUES")
+
+def example_data(stat: Sql, codecs: CodecRegistry = None) -> dict:
+    """Return the data of `stat`, completed with representative values for every `Field` that
+    has not been filled in yet. Fields are matched to the properties of `stat.cls` by name, and
+    the values are encoded with `codecs` (if given).
+    """
+    
+    codecs = codecs or CodecRegistry()
+    data = dict(stat.data)
+    cls = stat.cls
+    props = {p.name: p for p in cls._props} if cls is not None else {}
+    for name in _field_re.findall(str(stat)):
+        if name in data:
+            continue
+        if name in props:
+            p = props[name]
+            data[name] = codecs.encode(p.type, p.type.example())
+        elif name == "key" and cls is not None:
+            key = tuple([codecs.encode(p.type, p.type.example()) for p in cls.key.referencing_props()])
+            data[name] = key[0] if len(key) == 1 else key
+        else:
+            data[name] = None
+    return data
+
+def plan_shape(node: dict) -> str:
+    """Summarize an EXPLAIN plan node (and its children) as a string like
+    ``Limit(Seq Scan[table_user])``.
+    """
+    
+    s = node["Node Type"]
+    if "Relation Name" in node:
+        s += "[" + node["Relation Name"] + "]"
+    if "Index Name" in node:
+        s += "{" + node["Index Name"] + "}"
+    children = node.get("Plans", [])
+    if len(children) > 0:
+        s += "(" + ", ".join([plan_shape(c) for c in children]) + ")"
+    return s
+
+def plan_nodes(node: dict):
+    yield node
+    for c in node.get("Plans", []):
+        yield from plan_nodes(c)
+
+def compare_plan_catalogs(old: dict, new: dict, cost_factor: float = 1.5) -> list:
+    """Compare two catalogs made by `SparrowModel.explain_all` (for example of two releases).
+    Returns a list of human readable differences: changed plan shapes, costs that grew by more
+    than `cost_factor`, and new sequential scans on large tables.
+    """
+    
+    diffs = []
+    old_stats = old["statements"]
+    for (sql, n) in new["statements"].items():
+        o = old_stats.get(sql)
+        if o is None:
+            diffs.append("New statement: " + sql)
+            continue
+        if "error" in n or "error" in o:
+            if n.get("error") != o.get("error"):
+                diffs.append("EXPLAIN error changed for {}: {} -> {}".format(sql, o.get("error"), n.get("error")))
+            continue
+        if o["plan"] != n["plan"]:
+            diffs.append("Plan changed for {}: {} -> {}".format(sql, o["plan"], n["plan"]))
+        if o["total_cost"] > 0 and n["total_cost"] > o["total_cost"] * cost_factor:
+            diffs.append("Cost of {} grew from {} to {}".format(sql, o["total_cost"], n["total_cost"]))
+        for tname in set(n["large_seq_scans"]) - set(o["large_seq_scans"]):
+            diffs.append("New sequential scan on large table {} in {}".format(tname, sql))
+    for sql in old_stats.keys() - new["statements"].keys():
+        diffs.append("Removed statement: " + sql)
+    return diffs
+
+def index_columns(indexdef: str) -> list:
+    """Returns the (lowercase) columns of an index definition as found in ``pg_indexes``.
+    Expressions are returned as they are.
+    """
+    
+    start = indexdef.index("(", indexdef.index(" USING "))
+    cols = []
+    depth = 0
+    current = ""
+    for ch in indexdef[start+1:]:
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            if depth == 0:
+                break
+            depth -= 1
+        elif ch == "," and depth == 0:
+            cols.append(current)
+            current = ""
+            continue
+        current += ch
+    cols.append(current)
+    return [c.strip().split(" ")[0].strip('"').lower() for c in cols]
+
+_equality_ops = ("=", "IN", "= ANY", "IS")
+_order_ops = ("ASC", "DESC")
+
+def suggested_index(columns: list) -> tuple:
+    """Given the `(column name, operator)` tuples of a query on one table, returns the columns of
+    an index for it: first the columns compared by equality, then the ranges, then the ordering.
+    """
+    
+    eq, rng, order = [], [], []
+    for (name, op) in columns:
+        op = (op or "").strip().upper()
+        l = eq if op in _equality_ops else order if op in _order_ops else rng
+        if name not in eq + rng + order:
+            l.append(name)
+    return tuple(eq + rng + order), len(eq)
+
+def index_covers(existing: list, columns: tuple, n_eq: int) -> bool:
+    """Whether an existing index (with columns `existing`) serves a query that would like an index
+    on `columns`, where the first `n_eq` columns are compared by equality.
+    """
+    
+    if n_eq > 0:
+        return len(existing) >= n_eq and set(existing[:n_eq]) == set(columns[:n_eq])
+    return len(existing) > 0 and existing[0] == columns[0]
+
+
 # Central class
 # =============
 
@@ -52,28 +177,205 @@ class SparrowModel:
         for e in cls._enums:
             yield e._create_type_command
         yield cls._create_table_command
+        yield from [command for (name, command) in cls._create_partition_commands()]
+        yield from cls._create_index_commands
+        yield from cls._drop_index_commands
         yield cls._drop_table_command
         yield cls._insert_command
         yield cls._update_command
         yield cls._delete_command
         yield cls._find_by_key_query
     
-    async def install(self):
-        """Set up database, only once for each "install" of the model"""
+    def stats(self) -> list:
+        """Return the statistics of all executed statements (see `QueryStats.report`)."""
+        return self.db.stats.report()
+    
+    def slow_queries(self) -> list:
+        """Return the most recent entries of the slow query log (see `SlowQuery`)."""
+        return list(self.db.stats.slow_queries)
+    
+    def reset_stats(self):
+        self.db.stats.reset()
+    
+    def class_profile(self) -> list:
+        """Report how long it took to prepare each class: `define_time` is spent in the metaclass
+        (at import), `statements_time` building its statements (on first use, see
+        `LazyStatement`). The slowest classes come first.
+        """
+        
+        l = []
         for c in self.classes:
+            l.append(OrderedDict([
+                ("class", c.__name__),
+                ("define_time", c._define_time),
+                ("statements_time", c._statements_time),
+                ("statements_built", sum(1 for k in lazy_statements if not isinstance(c.__dict__.get(k), LazyStatement))),
+            ]))
+        return sorted(l, key=lambda d: d["define_time"] + d["statements_time"], reverse=True)
+    
+    async def index_report(self, db: Database = None) -> list:
+        """Suggest indexes, based on the conditions and orderings of the queries executed so far
+        on `db` (see `QueryStats`). The suggestions are cross-checked with the indexes that
+        already exist in ``pg_indexes``. Returns a list of dictionaries, the most time
+        consuming first::
+        
+            [{"class": "Message", "table": "table_Message", "columns": ["to_UID", "sent"],
+              "count": 1520, "total_time": 12.3, "shapes": ["SELECT ..."],
+              "sql": "CREATE INDEX ON table_Message (to_UID, sent)"}, ...]
+        """
+        
+        if db is None:
+            db = self.db
+        
+        existing = {}
+        for (tname, indexdef) in await RawSql(
+                "SELECT tablename, indexdef FROM pg_indexes WHERE schemaname = current_schema()").raw_all(db):
+            existing.setdefault(tname.lower(), []).append(index_columns(indexdef))
+        
+        tables = {c._table_name: c for c in self.classes}
+        suggestions = OrderedDict()
+        for st in db.stats.statements.values():
+            per_table = OrderedDict()
+            for (tname, name, op) in st.columns:
+                if tname in tables:
+                    per_table.setdefault(tname, []).append((name, op))
+            for (tname, cols) in per_table.items():
+                columns, n_eq = suggested_index(cols)
+                lower = tuple([c.lower() for c in columns])
+                if any(index_covers(e, lower, n_eq) for e in existing.get(tname.lower(), [])):
+                    continue
+                try:
+                    sug = suggestions[(tname, columns)]
+                except KeyError:
+                    sug = suggestions[(tname, columns)] = OrderedDict([
+                        ("class", tables[tname].__name__),
+                        ("table", tname),
+                        ("columns", list(columns)),
+                        ("count", 0),
+                        ("total_time", 0.0),
+                        ("shapes", []),
+                        ("sql", "CREATE INDEX ON {} ({})".format(tname, ", ".join(columns))),
+                    ])
+                sug["count"] += st.count
+                sug["total_time"] += st.total_time
+                sug["shapes"].append(st.shape)
+        return sorted(suggestions.values(), key=lambda s: s["total_time"], reverse=True)
+    
+    async def install(self):
+        """Set up database, only once for each "install" of the model. See `sync_schema` for
+        a version that can be run every time.
+        """
+        classes = sort_classes(self.classes)
+        for c in classes:
             for e in c._enums:
                 await e._create_type_command.exec(self.db)
             await c._create_table_command.exec(self.db)
+            for (name, command) in c._create_partition_commands():
+                await command.exec(self.db)
+        for c in classes:
+            for i in c._create_index_commands:
+                await i.exec(self.db)
+    
+    async def sync_schema(self, db: Database = None, dry_run: bool = False) -> list:
+        """Create the types, tables, columns and indexes that are missing in the database, in
+        one transaction (new enum values are added just before it). Never drops anything. Returns the applied `SchemaChange`s (or with
+        `dry_run`, the changes that would be applied without applying them). Only works with
+        Postgres.
+        """
+        return await sync_schema(db if db is not None else self.db, self.classes, dry_run)
             
+    async def maintain_partitions(self, db: Database = None, drop: bool = False) -> list:
+        """Create the upcoming partitions of the classes partitioned by time, and detach (or
+        drop) the expired ones. See `maintain_partitions`, run it every day or so.
+        """
+        return await maintain_partitions(db if db is not None else self.db, self.classes, drop=drop)
+    
+    async def flush_writes(self):
+        """Write all changes waiting in a `WriteBehind` or `WriteBuffer` now. Call this at
+        shutdown.
+        """
+        for c in self.classes:
+            if c._write_behind is not None:
+                await c._write_behind.flush()
+            if c._write_buffer is not None:
+                await c._write_buffer.flush()
+    
+    async def warm_caches(self, db: Database = None):
+        """Load all objects of the fully cached classes (see `FullCache`), so queries on them
+        are answered from memory. Call this at startup.
+        """
+        for c in self.classes:
+            if c._full_cache is not None:
+                await c._full_cache.load(db if db is not None else self.db)
+    
     async def uninstall(self):
         """Very brutal operation, drops all tables."""
-        for c in self.classes:
+        for c in reversed(sort_classes(self.classes)):
+            if c._full_cache is not None:
+                c._full_cache.clear()
+            for i in c._drop_index_commands:
+                await i.exec(self.db)
             await c._drop_table_command.exec(self.db)
             for e in c._enums:
                 await e._drop_type_command.exec(self.db)
         
-    def sql_info(self):
-        """Print all SQL statements (as organized as possible)."""
+    async def explain_all(self, db: Database = None, large_table_rows: int = 10000) -> dict:
+        """Run ``EXPLAIN (FORMAT JSON)`` on every statement of `all_sql_statements` (except DDL),
+        with representative data (see `example_data`). Returns a catalog that can be saved as
+        JSON and compared with `compare_plan_catalogs`. Statements are keyed by their shape (see
+        `normalize_sql`). Sequential scans on tables with at least
+        `large_table_rows` (estimated) rows are flagged.
+        
+        The catalog looks like this::
+        
+            {"statements": {
+                "SELECT ... WHERE (table_User.UID = ?)": {
+                    "class": "User",
+                    "plan": "Index Scan[table_user]{table_user_pkey}",
+                    "startup_cost": 0.15, "total_cost": 8.17, "plan_rows": 1,
+                    "seq_scans": [], "large_seq_scans": [],
+                }, ...
+            }}
+        """
+        
+        if db is None:
+            db = self.db
+        
+        sizes = {}
+        for (relname, reltuples) in await RawSql(
+                "SELECT relname, reltuples FROM pg_class WHERE relkind IN ('r', 'p')").raw_all(db):
+            sizes[relname] = reltuples
+        
+        statements = OrderedDict()
+        for stat in self.all_sql_statements():
+            text = str(stat)
+            shape = normalize_sql(text)
+            if text.lstrip().split(" ", 1)[0].upper() not in _explainable or shape in statements:
+                continue
+            entry = OrderedDict([("class", stat.cls.__name__ if stat.cls is not None else None)])
+            try:
+                (plans,) = await RawSql("EXPLAIN (FORMAT JSON) " + text, example_data(stat, db.codecs)).raw(db)
+            except SqlError as e:
+                entry["error"] = str(e.err)
+                statements[shape] = entry
+                continue
+            if isinstance(plans, str):
+                plans = json.loads(plans)
+            plan = plans[0]["Plan"]
+            seq_scans = [n["Relation Name"] for n in plan_nodes(plan) if n["Node Type"] == "Seq Scan"]
+            entry["plan"] = plan_shape(plan)
+            entry["startup_cost"] = plan["Startup Cost"]
+            entry["total_cost"] = plan["Total Cost"]
+            entry["plan_rows"] = plan["Plan Rows"]
+            entry["seq_scans"] = seq_scans
+            entry["large_seq_scans"] = [t for t in seq_scans if sizes.get(t, 0) >= large_table_rows]
+            statements[shape] = entry
+        return {"statements": statements}
+    
+    def sql_info(self, catalog: dict = None):
+        """Print all SQL statements (as organized as possible). If a `catalog` (made by
+        `explain_all`) is given, the plan of every statement is printed as well.
+        """
         print("\n")
         print("All (logged) SQL statements")
         print("===========================")
@@ -83,6 +385,15 @@ class SparrowModel:
             print("-"*len(s), end="\n\n")
             for s in self.sql_for_class(c):
                 print(str(s), end="\n\n")
+                if catalog is not None and normalize_sql(str(s)) in catalog["statements"]:
+                    entry = catalog["statements"][normalize_sql(str(s))]
+                    if "error" in entry:
+                        print("EXPLAIN failed: " + entry["error"], end="\n\n")
+                    else:
+                        print("Plan: {plan} (cost {total_cost}, rows {plan_rows})".format(**entry), end="")
+                        if len(entry["large_seq_scans"]) > 0:
+                            print(", SEQUENTIAL SCAN ON " + ", ".join(entry["large_seq_scans"]), end="")
+                        print(end="\n\n")
         
         # TODO more categorizing
         print("Uncategorized statements")
@@ -90,6 +401,17 @@ class SparrowModel:
         for s in self.sql_statements:
             print(str(s), end="\n\n")
     
+    def stats_info(self, amount=20):
+        """Print the statistics of the `amount` statement shapes that took the most time."""
+        print("\n")
+        print("Statement statistics")
+        print("====================")
+        for st in self.stats()[:amount]:
+            print("\n" + st["shape"])
+            print(("    class {class}, {count} executions, {errors} errors, {rows} rows, "
+                   + "{total_time:.3f} s in total, p50 {p50:.4f} s, p99 {p99:.4f} s").format(**st))
+        print("")
+    
     def json_info(self):
         """Print all JSON info (as organized as possible). Send this to frontend devs."""
         print("\n")
@@ -0,0 +1,203 @@
+
+import copy
+import datetime
+import re
+
+from .util import *
+
+
+# Helpers
+# =======
+
+def sql_literal(value) -> str:
+    """A constant in SQL, for the bounds of partitions."""
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+_interval_re = re.compile(r"^\s*(\d+)?\s*(day|week|month|year)s?\s*$", re.IGNORECASE)
+
+def parse_interval(interval: str) -> tuple:
+    """Parse an interval like ``"1 month"`` or ``"7 days"`` into `(number, unit)`."""
+    m = _interval_re.match(interval)
+    assert m is not None, "Can't partition by an interval of {!r}".format(interval)
+    return (int(m.group(1) or 1), m.group(2).lower())
+
+
+def as_date(now) -> datetime.date:
+    """The date of `now` (a date or datetime), today if it is `None`."""
+    if now is None:
+        return datetime.date.today()
+    return now.date() if isinstance(now, datetime.datetime) else now
+
+
+def add_months(d: datetime.date, months: int) -> datetime.date:
+    i = d.year * 12 + d.month - 1 + months
+    return datetime.date(i // 12, i % 12 + 1, 1)
+
+
+# Partitioning
+# ============
+
+class Partitioning:
+    """Base class of the ways to partition the table of an Entity class, see `RangePartition`,
+    `ListPartition` and `HashPartition`. Declare it as ``__partition__`` in the class.
+    """
+    
+    method = None
+    
+    def __init__(self, column):
+        self.column = column
+    
+    def for_class(self, copies: dict) -> "Partitioning":
+        """A copy for a class, using the copies of the properties of that class (see
+        `MetaEntity`).
+        """
+        p = copy.copy(self)
+        p.column = copies.get(id(self.column), self.column)
+        return p
+    
+    def partition_by_sql(self) -> str:
+        return "PARTITION BY {} ({})".format(self.method, self.column.name)
+    
+    def partitions(self, table: str, now: datetime.datetime = None) -> list:
+        """The partitions that should exist at `now`, as a list of `(name, bound)` where
+        `bound` is SQL like ``FOR VALUES IN (1, 2)``.
+        """
+        raise NotImplementedError
+    
+    def expired(self, table: str, names: list, now: datetime.datetime = None) -> list:
+        """The partitions (from `names`) that are too old to keep."""
+        return []
+
+
+class RangePartition(Partitioning):
+    """Partitions a table by periods of time (on a date or timestamp property)::
+    
+        class Event(Entity):
+            created = Property(datetime.datetime)
+            data = Property(Json)
+            eid = Property(int)
+            key = Key(eid, created)
+            
+            __partition__ = RangePartition(created, interval="1 month", premake=3, keep=12)
+    
+    The partitions are named after the table and the start of their period, like
+    ``table_Event_p20261001``.
+    
+    Parameters:
+        - `column`: The property to partition on. It must be part of the key.
+        - `interval`: The period of each partition, like ``"1 day"``, ``"1 week"``, ``"3 months"``
+          or ``"1 year"``.
+        - `premake`: The number of partitions to create ahead of the current one.
+        - `keep`: The number of partitions before the current one to keep, `None` to keep all of
+          them (see `maintain_partitions`).
+        - `default`: Also create a ``DEFAULT`` partition for rows outside all periods. Note that
+          Postgres can't create a partition while the default one holds rows for it.
+    """
+    
+    method = "RANGE"
+    
+    def __init__(self, column, interval: str = "1 month", premake: int = 3, keep: int = None, default: bool = False):
+        Partitioning.__init__(self, column)
+        (self.number, self.unit) = parse_interval(interval)
+        self.premake = premake
+        self.keep = keep
+        self.default = default
+    
+    def period_start(self, d: datetime.date) -> datetime.date:
+        """The start of the period that contains `d`."""
+        if self.unit == "month":
+            i = d.year * 12 + d.month - 1
+            i -= i % self.number
+            return datetime.date(i // 12, i % 12 + 1, 1)
+        if self.unit == "year":
+            return datetime.date(d.year - (d.year - 1) % self.number, 1, 1)
+        days = self.number * (7 if self.unit == "week" else 1)
+        # Day 1 (0001-01-01) is a Monday, so weeks start on Monday
+        return datetime.date.fromordinal(d.toordinal() - (d.toordinal() - 1) % days)
+    
+    def next_start(self, start: datetime.date, n: int = 1) -> datetime.date:
+        """The start of the `n`th period after the one starting at `start`."""
+        if self.unit == "month":
+            return add_months(start, self.number * n)
+        if self.unit == "year":
+            return datetime.date(start.year + self.number * n, 1, 1)
+        return start + datetime.timedelta(days=self.number * n * (7 if self.unit == "week" else 1))
+    
+    def partition_name(self, table: str, start: datetime.date) -> str:
+        return "{}_p{:%Y%m%d}".format(table, start)
+    
+    def partitions(self, table: str, now: datetime.datetime = None) -> list:
+        start = self.period_start(as_date(now))
+        l = []
+        for i in range(self.premake + 1):
+            (s, e) = (self.next_start(start, i), self.next_start(start, i + 1))
+            l.append((self.partition_name(table, s), "FOR VALUES FROM ('{}') TO ('{}')".format(s, e)))
+        if self.default:
+            l.append((table + "_default", "DEFAULT"))
+        return l
+    
+    def expired(self, table: str, names: list, now: datetime.datetime = None) -> list:
+        if self.keep is None:
+            return []
+        start = self.period_start(as_date(now))
+        oldest = self.partition_name(table, self.next_start(start, -self.keep)).lower()
+        prefix = (table + "_p").lower()
+        return [n for n in names if n.lower().startswith(prefix) and len(n) == len(oldest)
+                and n[len(prefix):].isdigit() and n.lower() < oldest]
+
+
+class ListPartition(Partitioning):
+    """Partitions a table by the value of a property::
+    
+        __partition__ = ListPartition(region, {"eu": ["be", "nl", "fr"], "us": ["us"]}, default=True)
+    
+    Parameters:
+        - `column`: The property to partition on. It must be part of the key.
+        - `values`: Dictionary from the suffix of the name of each partition (the partitions are
+          named like ``table_Event_eu``) to the list of values in it.
+        - `default`: Also create a ``DEFAULT`` partition for all other values.
+    """
+    
+    method = "LIST"
+    
+    def __init__(self, column, values: dict, default: bool = False):
+        Partitioning.__init__(self, column)
+        self.values = values
+        self.default = default
+    
+    def partitions(self, table: str, now: datetime.datetime = None) -> list:
+        l = [("{}_{}".format(table, suffix), "FOR VALUES IN ({})".format(", ".join([sql_literal(v) for v in values])))
+             for (suffix, values) in sorted(self.values.items())]
+        if self.default:
+            l.append((table + "_default", "DEFAULT"))
+        return l
+
+
+class HashPartition(Partitioning):
+    """Spreads the rows of a table evenly over a fixed number of partitions, by the hash of a
+    property::
+    
+        __partition__ = HashPartition(uid, 16)
+    
+    Parameters:
+        - `column`: The property to partition on. It must be part of the key.
+        - `modulus`: The number of partitions, named like ``table_Event_h0``.
+    """
+    
+    method = "HASH"
+    
+    def __init__(self, column, modulus: int):
+        Partitioning.__init__(self, column)
+        assert modulus >= 1
+        self.modulus = modulus
+    
+    def partitions(self, table: str, now: datetime.datetime = None) -> list:
+        return [("{}_h{}".format(table, i), "FOR VALUES WITH (MODULUS {}, REMAINDER {})".format(self.modulus, i))
+                for i in range(self.modulus)]
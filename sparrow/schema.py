@@ -0,0 +1,232 @@
+
+import datetime
+import zlib
+from collections import OrderedDict
+
+from .util import *
+from .sql import *
+from .entity import *
+
+
+# Helpers
+# =======
+
+def sort_classes(classes: list) -> list:
+    """Sort `classes` so that every class comes after the classes it refers to (as far as those
+    are in `classes`). Classes that refer to each other in a cycle keep their original order.
+    """
+    
+    remaining = list(classes)
+    result = []
+    while len(remaining) > 0:
+        for c in remaining:
+            if all(r.ref is c or r.ref not in remaining for r in c._refs):
+                break
+        else:
+            c = remaining[0]  # A cycle
+        remaining.remove(c)
+        result.append(c)
+    return result
+
+
+sync_lock_key = zlib.crc32(b"sparrow.sync_schema")
+"""Key of the advisory lock taken by `sync_schema`, so concurrent syncs wait for each other."""
+
+
+# Schema
+# ======
+
+class ExistingSchema:
+    """The parts of the schema in the database that sparrow knows about. All names are in
+    lowercase (as Postgres stores unquoted identifiers).
+    
+    Parameters:
+        - `enums`: Dictionary from the name of an enum type to the list of its values.
+        - `columns`: Dictionary from the name of a table to the set of its columns.
+        - `indexes`: Set of the names of all indexes.
+    """
+    
+    def __init__(self, enums: dict, columns: dict, indexes: set):
+        self.enums = enums
+        self.columns = columns
+        self.indexes = indexes
+
+
+async def read_schema(db: Database) -> ExistingSchema:
+    """Read the enum types, tables, columns and indexes in the current schema of `db` (from
+    ``pg_catalog`` and ``information_schema``).
+    """
+    
+    enums = OrderedDict()
+    for (name, value) in await RawSql(
+            "SELECT t.typname, e.enumlabel FROM pg_type t JOIN pg_enum e ON e.enumtypid = t.oid "
+            + "JOIN pg_namespace n ON n.oid = t.typnamespace WHERE n.nspname = current_schema() "
+            + "ORDER BY t.typname, e.enumsortorder").raw_all(db):
+        enums.setdefault(name.lower(), []).append(value)
+    columns = {}
+    for (table, column) in await RawSql(
+            "SELECT table_name, column_name FROM information_schema.columns "
+            + "WHERE table_schema = current_schema()").raw_all(db):
+        columns.setdefault(table.lower(), set()).add(column.lower())
+    indexes = set()
+    for (name,) in await RawSql(
+            "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema()").raw_all(db):
+        indexes.add(name.lower())
+    return ExistingSchema(enums, columns, indexes)
+
+
+class SchemaChange:
+    """A statement that brings the database closer to the model, with a description for
+    humans. Changes with `in_transaction` set to `False` run on their own, outside the
+    transaction of `sync_schema`.
+    """
+    
+    def __init__(self, description: str, statement: Sql, in_transaction: bool = True):
+        self.description = description
+        self.statement = statement
+        self.in_transaction = in_transaction
+    
+    def __str__(self):
+        return self.description
+
+
+def plan_schema(classes: list, existing: ExistingSchema, now: datetime.datetime = None) -> list:
+    """Work out the `SchemaChange`s needed to create the types, tables, columns and indexes of
+    `classes` that are not in `existing`, in an order that respects their dependencies.
+    Nothing is ever dropped or changed, so data is never lost. New partitioned tables get the
+    partitions that should exist at `now` (see `Partitioning.partitions`).
+    
+    Columns added to an existing table are nullable: the rows already in the table have no value
+    for them.
+    """
+    
+    changes = []
+    ordered = sort_classes(classes)
+    
+    done_enums = set()
+    for c in ordered:
+        for e in c._enums:
+            name = e.name.lower()
+            if name in done_enums:
+                continue
+            done_enums.add(name)
+            if name not in existing.enums:
+                changes.append(SchemaChange("Create type " + e.name, e._create_type_command))
+            else:
+                for (i, o) in enumerate(e.options):
+                    if str(o) not in existing.enums[name]:
+                        # At the same position as in the model, which is how Postgres orders
+                        # the values (see `operand_ordering`). The previous value exists by now.
+                        if i > 0:
+                            where = "AFTER " + sql_literal(str(e.options[i - 1]))
+                        else:
+                            where = "BEFORE " + sql_literal(existing.enums[name][0])
+                        # Before Postgres 12, ALTER TYPE ... ADD VALUE can't run in a transaction
+                        # (and from 12 on, the value can't be used in the same transaction)
+                        changes.append(SchemaChange("Add value {} to type {}".format(o, e.name), RawSql(
+                            "ALTER TYPE {} ADD VALUE IF NOT EXISTS {} {}".format(e.name, sql_literal(str(o)), where)),
+                            in_transaction=False))
+    
+    for c in ordered:
+        table = c._table_name.lower()
+        if table not in existing.columns:
+            changes.append(SchemaChange("Create table " + c._table_name, c._create_table_command))
+            for (name, command) in c._create_partition_commands(now):
+                changes.append(SchemaChange("Create partition " + name, command))
+            continue
+        have = existing.columns[table]
+        missing = set()
+        for p in c._props:
+            if p.name.lower() not in have:
+                missing.add(p.name)
+                type_sql = p.type.sql_type + (" " + p.sql_extra if p.sql_extra != "" else "")
+                changes.append(SchemaChange("Add column {}.{}".format(c._table_name, p.name), RawSql(
+                    "ALTER TABLE {} ADD COLUMN {} {}".format(c._table_name, p.name, type_sql))))
+        for r in c._refs:
+            if any(p.name in missing for p in r.props):
+                changes.append(SchemaChange("Add reference {}.{}".format(c._table_name, r.name), RawSql(
+                    "ALTER TABLE {} ADD {}".format(c._table_name, r.sql_constraint().strip()))))
+    
+    for c in ordered:
+        for (i, command) in zip(c._indexes, c._create_index_commands):
+            if i.name.lower() not in existing.indexes:
+                changes.append(SchemaChange("Create index " + i.name, command))
+    
+    return changes
+
+
+async def sync_schema(db: Database, classes: list, dry_run: bool = False) -> list:
+    """Create everything of `classes` that is missing in the database (see `plan_schema`), in
+    a single transaction. Running it again changes nothing. Returns the list of `SchemaChange`s
+    that were applied, or with `dry_run` only the ones that would be applied.
+    
+    New values of existing enum types are added first, each in a statement of its own (see
+    `SchemaChange.in_transaction`): Postgres can't add them in a transaction before version 12,
+    and can't use them in the same transaction from then on. If the transaction fails, those
+    values stay.
+    
+    Concurrent syncs (e.g. of several servers starting at once) wait for each other.
+    """
+    
+    planned = plan_schema(classes, await read_schema(db))
+    if dry_run:
+        return planned
+    
+    changes = [ch for ch in planned if not ch.in_transaction]
+    for ch in changes:
+        await ch.statement.exec(db)
+    async with db.transaction() as t:
+        await RawSql("SELECT pg_advisory_xact_lock(%(key)s)", {"key": sync_lock_key}).exec(t)
+        for ch in plan_schema(classes, await read_schema(t)):
+            if ch.in_transaction:
+                await ch.statement.exec(t)
+                changes.append(ch)
+    return changes
+
+
+# Partitions
+# ==========
+
+async def read_partitions(db: Database, table: str) -> list:
+    """The names (in lowercase) of the partitions of `table`."""
+    return [name for (name,) in await RawSql(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        + "JOIN pg_class p ON p.oid = i.inhparent JOIN pg_namespace n ON n.oid = p.relnamespace "
+        + "WHERE p.relname = %(table)s AND n.nspname = current_schema()", {"table": table.lower()}).raw_all(db)]
+
+
+def plan_partitions(cls, existing: list, now: datetime.datetime = None, drop: bool = False) -> list:
+    """The `SchemaChange`s of `maintain_partitions` for the partitioned class `cls`, given the
+    names (in lowercase) of its `existing` partitions.
+    """
+    
+    changes = []
+    for (name, command) in cls._create_partition_commands(now):
+        if name.lower() not in existing:
+            changes.append(SchemaChange("Create partition " + name, command))
+    for name in cls._partitioning.expired(cls._table_name, existing, now):
+        if drop:
+            changes.append(SchemaChange("Drop partition " + name, RawSql("DROP TABLE " + name)))
+        else:
+            changes.append(SchemaChange("Detach partition " + name, RawSql(
+                "ALTER TABLE {} DETACH PARTITION {}".format(cls._table_name, name))))
+    return changes
+
+
+async def maintain_partitions(db: Database, classes: list, now: datetime.datetime = None,
+                              drop: bool = False, dry_run: bool = False) -> list:
+    """Keep the partitions (see `Partitioning`) of `classes` up to date: create the partitions
+    that should exist at `now` (for a `RangePartition`, the current period and the next
+    ``premake`` ones), and detach the partitions older than ``keep`` periods. Detached
+    partitions are normal tables that can still be archived; with `drop` they are dropped.
+    Returns the list of `SchemaChange`s (with `dry_run`, without applying them).
+    """
+    
+    changes = []
+    for c in classes:
+        if c._partitioning is not None:
+            changes.extend(plan_partitions(c, await read_partitions(db, c._table_name), now, drop))
+    if not dry_run:
+        for ch in changes:
+            await ch.statement.exec(db)
+    return changes
@@ -0,0 +1,249 @@
+
+import asyncio
+import re
+import hashlib
+
+from .util import *
+from .sql import *
+
+
+# Exceptions
+# ==========
+
+class ShardingError(Error):
+    """Raised for statements a `ShardedDatabase` can't execute, like a write to a sharded class
+    without its key, or aggregates over all shards.
+    """
+
+
+# Helpers
+# =======
+
+def md5_shard(key, n: int) -> int:
+    """The default shard function: the MD5 of the `repr` of the key, modulo the number of
+    shards. Stable between processes (unlike `hash`). A CRC is not good enough here: keys
+    that differ in a single character often get the same CRC modulo a power of two.
+    """
+    return int.from_bytes(hashlib.md5(repr(key).encode()).digest()[:8], "big") % n
+
+
+_ddl_re = re.compile(r"^\s*(CREATE|DROP|ALTER)\b", re.IGNORECASE)
+
+
+def statement_query(statement: "Sql") -> "Sql":
+    """The statement `statement` was compiled from (see `Sql.to_raw`), or itself."""
+    return getattr(statement, "source", None) or statement
+
+
+def statement_class(statement: "Sql"):
+    """The Entity class `statement` is about, or `None`."""
+    query = statement_query(statement)
+    for s in (statement, query, getattr(query, "select", None)):
+        cls = getattr(s, "cls", None)
+        if cls is not None:
+            return cls
+    return None
+
+
+def skip_first_line(write):
+    """Wrap the coroutine `write` so the first line (a CSV header) is dropped."""
+    skipping = [True]
+    
+    async def _write(chunk):
+        if skipping[0]:
+            i = chunk.find(b"\n")
+            if i < 0:
+                return
+            skipping[0] = False
+            chunk = chunk[i + 1:]
+        if len(chunk) > 0:
+            await write(chunk)
+    return _write
+
+
+# Sharded database
+# ================
+
+class ShardTransaction(Transaction):
+    """A `Transaction` on one shard of a `ShardedDatabase` (see `ShardedDatabase.transaction`).
+    Every statement is routed like outside the transaction, and must end up on this shard.
+    """
+    
+    def __init__(self, sharded: "ShardedDatabase", shard: Database):
+        Transaction.__init__(self, shard)
+        self.sharded = sharded
+    
+    async def get_cursor(self, statement: "Sql", unsafe_dict: dict):
+        shards = self.sharded.targets(statement, unsafe_dict)
+        if len(shards) != 1 or shards[0] is not self.db:
+            raise ShardingError("Statement for another shard in a transaction: " + str(statement))
+        return await Transaction.get_cursor(self, statement, unsafe_dict)
+
+
+class ShardedDatabase:
+    """Spreads the objects of some Entity classes over a number of databases (*shards*), based
+    on their key. Use it wherever you would use a `Database`::
+    
+        db = ShardedDatabase([Database(None, "app", host=h, backend=AsyncpgBackend()) for h in hosts],
+                             sharded_classes=[Message])
+    
+    Statements are routed like this:
+        
+        - Inserts, updates and deletes of sharded classes, `Entity.find_by_key` and queries with
+          the key in their conditions (like ``Message.MID == Unsafe(mid)``) go to the shard of
+          the key. Writes without a key (e.g. an insert with a `KeyProperty`, whose value is only
+          known after the insert) raise a `ShardingError`: use keys made by the application.
+        - Other queries on sharded classes go to all shards at once. The results are merged,
+          respecting the ordering, offset and limit of a `Select`. `Select.count` and
+          `Select.exists` work, other aggregates don't. `Select.export` exports the shards one
+          after the other (only in CSV or NDJSON, without limit or offset).
+        - ``CREATE``, ``DROP`` and ``ALTER`` statements go to all shards, so
+          `SparrowModel.install` creates the schema everywhere.
+        - Everything else (including the classes that are not sharded) goes to the first shard.
+    
+    Joins only work between objects on the same shard. A transaction (see `transaction`) runs
+    on a single shard, and refuses statements for other shards (including reads of all shards).
+    
+    Parameters:
+        - `shards`: The `Database` of every shard (with the same backend). The number of
+          shards can't change without moving data.
+        - `shard_fn`: Function `(key, number of shards)` that returns the index of the shard for
+          a key, by default `md5_shard`.
+        - `sharded_classes`: The sharded Entity classes, by default all of them.
+    """
+    
+    def __init__(self, shards: list, shard_fn=None, sharded_classes=None):
+        assert len(shards) >= 1
+        self.shards = shards
+        self.shard_fn = shard_fn if shard_fn is not None else md5_shard
+        self.sharded_classes = set(sharded_classes) if sharded_classes is not None else None
+        self.backend = shards[0].backend
+        self.errors = shards[0].errors
+        self.codecs = shards[0].codecs
+        self.stats = shards[0].stats
+        for s in shards:
+            s.stats = self.stats  # One QueryStats for all shards
+    
+    def is_sharded(self, cls) -> bool:
+        return cls is not None and (self.sharded_classes is None or cls in self.sharded_classes)
+    
+    def shard_for(self, cls, key) -> Database:
+        """The `Database` that holds the object of `cls` with the given key."""
+        if not self.is_sharded(cls):
+            return self.shards[0]
+        return self.shards[self.shard_fn(key, len(self.shards))]
+    
+    def routing_key(self, cls, statement: "Sql", data: dict):
+        """The key that `statement` (about `cls`) is limited to, or `None`. Always the key as
+        in Python (like `Entity.key`), never the parameters sent to the database, which may
+        be encoded (see `CodecRegistry`).
+        """
+        query = statement_query(statement)
+        for s in (statement, query):
+            if s.object_key is not None:
+                return s.object_key  # Writes of an object and `Entity.find_by_key`
+        if not isinstance(query, Select):
+            return None
+        names = [p.name for p in cls.key.referencing_props()]
+        eqs = {p.name: v for (p, v) in query.equalities()}
+        if not all(n in eqs for n in names):
+            return None
+        values = [eqs[n] for n in names]
+        return values[0] if len(values) == 1 else tuple(values)
+    
+    def session(self):
+        return DatabaseSession(self)
+    
+    def transaction(self, cls=None, key=None):
+        """A `ShardTransaction` on the shard of the object of `cls` with the given key (or on
+        the first shard). Statements for other shards raise a `ShardingError`.
+        """
+        return ShardTransaction(self, self.shard_for(cls, key) if cls is not None else self.shards[0])
+    
+    def targets(self, statement: "Sql", data: dict) -> list:
+        """The shards `statement` has to be executed on."""
+        text = str(statement)
+        if _ddl_re.match(text):
+            return self.shards
+        cls = statement_class(statement)
+        if not self.is_sharded(cls):
+            return self.shards[:1]
+        key = self.routing_key(cls, statement, data)
+        if key is not None:
+            return [self.shard_for(cls, key)]
+        if not getattr(statement, "read_only", False):
+            raise ShardingError("Can't route this statement on {} without its key: {}".format(cls.__name__, text))
+        return self.shards
+    
+    async def get_cursor(self, statement: "Sql", unsafe_dict: dict, session: "DatabaseSession" = None):
+        shards = self.targets(statement, unsafe_dict)
+        if len(shards) == 1:
+            return await shards[0].get_cursor(statement, unsafe_dict, session)
+        if _ddl_re.match(str(statement)):
+            cursors = [await s.get_cursor(statement, unsafe_dict, session) for s in shards]
+            return cursors[0]
+        return await self.fan_out(statement, unsafe_dict, session)
+    
+    async def fan_out(self, statement: "Sql", data: dict, session: "DatabaseSession" = None):
+        """Execute a read on all shards and merge the results."""
+        query = statement_query(statement)
+        text = str(statement)
+        if text.startswith("SELECT COUNT(*) FROM ") and not text.startswith("SELECT COUNT(*) FROM ("):
+            cursors = await self.gather(statement, data, session)
+            return RowCursor([(sum([c.fetchone()[0] for c in cursors]),)])
+        if text.startswith("SELECT EXISTS("):
+            cursors = await self.gather(statement, data, session)
+            return RowCursor([(any([c.fetchone()[0] for c in cursors]),)])
+        if isinstance(query, AggregateQuery) or text.startswith("SELECT COUNT(*)"):
+            raise ShardingError("Aggregates over all shards are not supported: " + text)
+        if not (isinstance(query, Select) and isinstance(statement, ClassedSql)):
+            # Some other read (e.g. raw SQL of the class): concatenate
+            cursors = await self.gather(statement, data, session)
+            return RowCursor([r for c in cursors for r in c.fetchall()])
+        
+        offset = query._offset if query._offset is not None else 0
+        limit = query._limit
+        if not isinstance(offset, int) or not (limit is None or isinstance(limit, int)):
+            raise ShardingError("Only constant limits and offsets work over all shards: " + text)
+        shard_statement = statement
+        if offset > 0:
+            # Every shard has to give its first offset + limit results
+            q = query.copy()
+            q._offset = None
+            q._limit = None if limit is None else offset + limit
+            shard_statement = RawClassedSql(query.cls, str(q), data, read_only=True)
+            shard_statement.source = query
+        cursors = await self.gather(shard_statement, data, session)
+        rows = [r for c in cursors for r in c.fetchall()]
+        
+        order = query._keyset
+        if order is None and query._order is not None:
+            order = operand_columns(query._order, None)
+        if order is not None:
+            columns = query.cls._select_columns
+            for (p, op) in reversed(order):
+                if p.name not in columns or getattr(p, "cls", query.cls) is not query.cls:
+                    raise ShardingError("Can't merge the results of all shards on " + str(p))
+                i = columns.index(p.name)
+                # Stable sorts, from the last column to the first. NULL is larger than any value.
+                rows.sort(key=lambda r: (r[i] is None, r[i]), reverse=op == "DESC")
+        if offset > 0 or limit is not None:
+            rows = rows[offset:None if limit is None else offset + limit]
+        return RowCursor(rows)
+    
+    async def gather(self, statement: "Sql", data: dict, session: "DatabaseSession" = None) -> list:
+        return await asyncio.gather(*[s.get_cursor(statement, data, session) for s in self.shards])
+    
+    async def copy_out(self, statement: "Sql", format: str, write, columns: list, session: "DatabaseSession" = None):
+        # See Select.export. Over all shards, the shards are exported one after the other (so
+        # the results are only ordered per shard).
+        shards = self.targets(statement, statement.data)
+        if len(shards) > 1:
+            query = statement_query(statement)
+            if format == "binary":
+                raise ShardingError("Binary exports over all shards are not supported")
+            if getattr(query, "_limit", None) is not None or getattr(query, "_offset", None) is not None:
+                raise ShardingError("Exports over all shards can't have a limit or offset")
+        for (i, s) in enumerate(shards):
+            await s.copy_out(statement, format, write if i == 0 or format != "csv" else skip_first_line(write),
+                             columns, session)
@@ -1,22 +1,27 @@
 
 from functools import wraps
 import copy
-
-import psycopg2
-import momoko
+import inspect
+import itertools
+import operator
+import random
+import sys
+import time
 
 from .util import *
+from .stats import *
+from .backend import *
 
 
 # Exceptions
 # ==========
 
 class SqlError(Error):
-    """Exception raised while executing a query (or command). Wraps a psycopg2 error to
-    also include the query that went wrong.
+    """Exception raised while executing a query (or command). Wraps an error of the database
+    library (see `Backend.errors`) to also include the query that went wrong.
     """
     
-    def __init__(self, err: psycopg2.Error, query: "Sql", data: dict):
+    def __init__(self, err: Exception, query: "Sql", data: dict):
         self.err = err
         self.query = query
         self.data = data
@@ -28,23 +33,191 @@ class SqlError(Error):
 class NotSingle(Error):
     pass
 
+class CantEvaluate(Error):
+    """Raised when a condition can't be evaluated in Python (see `Condition.predicate`)."""
+    
+    def __init__(self, what):
+        self.what = what
+    
+    def __str__(self):
+        return "Can't evaluate {} in Python".format(self.what)
+
 # Classes
 # =======
 
 class Database:
-    """Class for Postgres database."""
+    """Class for Postgres database.
+    
+    Next to the primary database, you can give a number of read replicas (e.g. streaming
+    replicas of the primary). Statements that only read (see `Sql.read_only`) are sent to a
+    replica chosen by `load_balancer`, all others go to the primary. To read your own writes,
+    use a `DatabaseSession` (see `session`).
+    
+    Parameters:
+        - `dsn`: Use this DSN for the primary instead of building one from the other arguments.
+        - `replicas`: A list of replicas. Each replica is either a DSN string or a dictionary
+          that overrides some of the primary's arguments (e.g. `{"host": "replica1"}`).
+        - `load_balancer`: Policy to choose a replica, see `RoundRobin` (the default) and
+          `RandomReplica`.
+        - `sticky_window`: Number of seconds a session keeps reading from the primary after it
+          wrote something.
+        - `slow_query_threshold` and `slow_query_sample`: See `QueryStats`.
+        - `backend`: The `Backend` to use, by default a `MomokoBackend` on `ioloop`. With
+          another backend, `ioloop` may be `None`.
+    
+    Every execution is recorded in `stats` (a `QueryStats`).
+    """
+    
+    def __init__(self, ioloop, dbname, user="postgres", password="postgres", host="localhost", port=5432, momoko_poolsize=5,
+                 dsn=None, replicas=(), load_balancer=None, sticky_window=2.0,
+                 slow_query_threshold=None, slow_query_sample=1.0, backend=None):
+        args = dict(dbname=dbname, user=user, password=password, host=host, port=port)
+        self.backend = backend if backend is not None else MomokoBackend(ioloop)
+        self.errors = self.backend.errors
+        self.codecs = self.backend.codecs
+        self.pdb = self.backend.create_pool(dsn if dsn is not None else args, momoko_poolsize)
+        
+        self.replica_pools = []
+        for r in replicas:
+            if isinstance(r, dict):
+                replica_args = dict(args)
+                replica_args.update(r)
+                r = replica_args
+            self.replica_pools.append(self.backend.create_pool(r, momoko_poolsize))
+        
+        self.load_balancer = load_balancer if load_balancer is not None else RoundRobin()
+        self.sticky_window = sticky_window
+        self.stats = QueryStats(slow_query_threshold, slow_query_sample)
+    
+    def choose_pool(self, statement: "Sql", session: "DatabaseSession" = None):
+        """Return the pool that should execute `statement`."""
+        if not getattr(statement, "read_only", False):
+            if session is not None:
+                session.last_write = time.monotonic()
+            return self.pdb
+        if len(self.replica_pools) == 0:
+            return self.pdb
+        if session is not None and session.last_write is not None \
+                and time.monotonic() - session.last_write < self.sticky_window:
+            return self.pdb
+        return self.load_balancer.choose(self.replica_pools)
+    
+    def session(self):
+        """Create a `DatabaseSession` (for example one per incoming request)."""
+        return DatabaseSession(self)
+    
+    def transaction(self):
+        """Create a `Transaction` on the primary, to be used with ``async with``."""
+        return Transaction(self)
+    
+    async def get_cursor(self, statement: "Sql", unsafe_dict: dict, session: "DatabaseSession" = None):
+        return await self.execute_on(self.choose_pool(statement, session), statement, unsafe_dict)
     
-    def __init__(self, ioloop, dbname, user="postgres", password="postgres", host="localhost", port=5432, momoko_poolsize=5):
-        dsn = "dbname={dbname} user={user} password={password} host={host} port={port}".format(
-            dbname=dbname, user=user, password=password, host=host, port=port)
-        self.pdb = momoko.Pool(dsn=dsn, size=momoko_poolsize, ioloop=ioloop)
-        self.pdb.connect()
+    async def execute_on(self, executor, statement: "Sql", unsafe_dict: dict):
+        """Execute `statement` on `executor` (a pool or connection of the backend) and record it
+        in `stats`.
+        """
+        
+        text = str(statement)
+        start = time.perf_counter()
+        try:
+            cursor = await executor.execute(text, unsafe_dict)
+        except Exception as e:
+            self.stats.record(statement, text, time.perf_counter() - start, error=e)
+            raise
+        self.stats.record(statement, text, time.perf_counter() - start, cursor.rowcount)
+        return cursor
     
+    async def copy_out(self, statement: "Sql", format: str, write, columns: list, session: "DatabaseSession" = None):
+        """Stream the results of `statement` to the coroutine `write`, see `Select.export` and
+        `Backend.copy_out`.
+        """
+        
+        text = str(statement)
+        start = time.perf_counter()
+        try:
+            await self.backend.copy_out(self.choose_pool(statement, session), text, statement.data,
+                                        format, write, columns)
+        except Exception as e:
+            self.stats.record(statement, text, time.perf_counter() - start, error=e)
+            raise
+        self.stats.record(statement, text, time.perf_counter() - start)
 
+
+class DatabaseSession:
+    """Wraps a `Database` to provide 'read your writes': after a write, all reads done through
+    the session go to the primary for `Database.sticky_window` seconds. Pass it everywhere you
+    would otherwise pass the database::
+    
+        session = db.session()
+        await user.update(session)
+        u = await User.find_by_key(user.key, session)  # Reads from the primary
+    """
+    
+    def __init__(self, db: Database):
+        self.db = db
+        self.last_write = None
+    
     async def get_cursor(self, statement: "Sql", unsafe_dict: dict):
-        statement = str(statement)
-        cursor = await self.pdb.execute(statement, unsafe_dict)
-        return cursor
+        return await self.db.get_cursor(statement, unsafe_dict, session=self)
+    
+    async def copy_out(self, statement: "Sql", format: str, write, columns: list):
+        return await self.db.copy_out(statement, format, write, columns, session=self)
+    
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
+class Transaction:
+    """Executes statements in a single transaction on the primary. Pass it everywhere you would
+    otherwise pass the database::
+    
+        async with db.transaction() as t:
+            await user.update(t)
+            await message.insert(t)
+    
+    The transaction is committed at the end of the block, or rolled back if an exception is
+    raised.
+    """
+    
+    def __init__(self, db: Database):
+        self.db = db
+        self.context = None
+        self.conn = None
+    
+    async def __aenter__(self):
+        self.context = self.db.backend.transaction(self.db.pdb)
+        self.conn = await self.context.__aenter__()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        self.conn = None
+        return await self.context.__aexit__(exc_type, exc, tb)
+    
+    async def get_cursor(self, statement: "Sql", unsafe_dict: dict):
+        assert self.conn is not None, "Transaction is not active"
+        return await self.db.execute_on(self.conn, statement, unsafe_dict)
+    
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
+class RoundRobin:
+    """Load balancing policy that cycles through the replicas."""
+    
+    def __init__(self):
+        self.counter = itertools.count()
+    
+    def choose(self, pools: list):
+        return pools[next(self.counter) % len(pools)]
+
+
+class RandomReplica:
+    """Load balancing policy that picks a random replica."""
+    
+    def choose(self, pools: list):
+        return random.choice(pools)
+
 
 class GlobalDb:
     db = None
@@ -111,11 +284,14 @@ class SqlResult:
     
     The methods `single`, `all` and `amount` will try to interpret the result as object(s) of the
     given class in `self.query.cls`, don't try them if it that class is `None`.
+    
+    Rows are decoded with `codecs` (see `CodecRegistry`) before they are interpreted.
     """
     
-    def __init__(self, cursor, query: "Sql"):
+    def __init__(self, cursor, query: "Sql", codecs: CodecRegistry = None):
         self.cursor = cursor
         self.query = query
+        self.codecs = codecs
     
     def raw(self):
         """
@@ -129,20 +305,50 @@ class SqlResult:
         """Returns all raw values."""
         return self.cursor.fetchall()
     
+    def convert(self, row: tuple):
+        """Interpret a row as an object of `self.query.cls`, or as a tuple of objects if the
+        query joins multiple classes (see `Select.join`).
+        """
+        
+        if len(self.query.joined_classes) == 0:
+            if self.codecs is not None:
+                row = self.codecs.decode_row(self.query.cls, row)
+            return self.query.cls(db_args=row)
+        objs = []
+        start = 0
+        for cls in (self.query.cls,) + self.query.joined_classes:
+            end = start + len(cls._select_columns)
+            part = row[start:end]
+            # A LEFT JOIN without match gives only NULLs
+            if any(v is not None for v in part):
+                if self.codecs is not None:
+                    part = self.codecs.decode_row(cls, part)
+                objs.append(cls(db_args=part))
+            else:
+                objs.append(None)
+            start = end
+        return tuple(objs)
+    
     def single(self):
         """Returns a single object (and raises NotSingle if there is not only one."""
         if self.cursor.rowcount != 1:
             raise NotSingle("Not 1 result but {} result(s).".format(self.cursor.rowcount))
-        return self.query.cls(db_args=self.cursor.fetchone())
+        return self.convert(self.cursor.fetchone())
         
     def all(self):
         """Returns all objects in the query."""
-        return [self.query.cls(db_args=t) for t in self.cursor.fetchall()]
+        l = [self.convert(t) for t in self.cursor.fetchall()]
+        if self.query.reverse_results:
+            l.reverse()
+        return l
     
     def amount(self, i: int):
         """Returns a given number of objects in the query."""
         # TODO consider creating a version that asserts the amount specified is found
-        return [self.query.cls(db_args=t) for t in self.cursor.fetchmany(size=i)]
+        l = [self.convert(t) for t in self.cursor.fetchmany(size=i)]
+        if self.query.reverse_results:
+            l.reverse()
+        return l
     
     def scroll(self, i: int):
         """Scroll the cursor `i` steps. `i` can be negative. This method is chainable."""
@@ -154,13 +360,44 @@ class SqlResult:
         return self.cursor.rowcount
 
 
-def _wrapper_sqlresult(method):
+class CachedResult(SqlResult):
+    """Result of a query answered from the cache of a fully cached class, without the database
+    (see `FullCache`). The 'rows' of the cursor are the objects themselves.
+    """
+    
+    def __init__(self, objs: list, query: "Sql"):
+        SqlResult.__init__(self, RowCursor(objs), query)
+    
+    def convert(self, obj):
+        return obj
+    
+    def row(self, obj) -> tuple:
+        if obj is None:
+            return None
+        props = {p.name: p for p in self.query.cls._props}
+        return tuple([obj.__dict__[props[n].dataname] for n in self.query.cls._select_columns])
+    
+    def raw(self):
+        return self.row(self.cursor.fetchone())
+    
+    def raw_all(self):
+        return [self.row(o) for o in self.cursor.fetchall()]
+
+
+def _wrapper_sqlresult(method, objects=False):
     @wraps(method)
     async def wrapper(self, db: Database = None, *args, **kwargs):
         if db is None:
             db = GlobalDb.get()
         result = await self.exec(db)
-        return method(result, *args, **kwargs)
+        res = getattr(result, method.__name__)(*args, **kwargs)  # May be a CachedResult
+        if objects and len(self.prefetch_paths) > 0:
+            objs = res if isinstance(res, list) else [res]
+            if len(self.joined_classes) > 0:
+                objs = [o for t in objs for o in t if o is not None]
+            for path in self.prefetch_paths:
+                await path[0].prefetch([o for o in objs if isinstance(o, path[0].cls)], db, path[1:])
+        return res
     wrapper.__doc__ += "\n\nWrapped version, first argument is the database."
     return wrapper
 
@@ -180,19 +417,38 @@ class Sql:
     # By default, there is no class
     cls = None
     
+    read_only = False
+    """Whether the statement only reads data. Read-only statements may be sent to a replica."""
+    
+    source = None
+    """For statements made by `to_raw`, the statement it was compiled from."""
+    
+    reverse_results = False
+    """Whether the results should be reversed (see `Select.before`)."""
+    
+    prefetch_paths = ()
+    """References to load after the query, see `Select.prefetch`."""
+    
+    joined_classes = ()
+    """Classes joined to `cls`, see `Select.join`."""
+    
+    object_key = None
+    """The key of the single object this statement is about, if known (see
+    `Entity._statement_for` and `Entity.find_by_key`)."""
+    
     async def exec(self, db: Database = None):
         """Execute the SQL statement on the given database."""
         if db is None:
             db = GlobalDb.get()
         try:
-            return SqlResult(await db.get_cursor(str(self), self.data), self)
-        except psycopg2.Error as e:
+            return SqlResult(await db.get_cursor(self, self.data), self, db.codecs)
+        except db.errors as e:
             raise SqlError(e, str(self), self.data)
     
     # Allows you to call these method immediatly on a statement:
-    single = _wrapper_sqlresult(SqlResult.single)
-    all = _wrapper_sqlresult(SqlResult.all)
-    amount = _wrapper_sqlresult(SqlResult.amount)
+    single = _wrapper_sqlresult(SqlResult.single, objects=True)
+    all = _wrapper_sqlresult(SqlResult.all, objects=True)
+    amount = _wrapper_sqlresult(SqlResult.amount, objects=True)
     count = _wrapper_sqlresult(SqlResult.count)
     raw = _wrapper_sqlresult(SqlResult.raw)
     raw_all = _wrapper_sqlresult(SqlResult.raw_all)
@@ -230,7 +486,15 @@ class Sql:
     
     def to_raw(self):
         """Compile this to a `RawSql` instance for more performance!"""
-        return RawSql(str(self), self.data)
+        raw = RawSql(str(self), self.data, self.read_only)
+        raw.source = self
+        return raw
+    
+    def columns(self) -> list:
+        """Returns the properties used by this statement (in conditions and orderings), as a list
+        of `(property, operator)` tuples. Used for example by `SparrowModel.index_report`.
+        """
+        return []
     
     def __str__(self):
         return "undefined so far"
@@ -246,25 +510,48 @@ class ClassedSql(Sql):
         Sql.__init__(self, data)
     
     def to_raw(self):
-        return RawClassedSql(self.cls, str(self), self.data)
+        raw = RawClassedSql(self.cls, str(self), self.data, self.read_only)
+        raw.source = self
+        return raw
+
+
+def reads_only(text: str) -> bool:
+    """Guess whether a raw SQL text only reads data (a plain 'SELECT')."""
+    text = text.lstrip().upper()
+    return text.startswith("SELECT") and not any(
+        w in text for w in (" INTO ", " FOR UPDATE", " FOR NO KEY UPDATE", " FOR SHARE", " FOR KEY SHARE"))
 
 
 class RawSql(Sql):
     """Simply saves a string, and also some data. This is in contrast with `Sql`, which may save
     the query in a more abstract way.
+    
+    If `read_only` is not given, it is guessed from the text (see `reads_only`).
     """
     
-    def __init__(self, text, data = {}):
+    def __init__(self, text, data = {}, read_only=None):
         self.text = text
+        self.read_only = reads_only(text) if read_only is None else read_only
         Sql.__init__(self, data)
     
     def to_raw(self):
         """Already raw, just return self."""
         return self
     
+    def columns(self):
+        return self.source.columns() if self.source is not None else []
+    
+    def predicate(self):
+        """See `Condition.predicate`, only works for statements compiled from a `Condition`."""
+        if self.source is None:
+            raise CantEvaluate(self.text)
+        return self.source.predicate()
+    
     def copy(self):
         """More optimized version of copy."""
-        return RawSql(self.text, copy.copy(self.data))
+        newself = copy.copy(self)
+        newself.data = copy.copy(self.data)
+        return newself
     
     def __str__(self):
         return self.text
@@ -273,18 +560,122 @@ class RawSql(Sql):
 class RawClassedSql(RawSql, ClassedSql):
     """Version of `RawSql` that also saves a given class like `ClassedSql`."""
     
-    def __init__(self, cls, text, data = {}):
+    def __init__(self, cls, text, data = {}, read_only=None):
         # TODO possibly make this use super but I suspect it will fuck around
         self.cls = cls
-        self.text = text
-        Sql.__init__(self, data)
+        RawSql.__init__(self, text, data, read_only)
+
+
+def operand_columns(what, op: str) -> list:
+    """Returns the columns (see `Sql.columns`) of a single operand of a condition or ordering."""
+    if isinstance(what, Sql):
+        return what.columns()
+    if hasattr(what, "query_columns"):
+        return [(p, op) for p in what.query_columns()]
+    return []
+
+
+def operand_value(what, value):
+    """`value` as it is compared with the operand `what` in the database (see
+    `Type.operand_to_sql`). For a composite reference or key (see `operand_props`), `value` is
+    a tuple.
+    """
     
-    def copy(self):
-        return RawClassedSql(self.cls, self.text, copy.copy(self.data))
+    props = operand_props(what)
+    if props is None or value is None:
+        return value
+    encoders = [getattr(p.type, "operand_to_sql", None) for p in props]
+    if all(e is None for e in encoders):
+        return value
+    if len(props) == 1:
+        return encoders[0](value)
+    if not isinstance(value, tuple):
+        return value
+    return tuple([e(v) if e is not None and v is not None else v for (e, v) in zip(encoders, value)])
+
+
+def operand_props(what) -> list:
+    """The properties an operand of a condition stands for: the property itself, or the
+    properties of a `Reference` or `Key`. `None` for other operands.
+    """
+    
+    if hasattr(what, "dataname"):
+        return [what]
+    if hasattr(what, "query_columns") and not isinstance(what, Sql):
+        props = what.query_columns()
+        if len(props) > 0 and all(hasattr(p, "dataname") for p in props):
+            return props
+    return None
+
+
+def operand_getter(what):
+    """Returns a function that gives the value of an operand of a condition for an object (see
+    `Condition.predicate`). Works for properties, `Unsafe` values and constants.
+    """
+    
+    if isinstance(what, Unsafe):
+        return lambda obj, _value=what.value: _value
+    props = operand_props(what)
+    if props is not None and len(props) == 1:
+        return lambda obj, _name=props[0].dataname: obj.__dict__[_name]
+    if props is not None:
+        # A composite reference or key: a tuple, or NULL (like in SQL) if a part is NULL
+        def _get(obj, _names=[p.dataname for p in props]):
+            value = tuple([obj.__dict__[n] for n in _names])
+            return None if None in value else value
+        return _get
+    if isinstance(what, (Sql, Field, str)) or hasattr(what, "query_columns"):
+        raise CantEvaluate(what)
+    return lambda obj, _value=what: _value
+
+
+def operand_ordering(what):
+    """How the database orders the values of an operand, for `<`, `<=`, `>` and `>=` in Python
+    (see `Condition.predicate`): `None` if like Python, or a function that gives a value to
+    compare instead. An `Enum` is ordered by the position of its values (values that are not
+    options give `None`). Raises `CantEvaluate` for text, which the database orders by the
+    collation of the column.
+    """
+    
+    t = getattr(what, "type", None)
+    if t is None:
+        return None
+    inv_options = getattr(t, "inv_options", None)
+    if inv_options is not None:
+        return inv_options.get
+    if getattr(t, "python_type", None) is str:
+        raise CantEvaluate(what)
+    return None
+
+
+def ordered_getter(getter, key):
+    """Wraps an `operand_getter` to give the value to compare of `operand_ordering`."""
+    
+    def _get(obj):
+        value = getter(obj)
+        return None if value is None else key(value)
+    return _get
+
+
+def condition_predicate(what):
+    if not isinstance(what, Sql):
+        raise CantEvaluate(what)
+    return what.predicate()
 
 
 class Condition(Sql):
-    pass
+    def predicate(self):
+        """Returns a function that evaluates this condition in Python for an object (of the
+        class of the query), without the database. Raises `CantEvaluate` for conditions that
+        only the database can evaluate (like raw SQL or `Field`s, or `<` on text, see
+        `operand_ordering`). Comparisons with `None` are false, like comparisons with NULL in
+        SQL.
+        """
+        raise CantEvaluate(self)
+    
+    def matches(self, obj) -> bool:
+        """Evaluate this condition for `obj` in Python, see `predicate`."""
+        return self.predicate()(obj)
 
 
 class Not(Condition):
@@ -293,6 +684,13 @@ class Not(Condition):
         self.cond = self.check(cond)
         Sql.__init__(self)
     
+    def columns(self):
+        return self.cond.columns() if isinstance(self.cond, Sql) else []
+    
+    def predicate(self):
+        pred = condition_predicate(self.cond)
+        return lambda obj: not pred(obj)
+    
     def __str__(self):
         return "(NOT {})".format(self.cond)
 
@@ -301,12 +699,23 @@ class MultiCondition(Condition):
         Sql.__preinit__(self)
         self.conditions = [self.check(c) for c in conds]
         Sql.__init__(self)
+    
+    def columns(self):
+        return [col for c in self.conditions for col in operand_columns(c, None)]
 
 class And(MultiCondition):
+    def predicate(self):
+        preds = [condition_predicate(c) for c in self.conditions]
+        return lambda obj: all([p(obj) for p in preds])
+    
     def __str__(self):
         return "(" + " AND ".join([str(c) for c in self.conditions]) + ")"
 
 class Or(MultiCondition):
+    def predicate(self):
+        preds = [condition_predicate(c) for c in self.conditions]
+        return lambda obj: any([p(obj) for p in preds])
+    
     def __str__(self):
         return "(" + " OR ".join([str(c) for c in self.conditions]) + ")"
 
@@ -321,17 +730,85 @@ class Where(Condition):
             - `lfield` and `rfield`: Anything that can be interpreted as a part of an SQL query,
               could be of type string, `Sql`, `Field`, `Unsafe`, ...
             - `op`: Some operation that needs to be performed. Examples: '==', '>', ...
+        
+        If `lfield` is a property (or reference) whose type stores values differently (see
+        `Type.operand_to_sql`), an `Unsafe` `rfield` is converted. `original_rfield` keeps the
+        value as given.
         """
         
         Sql.__preinit__(self)
+        self.original_rfield = rfield
+        if isinstance(rfield, Unsafe):
+            value = operand_value(lfield, rfield.value)
+            if value is not rfield.value:
+                rfield = Unsafe(value)
         self.lfield = self.check(lfield)
         self.op = op
         self.rfield = self.check(rfield)
         Sql.__init__(self, data)
     
+    def columns(self):
+        return operand_columns(self.lfield, self.op) + operand_columns(self.rfield, self.op)
+    
+    def predicate(self):
+        try:
+            op = python_operators[self.op]
+        except KeyError:
+            raise CantEvaluate(self)
+        left = operand_getter(self.lfield)
+        right = operand_getter(self.original_rfield)
+        if self.op in flipped_operators:
+            orderings = [operand_ordering(self.lfield), operand_ordering(self.original_rfield)]
+            key = orderings[0] or orderings[1]
+            if key is not None:
+                (left, right) = (ordered_getter(left, key), ordered_getter(right, key))
+        
+        def _predicate(obj):
+            l = left(obj)
+            r = right(obj)
+            return l is not None and r is not None and op(l, r)
+        return _predicate
+    
+    def comparison(self) -> tuple:
+        """If this compares a property with a value (like `property < value`), returns a tuple
+        `(property, op, value)` with the property on the left, otherwise `None`. Used to index
+        live queries and cached queries. A reference with a single property gives that property;
+        a composite reference or key gives itself (only for `=`, with a tuple as value).
+        """
+        
+        if self.op not in python_operators:
+            return None
+        for (prop, other, op) in ((self.lfield, self.original_rfield, self.op),
+                                  (self.original_rfield, self.lfield, flipped_operators.get(self.op, self.op))):
+            props = operand_props(prop)
+            if props is not None and operand_props(other) is None:
+                try:
+                    value = operand_getter(other)(None)
+                except CantEvaluate:
+                    return None
+                if len(props) == 1:
+                    return (props[0], op, value)
+                if op == "=" and isinstance(value, tuple) and len(value) == len(props):
+                    return (prop, op, value)
+                return None
+        return None
+    
     def __str__(self):
         return "{s.lfield} {s.op} {s.rfield}".format(s=self)
 
+python_operators = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<>": operator.ne,
+    "<": operator.lt,
+    ">": operator.gt,
+    "<=": operator.le,
+    ">=": operator.ge,
+}
+"""Operators of `Where` that can be evaluated in Python."""
+
+flipped_operators = {"<": ">", ">": "<", "<=": ">=", ">=": "<="}
+
 class Order(Sql):  # TODO order on multiple attributes (might work already?)
     """Encodes an 'ORDER BY' clause."""
     
@@ -349,12 +826,17 @@ class Order(Sql):  # TODO order on multiple attributes (might work already?)
         self.op = op
         Sql.__init__(self, data)
         
+    def columns(self):
+        return operand_columns(self.field, self.op)
+    
     def __str__(self):
         return "{s.field} {s.op}".format(s=self)
 
 class Select(ClassedSql):
     """Encodes a 'SELECT' query."""
     
+    read_only = True
+    
     def __init__(self, cls, where_clauses = [], order: Order = None, offset=None, limit=None):
         """Initialize a 'SELECT' query. Most likely you will use `SomeEntityClass.get(...)` instead of this."""
         
@@ -363,6 +845,9 @@ class Select(ClassedSql):
         self._order = self.check(order)
         self._offset = self.check(offset)
         self._limit = self.check(limit)
+        self._keyset = None
+        self._seek_condition = None
+        self._joins = []
         ClassedSql.__init__(self, cls)
     
     def limit(self, l):
@@ -376,26 +861,360 @@ class Select(ClassedSql):
         return self
     
     def where(self, *clauses):
-        """'OFFSET' the query. Can be used for chaining.
+        """Add 'WHERE' clauses to the query. Can be used for chaining.
         
         Parameters: a number of Where clauses.
         """
         
-        self.where_clauses.extend(clauses)
+        self.where_clauses.extend([self.check(c) for c in clauses])
         return self
     
     def order(self, _order: Order):
         """'ORDER' the query. Can be used for chaining."""
         if not isinstance(_order, Order):
             _order = +_order
-        self._order = _order
+        self._order = self.check(_order)
         return self
     
-    def __str__(self):
-        s = "SELECT {props} FROM {cls._table_name}".format(cls=self.cls, props=self.cls._select_props)
-        if len(self.where_clauses) > 0:
-            s += " WHERE " + " AND ".join(["("+str(c)+")" for c in self.where_clauses])
+    def join(self, ref, outer: bool = False):
+        """Join another class along a `Reference`. Either the referencing or the referenced class
+        has to be in the query already. The results are tuples with an object of every class
+        (in the order of joining), each coming from the cache of its class if possible::
+        
+            for (order, customer) in await Order.get(Order.paid == False).join(Order.customer).all(db):
+                ...
+        
+        With `outer`, a LEFT JOIN is used, so missing objects are `None`. Can be used for chaining.
+        """
+        
+        classes = (self.cls,) + self.joined_classes
+        if ref.cls in classes and ref.ref not in classes:
+            new = ref.ref
+        elif ref.ref in classes and ref.cls not in classes:
+            new = ref.cls
+        else:
+            raise ValueError("Can't join {} (both or none of its classes are already in the query)".format(ref.name))
+        self._joins = self._joins + [(ref, new, outer)]
+        self.joined_classes = self.joined_classes + (new,)
+        return self
+    
+    def tables_sql(self) -> str:
+        """The tables (with joins) the query reads from."""
+        s = self.cls._table_name
+        for (ref, new, outer) in self._joins:
+            s += " {join} {t} ON ({own}) = ({other})".format(
+                join="LEFT JOIN" if outer else "JOIN", t=new._table_name,
+                own=", ".join([str(p) for p in ref.props]), other=", ".join([str(p) for p in ref.ref_props]))
+        return s
+    
+    def props_sql(self) -> str:
+        """The columns the query selects."""
+        if len(self._joins) == 0:
+            return self.cls._select_props
+        return ", ".join([c._table_name + "." + n for c in (self.cls,) + self.joined_classes for n in c._select_columns])
+    
+    def after(self, position):
+        """Keyset (or 'seek') pagination: only return the results that come after `position`,
+        which is either an object of `cls` or a tuple with the values of the ordering followed by
+        the values of the key. The results are ordered by the ordering of the query, followed by
+        the key (as a tie-breaker). Can be used for chaining::
+        
+            page = await Message.get(Message.to == Unsafe(uid)).order(-Message.sent).limit(50).all(db)
+            next_page = await Message.get(Message.to == Unsafe(uid)).order(-Message.sent) \\
+                .after(page[-1]).limit(50).all(db)
+        
+        Unlike `offset`, this does not get slower the further you go, as long as there is an
+        index on the ordering and the key. `None` means "from the start", it only adds the key
+        to the ordering. The ordered properties have to be `required`: a row comparison with
+        NULL is NULL, so rows with NULL would never show up.
+        """
+        
+        return self._seek(position, True)
+    
+    def before(self, position):
+        """Like `after`, but returns the results that come before `position` (still in the
+        order of the query, the last result is the one right before `position`).
+        """
+        
+        return self._seek(position, False)
+    
+    def count_query(self) -> RawSql:
+        """Returns a query that counts the results of this query in the database."""
+        if self._limit is None and self._offset is None:
+            text = "SELECT COUNT(*) FROM " + self.tables_sql() + self.where_sql()
+        else:
+            text = "SELECT COUNT(*) FROM (" + str(self) + ") AS _sparrow_counted"
+        raw = RawSql(text, self.data, read_only=True)
+        raw.source = self
+        return raw
+    
+    async def count(self, db: "Database" = None) -> int:
+        """Count the results with 'SELECT COUNT(*)', without fetching them."""
+        cached = self.cached_results()
+        if cached is not None:
+            return len(cached)
+        (n,) = await self.count_query().raw(db)
+        return n
+    
+    async def exists(self, db: "Database" = None) -> bool:
+        """Check whether there is at least one result with 'SELECT EXISTS(...)'."""
+        cached = self.cached_results()
+        if cached is not None:
+            return len(cached) > 0
+        raw = RawSql("SELECT EXISTS(SELECT 1 FROM " + self.tables_sql() + self.where_sql() + ")",
+                     self.data, read_only=True)
+        raw.source = self
+        (b,) = await raw.raw(db)
+        return b
+    
+    def aggregate(self, *functions) -> "AggregateQuery":
+        """Compute aggregates (see `AggregateFunction`) over the results, in the database::
+        
+            (total, biggest) = await Order.get(Order.paid == True).aggregate(Sum(Order.total), Max(Order.total)).raw(db)
+            per_day = await Order.get().aggregate(Count(), Avg(Order.total)) \\
+                .group_by(Order.created, bucket="day").raw_all(db)
+        
+        The ordering, limit and offset of this query are ignored.
+        """
+        
+        return AggregateQuery(self, functions)
+    
+    def prefetch(self, *paths):
+        """After the query, load the objects referenced by the results through the given
+        references, with one query per reference (objects already in the cache are not loaded
+        again). A path of multiple references can be given as a list. Can be used for chaining::
+        
+            orders = await Order.get(Order.paid == False).prefetch(
+                Order.product, [Order.customer, Customer.company]).all(db)
+            for o in orders:
+                c = Order.customer.resolve(o)  # No query needed
+        
+        The loaded objects stay in memory as long as the objects referring to them.
+        """
+        
+        self.prefetch_paths = self.prefetch_paths + tuple([
+            tuple(p) if isinstance(p, (list, tuple)) else (p,) for p in paths])
+        return self
+    
+    def pages(self, size: int, db: "Database" = None) -> "Pages":
+        """Iterate over all results in pages (lists) of `size` objects, using `after`::
+        
+            async for page in Message.get().order(+Message.sent).pages(1000, db):
+                ...
+        """
+        
+        return Pages(self, size, db)
+    
+    def cached_results(self) -> list:
+        """The results from memory if `cls` is fully cached (see `FullCache`) and the query
+        can be answered there, otherwise `None`.
+        """
+        
+        full_cache = getattr(self.cls, "_full_cache", None)
+        if full_cache is None:
+            return None
+        return full_cache.query(self)
+    
+    async def exec(self, db: "Database" = None):
+        """Execute the query, or answer it from memory (see `cached_results`)."""
+        cached = self.cached_results()
+        if cached is not None:
+            return CachedResult(cached, self)
+        return await ClassedSql.exec(self, db)
+    
+    def predicate(self):
+        """A function that tells whether an object would be in the results (ignoring limit and
+        offset), see `Condition.predicate`.
+        """
+        
+        preds = [condition_predicate(c) for c in self.where_clauses]
+        return lambda obj: all([p(obj) for p in preds])
+    
+    def comparisons(self) -> list:
+        """The `(property, op, value)` tuples (see `Where.comparison`) of the conditions that
+        every result must satisfy. Composite references and keys are split into their
+        properties.
+        """
+        
+        l = []
+        todo = list(self.where_clauses)
+        while len(todo) > 0:
+            c = todo.pop(0)
+            c = getattr(c, "source", None) or c
+            if isinstance(c, And):
+                todo.extend(c.conditions)
+            elif isinstance(c, Where):
+                comp = c.comparison()
+                if comp is None:
+                    continue
+                (prop, op, value) = comp
+                if hasattr(prop, "dataname"):
+                    l.append(comp)
+                else:
+                    # A composite reference or key: one equality per property
+                    l.extend([(p, op, v) for (p, v) in zip(operand_props(prop), value)])
+        return l
+    
+    def equalities(self) -> list:
+        """The `(property, value)` tuples of the conditions of the form `property = value`
+        that every result must satisfy.
+        """
+        return [(p, v) for (p, op, v) in self.comparisons() if op == "="]
+    
+    async def subscribe(self, listener, db: "Database" = None) -> "Subscription":
+        """Follow the results of this query live. `listener` (see `QueryListener`) first gets
+        the current results, then it is told when objects are added to the results, changed
+        while in the results, or removed from them::
+        
+            sub = await Ticket.get(Ticket.team == Unsafe(team), Ticket.open == True).subscribe(listener, db)
+            ...
+            sub.cancel()
+        
+        The conditions are evaluated in Python (see `Condition.predicate`) for every object of
+        `cls` inserted, updated or deleted by this process. Writes by other processes, or with
+        raw SQL, are not seen. The query can't have a limit, offset, keyset or joins.
+        """
+        
+        assert self._limit is None and self._offset is None, "Live queries can't have a limit or offset"
+        assert self._seek_condition is None and len(self._joins) == 0, "Live queries can't use keysets or joins"
+        return await self.cls._subscribe(self, listener, db)
+    
+    def export_query(self, format: str = "csv") -> tuple:
+        """The query used by `export`, and the `(name, type)` of its columns (see
+        `Backend.copy_out`). Returns a tuple `(query, columns)`.
+        """
+        
+        if format == "ndjson":
+            assert len(self._joins) == 0, "Can't export joined queries as ndjson"
+            props = [(self.cls, p) for p in self.cls._json_props]
+        else:
+            props = []
+            for c in (self.cls,) + self.joined_classes:
+                by_name = {p.name: p for p in c._props}
+                props.extend([(c, by_name[n]) for n in c._select_columns])
+        exprs = []
+        columns = []
+        for (c, p) in props:
+            col = p.name if len(self._joins) == 0 else c._table_name + "." + p.name
+            if format != "binary" and getattr(p.type, "storage", None) == "smallint":
+                # Export the values of the Enum, not their positions
+                col = "CASE {} {} END".format(col, " ".join(["WHEN {} THEN '{}'".format(i, str(o).replace("'", "''"))
+                                                             for (i, o) in enumerate(p.type.options)]))
+                columns.append((p.name, None))
+            else:
+                columns.append((p.name, p.type))
+            # Quoted, so the names keep their case (like in `json_repr`)
+            exprs.append('{} AS "{}"'.format(col, p.name))
+        text = "SELECT " + ", ".join(exprs) + " FROM " + self.tables_sql() + self.where_sql() + self.order_sql()
+        raw = RawSql(text, self.data, read_only=True)
+        raw.source = self
+        return (raw, columns)
+    
+    async def export(self, sink, format: str = "csv", db: "Database" = None):
+        """Stream the results to `sink` without creating any objects, with Postgres' ``COPY
+        (...) TO STDOUT``. Much faster (and lighter) than `all` and `Entity.to_json` for large
+        exports::
+        
+            with open("users.ndjson", "wb") as f:
+                await User.get(User.active == True).export(f, "ndjson", db)
+        
+        Parameters:
+            - `sink`: Anything with a method ``write(bytes)``, like a file opened in binary
+              mode. The method may be a coroutine.
+            - `format`: ``"csv"`` (with a header), ``"ndjson"`` (one JSON object per line,
+              like `Entity.json_repr`) or ``"binary"`` (the binary format of ``COPY``).
+        
+        With SQLite, the export is emulated and ``"binary"`` is not available.
+        """
+        
+        assert format in ("csv", "ndjson", "binary"), "Unknown export format: " + repr(format)
+        if db is None:
+            db = GlobalDb.get()
+        (query, columns) = self.export_query(format)
+        
+        async def write(chunk):
+            result = sink.write(chunk)
+            if inspect.isawaitable(result):
+                await result
+        
+        try:
+            await db.copy_out(query, format, write, columns)
+        except db.errors as e:
+            raise SqlError(e, str(query), query.data)
+    
+    def seek_columns(self) -> list:
+        """The `(property, 'ASC' or 'DESC')` tuples used by keyset pagination: the ordering,
+        followed by the key.
+        """
+        
+        cols = operand_columns(self._order, None) if self._order is not None else []
+        direction = cols[-1][1] if len(cols) > 0 else "ASC"
+        for p in self.cls.key.referencing_props():
+            if not any(p is q for (q, op) in cols):
+                cols.append((p, direction))
+        return cols
+    
+    def _seek(self, position, forward: bool):
+        cols = self.seek_columns()
+        key_props = list(self.cls.key.referencing_props())
+        for (p, op) in cols:
+            assert getattr(p, "required", True) or any(p is k for k in key_props), \
+                "Keyset pagination on {}, which can be NULL".format(p.name)
+        self._keyset = [(p, op if forward else ("ASC" if op == "DESC" else "DESC")) for (p, op) in cols]
+        self.reverse_results = not forward
+        if position is None:
+            self._seek_condition = None
+            return self
+        
+        if isinstance(position, self.cls):
+            values = [position.__dict__[p.dataname] for (p, op) in cols]
+        else:
+            values = list(position) if isinstance(position, tuple) else [position]
+            assert len(values) == len(cols), "Expected values for " + ", ".join([p.name for (p, op) in cols])
+        # Keep the Unsafe objects alive, their key is based on their id
+        # Converted like the values of a condition (see `Where`)
+        self._seek_values = [Unsafe(operand_value(p, v)) for ((p, op), v) in zip(cols, values)]
+        values = [str(self.check(u)) for u in self._seek_values]
+        # All columns are sorted in the same direction, so a row comparison does the job
+        self._seek_condition = "({}) {} ({})".format(
+            ", ".join([str(p) for (p, op) in cols]), ">" if self._keyset[0][1] == "ASC" else "<", ", ".join(values))
+        return self
+    
+    def columns(self):
+        l = [col for c in self.where_clauses for col in operand_columns(c, None)]
         if self._order is not None:
+            l.extend(operand_columns(self._order, None))
+        return l
+    
+    def copy(self):
+        """Faster version of copy, the clauses themselves are shared."""
+        newself = copy.copy(self)
+        newself.data = copy.copy(self.data)
+        newself.where_clauses = list(self.where_clauses)
+        return newself
+    
+    def to_raw(self):
+        raw = ClassedSql.to_raw(self)
+        raw.reverse_results = self.reverse_results
+        raw.prefetch_paths = self.prefetch_paths
+        raw.joined_classes = self.joined_classes
+        return raw
+    
+    def where_sql(self) -> str:
+        """The 'WHERE ...' part of the query (or an empty string)."""
+        clauses = self.where_clauses
+        if self._seek_condition is not None:
+            clauses = clauses + [self._seek_condition]
+        if len(clauses) > 0:
+            return " WHERE " + " AND ".join(["("+str(c)+")" for c in clauses])
+        return ""
+    
+    def order_sql(self) -> str:
+        """The 'ORDER BY ... LIMIT ... OFFSET ...' part of the query (or an empty string)."""
+        s = ""
+        if self._keyset is not None:
+            s += " ORDER BY " + ", ".join(["{} {}".format(p, op) for (p, op) in self._keyset])
+        elif self._order is not None:
             s += " ORDER BY {}".format(self._order)
         if self._limit is not None:
             s += " LIMIT {}".format(self._limit)
@@ -403,6 +1222,108 @@ class Select(ClassedSql):
             s += " OFFSET {}".format(self._offset)
         return s
     
+    def __str__(self):
+        return "SELECT " + self.props_sql() + " FROM " + self.tables_sql() + self.where_sql() + self.order_sql()
+
+
+class AggregateFunction(Sql):
+    """An aggregate function like 'SUM(...)', to be used in `Select.aggregate`. Use the
+    subclasses `Count`, `Sum`, `Min`, `Max` and `Avg`.
+    """
+    
+    function = None
+    
+    def __init__(self, field=None):
+        Sql.__preinit__(self)
+        self.field = self.check(field)
+        Sql.__init__(self)
+    
+    def __str__(self):
+        return "{}({})".format(self.function, "*" if self.field is None else self.field)
+
+class Count(AggregateFunction):
+    """'COUNT(field)', or 'COUNT(*)' without field."""
+    function = "COUNT"
+
+class Sum(AggregateFunction):
+    function = "SUM"
+
+class Min(AggregateFunction):
+    function = "MIN"
+
+class Max(AggregateFunction):
+    function = "MAX"
+
+class Avg(AggregateFunction):
+    function = "AVG"
+
+
+time_buckets = ("second", "minute", "hour", "day", "week", "month", "quarter", "year")
+
+class AggregateQuery(Sql):
+    """Aggregates over the results of a `Select`, see `Select.aggregate`. The results are plain
+    rows (use `raw` or `raw_all`): first the values of the groups, then the aggregates.
+    """
+    
+    read_only = True
+    
+    def __init__(self, select: Select, functions):
+        Sql.__preinit__(self)
+        self.select = select
+        self.functions = [self.check(f) for f in functions]
+        self.groups = []
+        Sql.__init__(self, select.data)
+    
+    def group_by(self, field, bucket: str = None):
+        """Group by `field`. For a `datetime` field, `bucket` (one of `time_buckets`, e.g. 'day')
+        groups per time interval. Groups are sorted. Can be used for chaining.
+        """
+        
+        field = self.check(field)
+        if bucket is None:
+            self.groups.append(str(field))
+        else:
+            assert bucket in time_buckets, "Unknown bucket " + bucket
+            self.groups.append("date_trunc('{}', {})".format(bucket, field))
+        return self
+    
+    def __str__(self):
+        s = "SELECT " + ", ".join(self.groups + [str(f) for f in self.functions]) \
+            + " FROM " + self.select.tables_sql() + self.select.where_sql()
+        if len(self.groups) > 0:
+            s += " GROUP BY {g} ORDER BY {g}".format(g=", ".join(self.groups))
+        return s
+
+
+class Pages:
+    """Asynchronous iterator over the results of a `Select` in pages, see `Select.pages`."""
+    
+    def __init__(self, query: Select, size: int, db: "Database" = None):
+        self.query = query
+        self.size = size
+        self.db = db
+        self.last = None
+        self.done = False
+    
+    if sys.version_info < (3, 5, 2):
+        # Python 3.5.0 and 3.5.1 await the result of __aiter__
+        async def __aiter__(self):
+            return self
+    else:
+        def __aiter__(self):
+            return self
+    
+    async def __anext__(self):
+        if self.done:
+            raise StopAsyncIteration
+        page = await self.query.copy().after(self.last).limit(self.size).all(self.db)
+        if len(page) < self.size:
+            self.done = True
+        if len(page) == 0:
+            raise StopAsyncIteration
+        self.last = page[-1]
+        return page
+
 
 class Command(ClassedSql):
     """For INSERT, DELETE, UPDATE, CREATE TABLE, DROP TABLE, ... statements."""
@@ -412,7 +1333,7 @@ class Command(ClassedSql):
 sql_create_table_template = """
 CREATE TABLE {tname} (
 {stuff}
-); 
+){partition}; 
 """
 
 class CreateTable(Command):
@@ -426,9 +1347,52 @@ class CreateTable(Command):
             tname = self.cls._table_name,
             stuff = ",\n".join([p.sql_def() for p in self.cls._props]
                                + [r.sql_constraint() for r in self.cls._refs]
-                               + [self.cls.key.sql_constraint()])
+                               + [self.cls.key.sql_constraint()]),
+            partition = " " + self.cls._partitioning.partition_by_sql() if self.cls._partitioning is not None else ""
         )
 
+class CreatePartition(Command):
+    """For CREATE TABLE ... PARTITION OF statements, `bound` is like ``FOR VALUES IN (1, 2)``
+    (see `Partitioning.partitions`).
+    """
+    
+    def __init__(self, cls, name: str, bound: str):
+        Command.__init__(self, cls)
+        self.name = name
+        self.bound = bound
+    
+    def __str__(self):
+        return "CREATE TABLE {} PARTITION OF {} {}".format(self.name, self.cls._table_name, self.bound)
+
+class CreateIndex(Command):
+    """For CREATE INDEX statements, `index` is an `Index` of `cls`."""
+    
+    def __init__(self, cls, index):
+        Command.__init__(self, cls)
+        self.index = index
+    
+    def __str__(self):
+        s = "CREATE {unique}INDEX {i.name} ON {cls._table_name}{method} ({cols})".format(
+            i = self.index,
+            cls = self.cls,
+            unique = "UNIQUE " if self.index.unique else "",
+            method = " USING " + self.index.method if self.index.method is not None else "",
+            cols = ", ".join(self.index.column_sql())
+        )
+        if self.index.where is not None:
+            s += " WHERE " + self.index.where
+        return s
+
+class DropIndex(Command):
+    """For DROP INDEX statements."""
+    
+    def __init__(self, cls, index):
+        Command.__init__(self, cls)
+        self.index = index
+    
+    def __str__(self):
+        return "DROP INDEX IF EXISTS {i.name}".format(i = self.index)
+
 class DropTable(Command):
     """For DROP TABLE statements."""
     
@@ -0,0 +1,179 @@
+
+import collections
+import logging
+import random
+import re
+
+from .util import *
+
+
+slow_query_logger = logging.getLogger("sparrow.slow_queries")
+
+# Helpers
+# =======
+
+_param_re = re.compile(r"%\([^)]*\)s")
+_string_re = re.compile(r"'(?:[^']|'')*'")
+_number_re = re.compile(r"\b\d+(?:\.\d+)?\b")
+_space_re = re.compile(r"\s+")
+
+_shape_cache = {}
+_shape_cache_size = 10000
+
+def normalize_sql(text: str) -> str:
+    """Return the *shape* of an SQL text: parameters and literals are replaced by ``?`` and
+    whitespace is collapsed. All executions of for example `_find_by_key_query` have the same shape,
+    regardless of the data (or `Unsafe` keys) used.
+    """
+    
+    try:
+        return _shape_cache[text]
+    except KeyError:
+        pass
+    shape = _param_re.sub("?", text)
+    shape = _string_re.sub("?", shape)
+    shape = _number_re.sub("?", shape)
+    shape = _space_re.sub(" ", shape).strip()
+    if len(_shape_cache) >= _shape_cache_size:
+        _shape_cache.clear()
+    _shape_cache[text] = shape
+    return shape
+
+
+def statement_columns(statement) -> list:
+    """Returns the columns used by `statement` as `(table name, column name, operator)` tuples."""
+    if not hasattr(statement, "columns"):
+        return []
+    return [(p.cls._table_name, p.name, op) for (p, op) in statement.columns() if p.cls is not None]
+
+
+# Statistics
+# ==========
+
+latency_buckets = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, float("inf"))
+"""Upper bounds (in seconds) of the buckets of the latency histograms."""
+
+
+class StatementStats:
+    """Statistics for all statements of the same shape (see `normalize_sql`)."""
+    
+    def __init__(self, shape: str, cls: type = None, columns: list = ()):
+        self.shape = shape
+        self.cls = cls
+        self.columns = columns
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_time = 0.0
+        self.min_time = None
+        self.max_time = 0.0
+        self.histogram = [0] * len(latency_buckets)
+    
+    def record(self, elapsed: float, rows: int, error: Exception = None):
+        self.count += 1
+        if error is not None:
+            self.errors += 1
+        elif rows is not None and rows > 0:
+            self.rows += rows
+        self.total_time += elapsed
+        if self.min_time is None or elapsed < self.min_time:
+            self.min_time = elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+        for (i, bound) in enumerate(latency_buckets):
+            if elapsed <= bound:
+                self.histogram[i] += 1
+                break
+    
+    def percentile(self, q: float) -> float:
+        """Approximate the `q`-th percentile (0 < q <= 100) of the latency, as the upper bound of
+        the bucket it falls into.
+        """
+        
+        if self.count == 0:
+            return None
+        needed = self.count * q / 100
+        seen = 0
+        for (bound, n) in zip(latency_buckets, self.histogram):
+            seen += n
+            if seen >= needed:
+                return min(bound, self.max_time)
+        return self.max_time
+    
+    def as_dict(self) -> dict:
+        return collections.OrderedDict([
+            ("shape", self.shape),
+            ("class", self.cls.__name__ if self.cls is not None else None),
+            ("columns", ["{} {}".format(*c[1:]) if c[2] is not None else c[1] for c in self.columns]),
+            ("count", self.count),
+            ("errors", self.errors),
+            ("rows", self.rows),
+            ("total_time", self.total_time),
+            ("mean_time", self.total_time / self.count if self.count > 0 else None),
+            ("min_time", self.min_time),
+            ("max_time", self.max_time),
+            ("p50", self.percentile(50)),
+            ("p95", self.percentile(95)),
+            ("p99", self.percentile(99)),
+            ("histogram", list(zip(latency_buckets, self.histogram))),
+        ])
+
+
+class SlowQuery:
+    """A single entry in the slow query log. The data of the statement is not kept."""
+    
+    def __init__(self, shape: str, text: str, cls: type, elapsed: float, error: Exception = None):
+        self.shape = shape
+        self.text = text
+        self.cls = cls
+        self.elapsed = elapsed
+        self.error = error
+    
+    def __str__(self):
+        return "Slow query ({ms:.1f} ms, class {cls}): {s.text}".format(
+            s=self, ms=self.elapsed * 1000, cls=self.cls.__name__ if self.cls is not None else None)
+
+
+class QueryStats:
+    """Keeps per-statement statistics for a `Database`.
+    
+    Parameters:
+        - `slow_threshold`: Statements that take longer than this many seconds are put in the
+          slow query log (and logged to the `sparrow.slow_queries` logger). `None` disables
+          the slow query log.
+        - `slow_sample`: Fraction (between 0 and 1) of the slow statements that is logged.
+        - `slow_log_size`: How many slow queries are kept in `slow_queries`.
+    """
+    
+    def __init__(self, slow_threshold: float = None, slow_sample: float = 1.0, slow_log_size: int = 100):
+        self.slow_threshold = slow_threshold
+        self.slow_sample = slow_sample
+        self.statements = {}
+        self.slow_queries = collections.deque(maxlen=slow_log_size)
+    
+    def record(self, statement, text: str, elapsed: float, rows: int = None, error: Exception = None):
+        """Record one execution of `statement` (with `text` as its SQL)."""
+        shape = normalize_sql(text)
+        try:
+            stats = self.statements[shape]
+        except KeyError:
+            stats = self.statements[shape] = StatementStats(shape, getattr(statement, "cls", None),
+                                                            statement_columns(statement))
+        stats.record(elapsed, rows, error)
+        
+        if self.slow_threshold is not None and elapsed >= self.slow_threshold \
+                and (self.slow_sample >= 1 or random.random() < self.slow_sample):
+            slow = SlowQuery(shape, text, stats.cls, elapsed, error)
+            self.slow_queries.append(slow)
+            slow_query_logger.warning(str(slow))
+    
+    def report(self) -> list:
+        """Return the statistics of all statement shapes as dictionaries, the shapes that took
+        the most time in total first.
+        """
+        
+        return [s.as_dict() for s in sorted(self.statements.values(), key=lambda s: s.total_time, reverse=True)]
+    
+    def reset(self):
+        self.statements.clear()
+        self.slow_queries.clear()
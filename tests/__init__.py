@@ -0,0 +1,13 @@
+
+import asyncio
+
+
+def run(coro):
+    """Run `coro` on a fresh event loop and return its result."""
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(coro)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -0,0 +1,52 @@
+import datetime
+
+from sparrow import *
+
+from . import run
+
+
+class Sale(Entity):
+    shop = Property(str)
+    amount = Property(int)
+    sold = Property(datetime.datetime)
+    key = SID = KeyProperty()
+
+
+async def fill(db):
+    Sale.cache.clear()
+    await SparrowModel(None, {}, [Sale], db=db).install()
+    for (shop, amount) in [("a", 5), ("a", 7), ("b", 1), ("c", 10), ("c", 2)]:
+        await Sale(shop=shop, amount=amount, sold=datetime.datetime(2026, 10, amount)).insert(db)
+
+
+def test_count_and_exists():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        await fill(db)
+        assert await Sale.get().count(db) == 5
+        assert await Sale.get(Sale.amount > Unsafe(4)).count(db) == 3
+        assert await Sale.get().order(+Sale.amount).limit(2).offset(4).count(db) == 1
+        assert await Sale.get(Sale.shop == Unsafe("c")).exists(db)
+        assert not await Sale.get(Sale.shop == Unsafe("d")).exists(db)
+        assert str(Sale.get().limit(3).count_query()).startswith("SELECT COUNT(*) FROM (SELECT ")
+    run(main())
+
+
+def test_aggregates():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        await fill(db)
+        assert await Sale.get().aggregate(Sum(Sale.amount), Min(Sale.amount), Max(Sale.amount)).raw(db) == (25, 1, 10)
+        (n, mean) = await Sale.get(Sale.shop != Unsafe("b")).aggregate(Count(), Avg(Sale.amount)).raw(db)
+        assert (n, mean) == (4, 6.0)
+        per_shop = await Sale.get(Sale.amount > Unsafe(1)).aggregate(Count(), Sum(Sale.amount)).group_by(Sale.shop).raw_all(db)
+        assert [tuple(r) for r in per_shop] == [("a", 2, 12), ("c", 2, 12)]
+    run(main())
+
+
+def test_time_buckets():
+    query = Sale.get().aggregate(Count(Sale.SID)).group_by(Sale.sold, bucket="month")
+    assert str(query) == ("SELECT date_trunc('month', table_Sale.sold), COUNT(table_Sale.SID) FROM table_Sale "
+                          + "GROUP BY date_trunc('month', table_Sale.sold) ORDER BY date_trunc('month', table_Sale.sold)")
@@ -0,0 +1,81 @@
+import datetime
+
+import pytest
+
+from sparrow import *
+from sparrow import backend
+
+from . import run
+
+
+class Reading(Entity):
+    at = Property(datetime.datetime)
+    values = Property(List(float))
+    meta = Property(Json)
+    key = RID = KeyProperty()
+
+
+def test_numbered_placeholders():
+    assert numbered_placeholders("SELECT %(a)s, %(b)s, %(a)s WHERE x LIKE 'y%%'") == (
+        "SELECT $1, $2, $1 WHERE x LIKE 'y%'", ["a", "b"])
+    assert numbered_placeholders("VALUES (%(b)s, %(a)s)", "?") == ("VALUES (?1, ?2)", ["b", "a"])
+
+
+def test_results_of_statements():
+    assert [status_rowcount(s) for s in ("UPDATE 3", "INSERT 0 1", "CREATE TABLE", "")] == [3, 1, -1, -1]
+    assert returns_rows("  select 1") and returns_rows("INSERT INTO t (a) VALUES (1) RETURNING id")
+    assert not returns_rows("UPDATE t SET a = 1")
+    assert make_dsn(dict(dbname="d", user="u", password="p", host="h", port=1)) == "dbname=d user=u password=p host=h port=1"
+
+
+def test_copy_statements():
+    assert copy_statement(*postgres_copy("SELECT 1", "csv")) == "COPY (SELECT 1) TO STDOUT WITH (FORMAT csv, HEADER)"
+    assert copy_statement(*postgres_copy("SELECT 1", "ndjson")) == (
+        "COPY (SELECT row_to_json(_sparrow_row) FROM (SELECT 1) AS _sparrow_row) TO STDOUT "
+        + "WITH (DELIMITER E'\\x02', FORMAT csv, QUOTE E'\\x01')")
+
+
+def test_codec_registry():
+    codecs = CodecRegistry()
+    assert codecs.encode(Reading.meta.type, {"a": 1}) == {"a": 1}  # Nothing registered
+    codecs.register("json", encode=str, decode=eval)
+    codecs.register(datetime.datetime, encode=lambda d: d.year)
+    codecs.register(Reading.values.type, decode=lambda v: [float(x) for x in v.split()])
+    r = Reading(at=datetime.datetime(2026, 1, 1), values=[1.5], meta={"a": 1})
+    assert codecs.encode_object(r) == {"at": 2026, "values": [1.5], "meta": "{'a': 1}"}
+    row = codecs.decode_row(Reading, [None, "1 2", "{'b': 2}", 3])
+    assert row == [None, [1.0, 2.0], {"b": 2}, 3]
+    assert codecs.encode_key([Reading.at, Reading.RID], (datetime.datetime(2000, 1, 1), 5)) == (2000, 5)
+
+
+@pytest.mark.skipif(backend.asyncpg is not None, reason="asyncpg is installed")
+def test_asyncpg_is_optional():
+    with pytest.raises(ImportError):
+        AsyncpgBackend()
+
+
+class Connection:
+    """Records what `asyncpg_execute` sends, like an asyncpg connection."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def fetch(self, query, *args):
+        self.calls.append((query, args))
+        return [(1, "a")]
+
+    async def execute(self, query, *args):
+        self.calls.append((query, args))
+        return "UPDATE 2"
+
+
+def test_asyncpg_execute():
+    con = Connection()
+
+    async def main():
+        cursor = await asyncpg_execute(con, "SELECT * FROM t WHERE a = %(a)s AND b = %(b)s", {"b": 2, "a": 1})
+        assert cursor.fetchall() == [(1, "a")]
+        cursor = await asyncpg_execute(con, "UPDATE t SET a = %(a)s", {"a": 3})
+        assert cursor.rowcount == 2
+    run(main())
+    assert con.calls == [("SELECT * FROM t WHERE a = $1 AND b = $2", (1, 2)), ("UPDATE t SET a = $1", (3,))]
@@ -0,0 +1,17 @@
+import json
+
+from benchmarks.bench_orm import all_benchmarks
+from benchmarks.run import main
+
+
+def test_the_benchmarks_run(tmp_path, capsys):
+    # Only checks that every benchmark still works, with a few iterations each
+    before = str(tmp_path / "before.json")
+    main(["--scale", "0.001", "--repeat", "1", "--backend", "sqlite", "-o", before])
+    main(["--scale", "0.001", "--repeat", "1", "-k", "find_by_key", "--compare", before])
+    with open(before) as f:
+        results = json.load(f)["results"]
+    assert {b.name for b in all_benchmarks()} < set(results)
+    assert any(name.startswith("sqlite.") for name in results)
+    assert all(r["ops_per_sec"] > 0 and r["number"] >= 1 for r in results.values())
+    assert "ratio" in capsys.readouterr().out
@@ -0,0 +1,106 @@
+
+import asyncio
+
+from sparrow import *
+
+from . import run
+
+
+class Sample(Entity):
+    __write_buffer__ = WriteBuffer(window=0.01, max_size=8, updates=True)
+
+    sensor = Property(int)
+    value = Property(float)
+    key = SID = KeyProperty()
+
+
+class Label(Entity):
+    __write_buffer__ = WriteBuffer(window=0.01)
+
+    name = Property(str)
+    key = Key(name)
+
+
+def statements(db):
+    return sum(s.count for s in db.stats.statements.values())
+
+
+def test_buffered_inserts_get_their_own_keys():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        await SparrowModel(None, {}, [Sample], db=db).install()
+        samples = [Sample(sensor=i, value=i / 4) for i in range(20)]
+        before = statements(db)
+        await asyncio.gather(*[s.insert(db) for s in samples])
+        assert statements(db) - before == 3  # 8 + 8 + 4 rows
+        assert sorted(s.key for s in samples) == list(range(1, 21))
+        for s in samples:
+            (sensor,) = await RawSql("SELECT sensor FROM table_Sample WHERE SID = %(k)s", {"k": s.key}).raw(db)
+            assert sensor == s.sensor
+    run(main())
+
+
+def test_buffered_updates():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        await SparrowModel(None, {}, [Sample], db=db).install()
+        samples = [Sample(sensor=i, value=0.0) for i in range(10)]
+        await asyncio.gather(*[s.insert(db) for s in samples])
+        for s in samples:
+            s.value = s.sensor * 2.0
+        await asyncio.gather(*[s.update(db) for s in samples])
+        rows = await RawSql("SELECT sensor, value FROM table_Sample").raw_all(db)
+        assert sorted(rows) == [(i, i * 2.0) for i in range(10)]
+    run(main())
+
+
+def test_failing_row_only_fails_its_caller():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        await SparrowModel(None, {}, [Label], db=db).install()
+        results = await asyncio.gather(*[Label(name=n).insert(db) for n in ["a", "b", "a", "c"]],
+                                       return_exceptions=True)
+        assert [isinstance(r, SqlError) for r in results] == [False, False, True, False]
+        names = await RawSql("SELECT name FROM table_Label ORDER BY name").raw_all(db)
+        assert names == [("a",), ("b",), ("c",)]
+    run(main())
+
+
+def test_buffered_inserts_on_sharded_database():
+    shards = [Database(None, ":memory:", backend=SqliteBackend()) for _ in range(3)]
+    db = ShardedDatabase(shards)
+
+    async def main():
+        await SparrowModel(None, {}, [Label], db=db).install()
+        names = ["n{}".format(i) for i in range(12)]
+        await asyncio.gather(*[Label(name=n).insert(db) for n in names])
+        for n in names:
+            assert await Label.get(Label.name == Unsafe(n)).count(db.shard_for(Label, n)) == 1
+        assert await Label.get().count(db) == 12
+    run(main())
+
+
+def test_repeated_updates_write_the_latest_state():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        Sample.cache.clear()
+        await SparrowModel(None, {}, [Sample], db=db).install()
+        (s, a, b) = [Sample(sensor=i, value=0.0) for i in range(3)]
+        await asyncio.gather(s.insert(db), a.insert(db), b.insert(db))
+
+        async def update(obj, value):
+            obj.value = value
+            await obj.update(db)
+
+        before = statements(db)
+        await asyncio.gather(*[update(s, float(v)) for v in range(1, 6)] + [update(a, 9.0), update(b, 9.0)])
+        assert statements(db) - before == 1
+        assert ("update", 3) in Sample._write_buffer.statements  # One row per object
+        (value,) = await RawSql("SELECT value FROM table_Sample WHERE SID = %(k)s", {"k": s.key}).raw(db)
+        assert value == 5.0
+        assert len(Sample._write_buffer.pending) == 0
+    run(main())
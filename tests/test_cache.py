@@ -0,0 +1,120 @@
+from sparrow import *
+
+from . import run
+
+
+class Country(Entity):
+    __fully_cached__ = True
+
+    code = Property(str)
+    population = Property(int)
+    size = Property(Enum("small", "medium", "large", storage="smallint"))
+    key = CID = KeyProperty()
+
+    by_code = CacheIndex(code, sorted=True)
+    by_population = CacheIndex(population, sorted=True)
+    by_size = CacheIndex(size, sorted=True)
+
+
+countries = [("BE", 11, "small"), ("DE", 83, "large"), ("LU", 1, "small"), ("nl", 17, "medium"),
+             ("FR", 67, "large"), ("at", 9, "medium")]
+
+
+def queries():
+    return [
+        Country.get(Country.size < Unsafe("large")),
+        Country.get(Country.size >= Unsafe("medium")).order(-Country.population),
+        Country.get(Country.population > Unsafe(10)).order(Country.size).limit(2),
+        Country.get(Country.code == Unsafe("FR")),
+        Country.get().order(Country.population).limit(4).offset(1),
+    ]
+
+
+def test_cached_results_match_the_database():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        Country.cache.clear()
+        model = SparrowModel(None, {}, [Country], db=db)
+        await model.install()
+        for (code, population, size) in countries:
+            await Country(code=code, population=population, size=size).insert(db)
+        expected = [[c.code for c in await q.all(db)] for q in queries()]
+        await model.warm_caches(db)
+        before = sum(s.count for s in db.stats.statements.values())
+        cached = [[c.code for c in await q.all(db)] for q in queries()]
+        assert sum(s.count for s in db.stats.statements.values()) == before
+        for (c, e, q) in zip(cached, expected, queries()):
+            if q._order is None:
+                (c, e) = (sorted(c), sorted(e))
+            assert c == e, str(q)
+    run(main())
+
+
+def test_text_order_goes_to_the_database():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        Country.cache.clear()
+        model = SparrowModel(None, {}, [Country], db=db)
+        await model.install()
+        for (code, population, size) in countries:
+            await Country(code=code, population=population, size=size).insert(db)
+        await model.warm_caches(db)
+        for q in (Country.get().order(Country.code), Country.get(Country.code > Unsafe("B"))):
+            assert Country._full_cache.query(q) is None
+        assert Country._full_cache.query(Country.get().order(Country.size)) is not None
+    run(main())
+
+
+class City(Entity):
+    __fully_cached__ = True
+
+    name = Property(str)
+    country = Reference(Country)
+    key = CYID = KeyProperty()
+
+    by_country = CacheIndex(country)
+
+
+class Zone(Entity):
+    area = Property(int)
+    number = Property(int)
+    key = Key(area, number)
+
+
+class Stop(Entity):
+    __fully_cached__ = True
+
+    name = Property(str)
+    zone = Reference(Zone)
+    key = STID = KeyProperty()
+
+    by_zone = CacheIndex(zone)
+
+
+def test_references_are_looked_up_in_the_cache():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        Country.cache.clear()
+        model = SparrowModel(None, {}, [Country, City, Zone, Stop], db=db)
+        await model.install()
+        (be, fr) = (Country(code="BE", population=11, size="small"), Country(code="FR", population=67, size="large"))
+        await be.insert(db)
+        await fr.insert(db)
+        for (name, country) in [("Ghent", be), ("Paris", fr), ("Lille", fr), ("Liege", be), ("Nice", fr)]:
+            await City(name=name, country=country.key).insert(db)
+        for (area, number) in [(1, 1), (1, 2)]:
+            await Zone(area=area, number=number).insert(db)
+        for (name, zone) in [("a", (1, 1)), ("b", (1, 2)), ("c", (1, 2))]:
+            await Stop(name=name, zone=zone).insert(db)
+        queries = [City.get(City.country == Unsafe(fr.key)), Stop.get(Stop.zone == Unsafe((1, 2)))]
+        expected = [sorted([o.name for o in await q.all(db)]) for q in queries]
+        await model.warm_caches(db)
+        before = sum(s.count for s in db.stats.statements.values())
+        assert [sorted([o.name for o in await q.all(db)]) for q in queries] == expected
+        assert sum(s.count for s in db.stats.statements.values()) == before
+        assert len(City._full_cache.candidates(queries[0])) == 3  # Through the index
+        assert len(Stop._full_cache.candidates(queries[1])) == 2
+    run(main())
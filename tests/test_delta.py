@@ -0,0 +1,105 @@
+import copy
+import json
+
+from sparrow import *
+
+from . import run
+
+
+class Board(RTEntity):
+    name = Property(str)
+    tags = Property(Json)
+    secret = Property(str, json=False)
+    key = BID = KeyProperty()
+
+
+class Card(RTEntity):
+    title = Property(str)
+    done = Property(bool)
+    key = CID = KeyProperty()
+
+    def json_repr(self):
+        return {"title": self.title.upper(), "done": self.done, "cid": self.CID}
+
+
+class FieldListener(Listener):
+    def __init__(self):
+        self.deltas = []
+
+    def update_fields(self, obj, delta):
+        self.deltas.append((copy.deepcopy(delta.changes), json.loads(delta.json)))
+
+
+class PlainListener(Listener):
+    def __init__(self):
+        self.updates = []
+
+    def update(self, obj):
+        self.updates.append(obj)
+
+
+def test_delta_holds_the_changed_json_properties():
+    Board.cache.clear()
+    b = Board(name="todo", tags=["a"], secret="x", BID=1)
+    assert len(b.delta()) == 0
+    b.name = "doing"
+    b.secret = "y"
+    delta = b.delta()
+    assert delta.changes == {"name": ("todo", "doing")}
+    assert delta.values() == {"name": "doing"}
+    assert json.loads(delta.json) == {"name": "doing"}
+
+
+def test_listeners_get_what_changed_since_their_last_notification():
+    Board.cache.clear()
+    b = Board(name="todo", tags=["a"], secret="x", BID=2)
+    (fields, plain) = (FieldListener(), PlainListener())
+    b.add_listener(fields)
+    b.add_listener(plain)
+    b.name = "doing"
+    b.send_update()
+    b.send_update()
+    assert fields.deltas == [({"name": ("todo", "doing")}, {"name": "doing"}), ({}, {})]
+    assert plain.updates == [b, b]
+
+
+def test_in_place_changes_are_detected():
+    Board.cache.clear()
+    b = Board(name="todo", tags=["a"], secret="x", BID=3)
+    l = FieldListener()
+    b.add_listener(l)
+    b.tags.append("b")
+    b.send_update()
+    b.tags.append("c")
+    b.send_update()
+    assert l.deltas == [({"tags": (["a"], ["a", "b"])}, {"tags": ["a", "b"]}),
+                        ({"tags": (["a", "b"], ["a", "b", "c"])}, {"tags": ["a", "b", "c"]})]
+
+
+def test_json_follows_json_repr():
+    Card.cache.clear()
+    c = Card(title="write tests", done=False, CID=1)
+    l = FieldListener()
+    c.add_listener(l)
+    c.done = True
+    c.send_update()
+    c.title = "ship"
+    c.send_update()
+    assert [j for (changes, j) in l.deltas] == [{"done": True}, {"title": "SHIP"}]
+
+
+def test_update_notifies_the_listeners():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        Card.cache.clear()
+        await SparrowModel(None, {}, [Card], db=db).install()
+        c = Card(title="a", done=False)
+        await c.insert(db)
+        l = FieldListener()
+        c.add_listener(l)
+        c.done = True
+        await c.update(db)
+        assert l.deltas == [({"done": (False, True)}, {"done": True})]
+        assert (await Card.find_by_key(c.CID, db)).done is True
+    run(main())
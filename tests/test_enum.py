@@ -0,0 +1,48 @@
+import pytest
+
+from sparrow import *
+
+from . import run
+
+
+class Job(Entity):
+    states = Enum("queued", "running", "failed", "done", storage="smallint")
+    state = Property(states)
+    name = Property(str)
+    key = JID = KeyProperty()
+
+
+def test_smallint_storage():
+    assert Job.states.sql_type == "SMALLINT"
+    assert "state SMALLINT NOT NULL" in str(Job._create_table_command)
+    assert Job.states not in Job._enums  # No Postgres type to create
+    with pytest.raises(PropertyConstraintFail):
+        Job(state="lost", name="x")
+    with pytest.raises(PropertyConstraintFail):
+        Job(state=["done"], name="x")
+    with pytest.raises(AssertionError):
+        Enum("a", storage="text")
+
+
+def test_smallint_round_trip():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        Job.cache.clear()
+        await SparrowModel(None, {}, [Job], db=db).install()
+        for (i, state) in enumerate(["done", "queued", "failed", "done"]):
+            await Job(state=state, name="j{}".format(i)).insert(db)
+        stored = await RawSql("SELECT state FROM table_Job ORDER BY JID").raw_all(db)
+        assert [s for (s,) in stored] == [3, 0, 2, 3]
+        Job.cache.clear()
+        jobs = await Job.get().order(+Job.JID).all(db)
+        assert [j.state for j in jobs] == ["done", "queued", "failed", "done"]
+        jobs[1].state = "running"
+        await jobs[1].update(db)
+        del jobs
+        Job.cache.clear()
+        assert [j.name for j in await Job.get(Job.state == Unsafe("done")).order(+Job.JID).all(db)] == ["j0", "j3"]
+        # Positions follow the order of the options
+        assert {j.name for j in await Job.get(Job.state < Unsafe("failed")).all(db)} == {"j1"}
+        assert (await Job.find_by_key(2, db)).state == "running"
+    run(main())
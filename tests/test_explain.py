@@ -0,0 +1,55 @@
+import datetime
+
+from sparrow import *
+
+
+class Visit(Entity):
+    when = Property(datetime.datetime)
+    tags = Property(List(str))
+    level = Property(Enum("low", "high", storage="smallint"))
+    key = Key(when)
+
+
+def test_example_data():
+    codecs = SqliteBackend().codecs
+    assert example_data(Visit._update_command, codecs) == {"when": "2000-01-01 00:00:00", "tags": "[]", "level": 0}
+    assert example_data(Visit._find_by_key_query) == {"key": datetime.datetime(2000, 1, 1)}
+    query = Visit.get(Visit.when > Unsafe(datetime.datetime(2026, 1, 1)))
+    assert example_data(query) == query.data  # Nothing is missing
+    assert example_data(Visit.raw("SELECT * FROM table_Visit WHERE x = %(other)s")) == {"other": None}
+
+
+plan = {"Node Type": "Limit", "Plans": [
+    {"Node Type": "Nested Loop", "Plans": [
+        {"Node Type": "Seq Scan", "Relation Name": "table_visit"},
+        {"Node Type": "Index Scan", "Relation Name": "table_note", "Index Name": "table_note_pkey"}]}]}
+
+
+def test_plan_shape():
+    assert plan_shape(plan) == "Limit(Nested Loop(Seq Scan[table_visit], Index Scan[table_note]{table_note_pkey}))"
+    assert [n["Node Type"] for n in plan_nodes(plan)] == ["Limit", "Nested Loop", "Seq Scan", "Index Scan"]
+
+
+def entry(plan, cost, large=()):
+    return {"class": "Visit", "plan": plan, "startup_cost": 0.0, "total_cost": cost, "plan_rows": 1,
+            "seq_scans": list(large), "large_seq_scans": list(large)}
+
+
+def test_compare_plan_catalogs():
+    old = {"statements": {
+        "SELECT a": entry("Index Scan[t]{t_pkey}", 8.0),
+        "SELECT b": entry("Index Scan[t]{t_b}", 10.0),
+        "SELECT c": {"class": None, "error": "syntax error"},
+        "SELECT gone": entry("Result", 0.0)}}
+    new = {"statements": {
+        "SELECT a": entry("Index Scan[t]{t_pkey}", 9.0),
+        "SELECT b": entry("Seq Scan[t]", 100.0, ["t"]),
+        "SELECT c": {"class": None, "error": "syntax error"},
+        "SELECT d": entry("Result", 0.0)}}
+    assert sorted(compare_plan_catalogs(old, new)) == sorted([
+        "Plan changed for SELECT b: Index Scan[t]{t_b} -> Seq Scan[t]",
+        "Cost of SELECT b grew from 10.0 to 100.0",
+        "New sequential scan on large table t in SELECT b",
+        "New statement: SELECT d",
+        "Removed statement: SELECT gone"])
+    assert compare_plan_catalogs(new, new) == []
@@ -0,0 +1,65 @@
+import csv
+import io
+import json
+
+from sparrow import *
+
+from . import run
+
+
+class Product(Entity):
+    name = Property(str)
+    price = Property(float)
+    stock = Property(bool)
+    tags = Property(List(str))
+    specs = Property(Json)
+    size = Property(Enum("S", "M", "L", storage="smallint"))
+    secret = Property(str, json=False)
+    key = PID = KeyProperty()
+
+
+class Sink:
+    def __init__(self):
+        self.chunks = []
+
+    async def write(self, chunk):
+        self.chunks.append(chunk)
+
+    def text(self):
+        return b"".join(self.chunks).decode()
+
+
+async def fill(db):
+    Product.cache.clear()
+    await SparrowModel(None, {}, [Product], db=db).install()
+    await Product(name="mug", price=4.5, stock=True, tags=["kitchen", "a b"], specs={"ml": 300},
+                  size="M", secret="x").insert(db)
+    await Product(name='"lamp"', price=20.0, stock=False, tags=[], specs=[1, None], size="L", secret="y").insert(db)
+
+
+def test_csv_export():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        await fill(db)
+        sink = Sink()
+        await Product.get().order(+Product.PID).export(sink, "csv", db)
+        rows = list(csv.reader(io.StringIO(sink.text())))
+        assert rows == [["name", "price", "stock", "tags", "specs", "size", "secret", "PID"],
+                        ["mug", "4.5", "t", '{kitchen,"a b"}', '{"ml": 300}', "M", "x", "1"],
+                        ['"lamp"', "20.0", "f", "{}", "[1, null]", "L", "y", "2"]]
+    run(main())
+
+
+def test_ndjson_export():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        await fill(db)
+        sink = Sink()
+        await Product.get(Product.stock == Unsafe(True)).export(sink, "ndjson", db)
+        [line] = sink.text().splitlines()
+        mug = await Product.find_by_key(1, db)
+        assert json.loads(line) == mug.json_repr()
+        assert "secret" not in json.loads(line)
+    run(main())
@@ -0,0 +1,85 @@
+import pytest
+
+from sparrow import *
+
+from . import run
+
+
+class Person(Entity):
+    first = Property(str)
+    last = Property(str)
+    mail = Property(str, unique=True)
+    active = Property(bool, index=True)
+    key = PID = KeyProperty()
+
+    by_name = Index(last, first)
+    active_mail = Index("lower(mail)", unique=True, where="active")
+
+
+class Post(Entity):
+    __index_references__ = True
+    author = Reference(Person)
+    editor = Reference(Person, index=False)
+    key = POID = KeyProperty()
+
+
+class Like(Entity):
+    post = Reference(Post)
+    who = Reference(Person, index=True)
+    key = Key(post, who)
+
+
+def test_index_declarations():
+    assert [str(s) for s in Person._create_index_commands] == [
+        "CREATE INDEX table_Person_by_name_idx ON table_Person (last, first)",
+        "CREATE UNIQUE INDEX table_Person_active_mail_idx ON table_Person ((lower(mail))) WHERE active",
+        "CREATE UNIQUE INDEX table_Person_mail_idx ON table_Person (mail)",
+        "CREATE INDEX table_Person_active_idx ON table_Person (active)"]
+    assert str(Person._drop_index_commands[0]) == "DROP INDEX IF EXISTS table_Person_by_name_idx"
+    assert list(Index(Like.key, "x + 1").column_names()) == ["post_POID", "who_PID", None]
+
+
+def test_references_are_indexed():
+    assert [str(s) for s in Post._create_index_commands] == ["CREATE INDEX table_Post_author_idx ON table_Post (author_PID)"]
+    assert [str(s) for s in Like._create_index_commands] == ["CREATE INDEX table_Like_who_idx ON table_Like (who_PID)"]
+
+
+def test_long_index_names_are_shortened():
+    name = index_name("table_" + "x" * 40, "y" * 30)
+    assert len(name) == 63
+    assert name != index_name("table_" + "x" * 40, "y" * 29 + "z")
+    assert index_name("table_T", "a") == "table_T_a_idx"
+
+
+def test_unique_indexes_are_installed():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        Person.cache.clear()
+        await SparrowModel(None, {}, [Person, Post, Like], db=db).install()
+        await Person(first="a", last="b", mail="a@b", active=True).insert(db)
+        with pytest.raises(SqlError):
+            await Person(first="c", last="d", mail="a@b", active=False).insert(db)
+        names = {n for (n,) in await RawSql("SELECT name FROM sqlite_master WHERE type = 'index'").raw_all(db)}
+        assert {"table_Person_by_name_idx", "table_Post_author_idx", "table_Like_who_idx"} <= names
+    run(main())
+
+
+def test_suggested_index():
+    query = Person.get(Person.active == Unsafe(True), Person.last > Unsafe("m")).order(+Person.first)
+    columns = [(name, op) for (table, name, op) in statement_columns(query)]
+    assert suggested_index(columns) == (("active", "last", "first"), 1)
+    assert suggested_index([("a", "<"), ("b", "IN"), ("a", "DESC"), ("c", None)]) == (("b", "a", "c"), 1)
+
+
+def test_index_covers():
+    assert index_covers(["active", "last"], ("active", "last", "first"), 1)
+    assert index_covers(["b", "a", "x"], ("a", "b"), 2)
+    assert not index_covers(["a"], ("a", "b"), 2)
+    assert not index_covers(["last", "active"], ("active", "last"), 1)
+    assert index_covers(["last"], ("last",), 0) and not index_covers([], ("last",), 0)
+
+
+def test_index_columns():
+    assert index_columns("CREATE INDEX i ON public.t USING btree (lower((mail)::text), \"Last\" DESC, first)") == [
+        "lower((mail)::text)", "last", "first"]
@@ -0,0 +1,74 @@
+import pytest
+
+from sparrow import *
+
+from . import run
+
+
+class Customer(Entity):
+    name = Property(str)
+    key = CUID = KeyProperty()
+
+
+class Purchase(Entity):
+    total = Property(int)
+    paid = Property(bool)
+    customer = Reference(Customer)
+    key = PUID = KeyProperty()
+
+
+class Refund(Entity):
+    reason = Property(str)
+    purchase = Reference(Purchase)
+    key = RID = KeyProperty()
+
+
+async def fill(db):
+    for c in (Customer, Purchase, Refund):
+        c.cache.clear()
+    await SparrowModel(None, {}, [Customer, Purchase, Refund], db=db).install()
+    (ann, bob, cy) = customers = [Customer(name=n) for n in ("ann", "bob", "cy")]
+    for c in customers:
+        await c.insert(db)
+    purchases = [Purchase(total=t, paid=p, customer=c.key) for (t, p, c) in
+                 [(10, True, ann), (20, False, ann), (30, False, bob)]]
+    for p in purchases:
+        await p.insert(db)
+    await Refund(reason="broken", purchase=purchases[1].key).insert(db)
+    return (customers, purchases)
+
+
+def test_join_along_a_reference():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        (customers, purchases) = await fill(db)
+        rows = await Purchase.get(Purchase.paid == Unsafe(False)).join(Purchase.customer).order(+Purchase.total).all(db)
+        assert [(p.total, c.name) for (p, c) in rows] == [(20, "ann"), (30, "bob")]
+        assert rows[0][0] is purchases[1] and rows[0][1] is customers[0]  # From the cache
+        rows = await Refund.get().join(Refund.purchase).join(Purchase.customer).all(db)
+        assert [(r.reason, p.total, c.name) for (r, p, c) in rows] == [("broken", 20, "ann")]
+    run(main())
+
+
+def test_outer_join_from_the_referenced_class():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        await fill(db)
+        Customer.cache.clear()
+        Purchase.cache.clear()
+        rows = await Customer.get().join(Purchase.customer, outer=True).all(db)
+        assert sorted([(c.name, p.total if p is not None else 0) for (c, p) in rows]) == [
+            ("ann", 10), ("ann", 20), ("bob", 30), ("cy", 0)]
+        rows = await Customer.get().join(Purchase.customer).all(db)
+        assert len(rows) == 3
+        assert len({id(c) for (c, p) in rows if c.name == "ann"}) == 1  # The same object for every row
+    run(main())
+
+
+def test_join_needs_a_class_of_the_query():
+    with pytest.raises(ValueError):
+        Refund.get().join(Purchase.customer)
+    with pytest.raises(ValueError):
+        Purchase.get().join(Purchase.customer).join(Purchase.customer)
@@ -0,0 +1,49 @@
+from sparrow import *
+
+from . import run
+
+
+def define():
+    class Tag(Entity):
+        label = Property(str)
+        key = TGID = KeyProperty()
+
+    class Tagging(Entity):
+        tag = Reference(Tag)
+        target = Property(int)
+        key = Key(tag, target)
+
+    return (Tag, Tagging)
+
+
+def built(cls) -> set:
+    return {k for k in lazy_statements if not isinstance(cls.__dict__.get(k, lazy_statements[k]), LazyStatement)}
+
+
+def test_statements_are_built_on_first_use():
+    (Tag, Tagging) = define()
+    assert built(Tag) == set() and built(Tagging) == set()
+    insert = Tag._insert_command
+    assert str(insert).startswith("INSERT INTO table_Tag (label) VALUES")
+    assert Tag._insert_command is insert
+    assert built(Tag) == {"_insert_command"} and built(Tagging) == set()
+    assert "table_Tagging" in str(Tagging._find_by_key_query)
+    profile = SparrowModel(None, {}, [Tag, Tagging], db=object()).class_profile()
+    assert {p["class"]: p["statements_built"] for p in profile} == {"Tag": 1, "Tagging": 1}
+    assert all(p["define_time"] > 0 and p["statements_time"] > 0 for p in profile)
+
+
+def test_lazy_statements_work_with_a_database():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+    (Tag, Tagging) = define()
+
+    async def main():
+        await SparrowModel(None, {}, [Tag, Tagging], db=db).install()
+        t = Tag(label="x")
+        await t.insert(db)
+        await Tagging(tag=t.key, target=3).insert(db)
+        Tagging.cache.clear()
+        assert (await Tagging.find_by_key((t.key, 3), db)).target == 3
+        await t.delete(db)
+        assert await Tag.get().count(db) == 0
+    run(main())
@@ -0,0 +1,150 @@
+from sparrow import *
+
+from . import run
+
+
+class Task(Entity):
+    title = Property(str)
+    state = Property(Enum("new", "running", "done", storage="smallint"))
+    priority = Property(int)
+    key = TID = KeyProperty()
+
+
+class Recorder(QueryListener):
+    def __init__(self, attr="title"):
+        self.attr = attr
+        self.members = set()
+        self.events = []
+
+    def snapshot(self, objs):
+        self.members = {getattr(o, self.attr) for o in objs}
+
+    def added(self, obj):
+        self.members.add(getattr(obj, self.attr))
+        self.events.append(("added", getattr(obj, self.attr)))
+
+    def changed(self, obj):
+        self.events.append(("changed", getattr(obj, self.attr)))
+
+    def removed(self, obj):
+        self.members.discard(getattr(obj, self.attr))
+        self.events.append(("removed", getattr(obj, self.attr)))
+
+
+async def titles(query, db):
+    return {t.title for t in await query.all(db)}
+
+
+def test_predicate_matches_the_database():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+    queries = [
+        Task.get(Task.state < Unsafe("running")),  # "new" < "running", but also "done" as text
+        Task.get(Task.state >= Unsafe("running")),
+        Task.get(Task.state != Unsafe("done"), Task.priority > Unsafe(1)),
+        Task.get(Task.priority <= Unsafe(2)),
+    ]
+
+    async def main():
+        await SparrowModel(None, {}, [Task], db=db).install()
+        tasks = [Task(title="t{}".format(i), state=s, priority=i % 4)
+                 for (i, s) in enumerate(["new", "running", "done"] * 3)]
+        for t in tasks:
+            await t.insert(db)
+        for q in queries:
+            pred = q.predicate()
+            assert {t.title for t in tasks if pred(t)} == await titles(q, db)
+    run(main())
+
+
+def test_text_ranges_go_to_the_database():
+    for q in (Task.get(Task.title < Unsafe("b")), Task.get(Unsafe("b") >= Task.title)):
+        try:
+            q.predicate()
+        except CantEvaluate:
+            pass
+        else:
+            assert False, "Text ranges depend on the collation of the database"
+    Task.get(Task.title == Unsafe("b")).predicate()
+
+
+def test_subscription_follows_the_query():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+    query = Task.get(Task.state <= Unsafe("running"), Task.priority > Unsafe(0))
+
+    async def main():
+        Task.cache.clear()
+        await SparrowModel(None, {}, [Task], db=db).install()
+        (a, b, c) = [Task(title=n, state="new", priority=1) for n in "abc"]
+        await a.insert(db)
+        listener = Recorder()
+        sub = await query.subscribe(listener, db)
+        await b.insert(db)
+        c.state = "done"
+        await c.insert(db)
+        a.state = "running"
+        await a.update(db)
+        b.state = "done"
+        await b.update(db)
+        c.state = "running"
+        await c.update(db)
+        await a.delete(db)
+        assert listener.events == [("added", "b"), ("changed", "a"), ("removed", "b"),
+                                   ("added", "c"), ("removed", "a")]
+        assert listener.members == await titles(query, db) == {"c"}
+        sub.cancel()
+    run(main())
+
+
+class Team(Entity):
+    name = Property(str)
+    key = TID = KeyProperty()
+
+
+class Member(Entity):
+    name = Property(str)
+    team = Reference(Team)
+    key = MID = KeyProperty()
+
+
+class Shift(Entity):
+    day = Property(int)
+    slot = Property(int)
+    key = Key(day, slot)
+
+
+class Assignment(Entity):
+    who = Property(str)
+    shift = Reference(Shift)
+    key = AID = KeyProperty()
+
+
+def test_subscription_on_a_reference():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        Team.cache.clear()
+        await SparrowModel(None, {}, [Team, Member], db=db).install()
+        (red, blue) = (Team(name="red"), Team(name="blue"))
+        await red.insert(db)
+        await blue.insert(db)
+        query = Member.get(Member.team == Unsafe(red.key))
+        assert query.equalities() == [(Member.team.single_prop, red.key)]
+        listener = Recorder("name")
+        sub = await query.subscribe(listener, db)
+        assert Member._live.index_entry(sub) is not None  # Indexed, not scanned
+        ann = Member(name="ann", team=red.key)
+        await ann.insert(db)
+        await Member(name="bob", team=blue.key).insert(db)
+        ann.team = blue.key
+        await ann.update(db)
+        assert listener.events == [("added", "ann"), ("removed", "ann")]
+        sub.cancel()
+    run(main())
+
+
+def test_composite_reference_conditions():
+    query = Assignment.get(Assignment.shift == Unsafe((3, 2)))
+    assert sorted([(p.name, v) for (p, v) in query.equalities()]) == [("shift_day", 3), ("shift_slot", 2)]
+    pred = query.predicate()
+    assert pred(Assignment(who="ann", shift=(3, 2)))
+    assert not pred(Assignment(who="bob", shift=(3, 1)))
@@ -0,0 +1,70 @@
+import datetime
+
+from sparrow import *
+
+from . import run
+
+
+class Post(Entity):
+    sent = Property(datetime.datetime)
+    score = Property(int)
+    edited = Property(datetime.datetime, required=False)
+    key = PID = KeyProperty()
+
+
+async def posts(db, n):
+    Post.cache.clear()
+    await SparrowModel(None, {}, [Post], db=db).install()
+    start = datetime.datetime(2026, 1, 1)
+    for i in range(n):
+        await Post(sent=start + datetime.timedelta(hours=i // 2), score=i % 3, edited=None).insert(db)
+
+
+def test_pages_cover_all_rows_once():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        await posts(db, 23)
+        query = Post.get().order(-Post.sent)
+        expected = [p.key for p in await query.copy().after(None).all(db)]  # With the key as tie-breaker
+        seen = []
+        async for page in query.pages(5, db):
+            assert len(page) <= 5
+            seen.extend([p.key for p in page])
+        assert seen == expected and len(set(seen)) == 23
+        back = await query.copy().before(await Post.find_by_key(seen[10], db)).limit(4).all(db)
+        assert [p.key for p in back] == seen[6:10]
+    run(main())
+
+
+def test_nullable_orderings_are_refused():
+    try:
+        Post.get().order(+Post.edited).after(None)
+    except AssertionError:
+        pass
+    else:
+        assert False, "Rows with NULL would be skipped"
+
+
+class Job(Entity):
+    level = Property(Enum("low", "normal", "urgent", storage="smallint"))
+    name = Property(str)
+    key = JID = KeyProperty()
+
+
+def test_seek_on_enums_uses_their_positions():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        Job.cache.clear()
+        await SparrowModel(None, {}, [Job], db=db).install()
+        for (i, level) in enumerate(["urgent", "low", "normal"] * 4):
+            await Job(level=level, name="j{}".format(i)).insert(db)
+        query = Job.get().order(-Job.level)
+        pages = []
+        async for page in query.pages(5, db):
+            pages.append([j.level for j in page])
+        assert sum(pages, []) == ["urgent"] * 4 + ["normal"] * 4 + ["low"] * 4
+        after = await Job.get().order(+Job.level).after(("normal", 0)).all(db)
+        assert [j.level for j in after] == ["normal"] * 4 + ["urgent"] * 4
+    run(main())
@@ -0,0 +1,83 @@
+import datetime
+
+from sparrow import *
+
+
+class Event(Entity):
+    created = Property(datetime.datetime)
+    eid = Property(int)
+    key = Key(eid, created)
+
+    __partition__ = RangePartition(created, interval="1 month", premake=2, keep=3)
+
+
+class Visit(Entity):
+    region = Property(str)
+    vid = Property(int)
+    key = Key(vid, region)
+
+    __partition__ = ListPartition(region, {"eu": ["be", "nl"], "us": ["us"]}, default=True)
+
+
+def test_period_start():
+    week = RangePartition(Event.created, "1 week")
+    assert week.period_start(datetime.date(2026, 10, 18)) == datetime.date(2026, 10, 12)  # A Sunday
+    assert week.period_start(datetime.date(2026, 10, 19)) == datetime.date(2026, 10, 19)  # A Monday
+    quarter = RangePartition(Event.created, "3 months")
+    assert quarter.period_start(datetime.date(2026, 12, 31)) == datetime.date(2026, 10, 1)
+    assert quarter.next_start(datetime.date(2026, 10, 1)) == datetime.date(2027, 1, 1)
+    year = RangePartition(Event.created, "1 year")
+    assert year.period_start(datetime.date(2026, 10, 18)) == datetime.date(2026, 1, 1)
+
+
+def test_range_partitions():
+    p = RangePartition(Event.created, "1 month", premake=2, default=True)
+    assert p.partitions("t", datetime.datetime(2026, 11, 30, 23, 59)) == [
+        ("t_p20261101", "FOR VALUES FROM ('2026-11-01') TO ('2026-12-01')"),
+        ("t_p20261201", "FOR VALUES FROM ('2026-12-01') TO ('2027-01-01')"),
+        ("t_p20270101", "FOR VALUES FROM ('2027-01-01') TO ('2027-02-01')"),
+        ("t_default", "DEFAULT")]
+    weeks = RangePartition(Event.created, "2 weeks", premake=0)
+    [(name, bound)] = weeks.partitions("t", datetime.date(2026, 10, 18))
+    assert bound == "FOR VALUES FROM ('{}') TO ('{}')".format(
+        weeks.period_start(datetime.date(2026, 10, 18)), weeks.period_start(datetime.date(2026, 10, 18)) + datetime.timedelta(days=14))
+
+
+def test_expired_partitions():
+    p = Event._partitioning
+    names = ["table_event_p20260501", "table_event_p20260601", "table_event_p20260701", "table_event_p20261001",
+             "table_event_default", "table_event_archive"]
+    assert p.expired("table_Event", names, datetime.date(2026, 10, 18)) == ["table_event_p20260501", "table_event_p20260601"]
+    assert RangePartition(Event.created).expired("table_Event", names) == []
+
+
+def test_list_and_hash_partitions():
+    assert Visit._partitioning.partitions("t") == [
+        ("t_eu", "FOR VALUES IN ('be', 'nl')"), ("t_us", "FOR VALUES IN ('us')"), ("t_default", "DEFAULT")]
+    assert [bound for (name, bound) in HashPartition(Visit.vid, 2).partitions("t")] == [
+        "FOR VALUES WITH (MODULUS 2, REMAINDER 0)", "FOR VALUES WITH (MODULUS 2, REMAINDER 1)"]
+
+
+def test_partition_commands_follow_the_date():
+    (before, after) = (datetime.date(2026, 10, 31), datetime.date(2026, 11, 1))
+    assert [name for (name, command) in Event._create_partition_commands(before)] == [
+        "table_Event_p20261001", "table_Event_p20261101", "table_Event_p20261201"]
+    [(name, command)] = Event._create_partition_commands(after)[-1:]
+    assert name == "table_Event_p20270101"
+    assert "FOR VALUES FROM ('2027-01-01') TO ('2027-02-01')" in str(command)
+    changes = plan_schema([Event], ExistingSchema({}, {}, set()), after)
+    assert [str(ch) for ch in changes] == ["Create table table_Event", "Create partition table_Event_p20261101",
+                                           "Create partition table_Event_p20261201", "Create partition table_Event_p20270101"]
+
+
+def test_plan_partitions():
+    now = datetime.date(2026, 10, 18)
+    existing = ["table_event_p20260601", "table_event_p20260701", "table_event_p20261001"]
+    changes = plan_partitions(Event, existing, now)
+    assert [str(ch) for ch in changes] == ["Create partition table_Event_p20261101", "Create partition table_Event_p20261201",
+                                           "Detach partition table_event_p20260601"]
+    assert str(changes[-1].statement) == "ALTER TABLE table_Event DETACH PARTITION table_event_p20260601"
+    changes = plan_partitions(Event, existing, now, drop=True)
+    assert str(changes[-1]) == "Drop partition table_event_p20260601"
+    assert str(changes[-1].statement) == "DROP TABLE table_event_p20260601"
+    assert plan_partitions(Visit, ["table_visit_eu", "table_visit_us", "table_visit_default"]) == []
@@ -0,0 +1,108 @@
+from sparrow import *
+
+from . import run
+
+
+class Thread(Entity):
+    title = Property(str)
+    key = THID = KeyProperty()
+
+
+class Comment(Entity):
+    author = Property(str)
+    n = Property(int)
+    thread = Reference(Thread)
+    key = CID = KeyProperty()
+
+
+class Desk(Entity):
+    floor = Property(int)
+    number = Property(int)
+    key = Key(floor, number)
+
+
+class Badge(Entity):
+    owner = Property(str)
+    desk = Reference(Desk)
+    key = BID = KeyProperty()
+
+
+async def fill(db):
+    for c in (Thread, Comment, Desk, Badge):
+        c.cache.clear()
+    await SparrowModel(None, {}, [Thread, Comment, Desk, Badge], db=db).install()
+    threads = [Thread(title=t) for t in ("a", "b", "c")]
+    for t in threads:
+        await t.insert(db)
+    for i in range(6):
+        await Comment(author="ann" if i % 3 == 0 else "bob", n=i, thread=threads[i % 2].key).insert(db)
+    for (floor, number) in [(1, 1), (1, 2), (2, 1)]:
+        await Desk(floor=floor, number=number).insert(db)
+    return threads
+
+
+def test_load_referencing():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        (a, b, c) = await fill(db)
+        comments = await Comment.thread.load_referencing([b, a, c, a], db=db)
+        assert list(comments) == [b.key, a.key, c.key]
+        assert {k: [x.n for x in v] for (k, v) in comments.items()} == {a.key: [0, 2, 4], b.key: [1, 3, 5], c.key: []}
+        latest = await Comment.thread.load_referencing([a, b], order=-Comment.n, limit=2, db=db)
+        assert {k: [x.n for x in v] for (k, v) in latest.items()} == {a.key: [4, 2], b.key: [5, 3]}
+        assert await Comment.thread.load_referencing([], db=db) == {}
+    run(main())
+
+
+def test_load_referencing_with_data_in_the_order():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        (a, b, c) = await fill(db)
+        ann_first = Order(Comment.author == Unsafe("ann"), "DESC")
+        first = await Comment.thread.load_referencing([a, b], order=ann_first, limit=1, db=db)
+        assert {k: [x.author for x in v] for (k, v) in first.items()} == {a.key: ["ann"], b.key: ["ann"]}
+    run(main())
+
+
+def test_load_referencing_composite_keys():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        await fill(db)
+        for (owner, desk) in [("x", (1, 2)), ("y", (2, 1)), ("z", (1, 2))]:
+            await Badge(owner=owner, desk=desk).insert(db)
+        desks = await Desk.get().order(+Desk.floor).all(db)
+        badges = await Badge.desk.load_referencing(desks, order=+Badge.owner, db=db)
+        assert {k: [x.owner for x in v] for (k, v) in badges.items()} == {(1, 1): [], (1, 2): ["x", "z"], (2, 1): ["y"]}
+    run(main())
+
+
+def test_prefetch():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        await fill(db)
+        Thread.cache.clear()
+        comments = await Comment.get().prefetch(Comment.thread).all(db)
+        assert sorted([Comment.thread.resolve(c).title for c in comments]) == ["a", "a", "a", "b", "b", "b"]
+        for (owner, desk) in [("x", (1, 2)), ("y", (2, 1))]:
+            await Badge(owner=owner, desk=desk).insert(db)
+        Desk.cache.clear()
+        badges = await Badge.get().order(+Badge.owner).prefetch(Badge.desk).all(db)
+        assert [Badge.desk.resolve(b).key for b in badges] == [(1, 2), (2, 1)]
+    run(main())
+
+
+def test_prefetch_skips_empty_references():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        await fill(db)
+        Badge.desk._prefetch_query = None
+        badge = Badge(owner="w", desk=(None, None))
+        await Badge.desk.prefetch([badge], db)
+        assert Badge.desk._prefetch_query is None  # No query was needed
+        assert Badge.desk.resolve(badge) is None
+    run(main())
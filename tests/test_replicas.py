@@ -0,0 +1,61 @@
+from sparrow import *
+
+from . import run
+
+
+class Note(Entity):
+    text = Property(str)
+    key = NID = KeyProperty()
+
+
+async def setup(tmp_path, **kwargs):
+    """A primary and two replicas, each in its own file with a note saying where it is."""
+    names = ["primary", "r1", "r2"]
+    for name in names:
+        single = Database(None, str(tmp_path / name), backend=SqliteBackend())
+        await SparrowModel(None, {}, [Note], db=single).install()
+        await RawSql("INSERT INTO table_Note (text) VALUES (%(text)s)", {"text": name}).exec(single)
+    return Database(None, str(tmp_path / "primary"), backend=SqliteBackend(),
+                    replicas=[str(tmp_path / n) for n in names[1:]], **kwargs)
+
+
+async def where(db):
+    Note.cache.clear()
+    return (await Note.get().order(+Note.NID).limit(1).single(db)).text
+
+
+def test_reads_go_round_the_replicas(tmp_path):
+    async def main():
+        db = await setup(tmp_path)
+        assert [await where(db) for i in range(4)] == ["r1", "r2", "r1", "r2"]
+        assert await Note.get().count(db) == 1  # Also a read
+        await Note(text="new").insert(db)
+        (count,) = await RawSql("SELECT COUNT(*) FROM table_Note").raw(db)
+        assert count == 1
+        (count,) = await RawSql("SELECT COUNT(*) FROM table_Note", read_only=False).raw(db)
+        assert count == 2
+    run(main())
+
+
+def test_sessions_read_their_writes(tmp_path):
+    async def main():
+        db = await setup(tmp_path, sticky_window=60)
+        session = db.session()
+        assert await where(session) == "r1"
+        await Note(text="new").insert(session)
+        assert await where(session) == "primary"
+        assert await where(db) == "r2"
+        session.last_write -= 61
+        assert await where(session) == "r1"
+        async with db.transaction() as t:
+            assert await where(t) == "primary"
+    run(main())
+
+
+def test_without_replicas_everything_goes_to_the_primary():
+    db = Database(None, ":memory:", backend=SqliteBackend(), load_balancer=RandomReplica())
+    assert db.choose_pool(Note.get()) is db.pdb
+    assert db.choose_pool(RawSql("DELETE FROM table_Note")) is db.pdb
+    assert reads_only(" select * from table_Note")
+    assert not reads_only("SELECT * FROM table_Note FOR UPDATE")
+    assert not reads_only("SELECT * INTO backup FROM table_Note")
@@ -0,0 +1,32 @@
+from sparrow import *
+
+
+class Account(Entity):
+    plans = Enum("free", "pro", "team")
+    plan = Property(plans)
+    owner = Property(str)
+    key = AID = KeyProperty()
+
+
+def test_new_enum_values_are_added_outside_the_transaction():
+    existing = ExistingSchema({"plans": ["free", "pro"]}, {"table_account": {"plan", "owner", "aid"}}, set())
+    changes = plan_schema([Account], existing)
+    assert [str(ch) for ch in changes] == ["Add value team to type plans"]
+    assert not changes[0].in_transaction
+    assert str(changes[0].statement) == "ALTER TYPE plans ADD VALUE IF NOT EXISTS 'team' AFTER 'pro'"
+
+
+def test_new_enum_values_keep_their_position():
+    existing = ExistingSchema({"plans": ["pro"]}, {"table_account": {"plan", "owner", "aid"}}, set())
+    statements = [str(ch.statement) for ch in plan_schema([Account], existing)]
+    assert statements == ["ALTER TYPE plans ADD VALUE IF NOT EXISTS 'free' BEFORE 'pro'",
+                          "ALTER TYPE plans ADD VALUE IF NOT EXISTS 'team' AFTER 'pro'"]
+    existing = ExistingSchema({"plans": ["free", "team"]}, {"table_account": {"plan", "owner", "aid"}}, set())
+    statements = [str(ch.statement) for ch in plan_schema([Account], existing)]
+    assert statements == ["ALTER TYPE plans ADD VALUE IF NOT EXISTS 'pro' AFTER 'free'"]
+
+
+def test_new_tables_are_created_in_the_transaction():
+    changes = plan_schema([Account], ExistingSchema({}, {}, set()))
+    assert [str(ch) for ch in changes] == ["Create type plans", "Create table table_Account"]
+    assert all(ch.in_transaction for ch in changes)
@@ -0,0 +1,106 @@
+
+import datetime
+
+from sparrow import *
+
+from . import run
+
+
+class Reading(Entity):
+    at = Property(datetime.datetime)
+    value = Property(int)
+    key = Key(at)
+
+
+class Note(Entity):
+    text = Property(str)
+    key = NID = KeyProperty()
+
+
+def sharded(n=4):
+    shards = [Database(None, ":memory:", backend=SqliteBackend()) for _ in range(n)]
+    return (shards, ShardedDatabase(shards, sharded_classes=[Reading]))
+
+
+def test_insert_find_delete_across_shards():
+    (shards, db) = sharded()
+    model = SparrowModel(None, {}, [Reading, Note], db=db)
+    times = [datetime.datetime(2026, 1, 1, 12, i) for i in range(8)]
+
+    async def main():
+        await model.install()
+        for (i, t) in enumerate(times):
+            await Reading(at=t, value=i).insert(db)
+        assert sum([await Reading.get().count(s) for s in shards]) == 8
+        assert len([s for s in shards if await Reading.get().count(s) > 0]) > 1
+        Reading.cache.clear()
+        for (i, t) in enumerate(times):
+            r = await Reading.find_by_key(t, db)
+            assert r.value == i
+            assert await Reading.get().count(db.shard_for(Reading, t)) >= 1
+        for t in times[:4]:
+            await (await Reading.find_by_key(t, db)).delete(db)
+        assert await Reading.get().count(db) == 4
+        assert sorted([r.value for r in await Reading.get().all(db)]) == [4, 5, 6, 7]
+        await model.uninstall()
+    run(main())
+
+
+def test_fan_out_respects_order_and_limit():
+    (shards, db) = sharded(3)
+    model = SparrowModel(None, {}, [Reading], db=db)
+
+    async def main():
+        await model.install()
+        for i in range(20):
+            await Reading(at=datetime.datetime(2026, 1, 1) + datetime.timedelta(hours=i), value=(i * 7) % 20).insert(db)
+        values = [r.value for r in await Reading.get().order(-Reading.value).limit(5).offset(2).all(db)]
+        assert values == [17, 16, 15, 14, 13]
+        assert await Reading.get(Reading.value >= 10).count(db) == 10
+        await model.uninstall()
+    run(main())
+
+
+def test_transaction_refuses_other_shards():
+    (shards, db) = sharded()
+    model = SparrowModel(None, {}, [Reading], db=db)
+    times = [datetime.datetime(2026, 2, 1, i) for i in range(8)]
+
+    async def main():
+        await model.install()
+        refused = 0
+        for t in times:
+            try:
+                async with db.transaction(Reading, times[0]) as tr:
+                    await Reading(at=t, value=0).insert(tr)
+            except ShardingError:
+                refused += 1
+        stored = await Reading.get().count(db)
+        assert stored + refused == 8 and refused > 0
+        Reading.cache.clear()
+        for r in await Reading.get().all(db):
+            assert (await Reading.find_by_key(r.at, db)) is r
+        await model.uninstall()
+    run(main())
+
+
+def test_unsharded_classes_live_on_first_shard():
+    (shards, db) = sharded(2)
+    model = SparrowModel(None, {}, [Note], db=db)
+
+    async def main():
+        await model.install()
+        n = Note(text="hi")
+        await n.insert(db)
+        assert await Note.get().count(shards[0]) == 1
+        assert (await Note.get(Note.NID == Unsafe(n.key)).single(db)) is n
+        await model.uninstall()
+    run(main())
+
+
+def test_keys_are_spread_evenly():
+    for n in (2, 4, 8):
+        counts = [0] * n
+        for i in range(24 * n):
+            counts[md5_shard(datetime.datetime(2026, 2, 1) + datetime.timedelta(hours=i), n)] += 1
+        assert min(counts) > 0
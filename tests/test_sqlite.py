@@ -0,0 +1,173 @@
+import asyncio
+import datetime
+
+from sparrow import *
+
+from . import run
+
+
+class Measurement(Entity):
+    taken = Property(datetime.datetime)
+    value = Property(float)
+    valid = Property(bool)
+    tags = Property(List(str))
+    extra = Property(Json)
+    qualities = Enum("bad", "ok", "good")
+    quality = Property(qualities)
+    unit = Property(Enum("m", "s", "kg", storage="smallint"))
+    key = MID = KeyProperty()
+
+
+class Seat(Entity):
+    row = Property(str)
+    number = Property(int)
+    booked = Property(bool)
+    key = Key(row, number)
+
+
+class Ticket(Entity):
+    holder = Property(str)
+    seat = Reference(Seat)
+    key = TID = KeyProperty()
+
+
+def test_values_survive_a_round_trip():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+    fields = dict(taken=datetime.datetime(2026, 3, 1, 12, 30, 15, 250000), value=2.5, valid=False,
+                  tags=["a", "b"], extra={"n": [1, None], "s": "x"}, quality="good", unit="kg")
+
+    async def main():
+        Measurement.cache.clear()
+        await SparrowModel(None, {}, [Measurement], db=db).install()
+        m = Measurement(**fields)
+        await m.insert(db)
+        key = m.key
+        del m
+        Measurement.cache.clear()
+        loaded = await Measurement.find_by_key(key, db)
+        assert {name: getattr(loaded, name) for name in fields} == fields
+        found = await Measurement.get(Measurement.unit == Unsafe("kg"), Measurement.quality == Unsafe("good")).all(db)
+        assert [f.key for f in found] == [key]
+    run(main())
+
+
+def test_composite_keys():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        Seat.cache.clear()
+        await SparrowModel(None, {}, [Seat, Ticket], db=db).install()
+        for (row, number) in [("A", 1), ("A", 2), ("B", 1)]:
+            await Seat(row=row, number=number, booked=False).insert(db)
+        Seat.cache.clear()
+        seat = await Seat.find_by_key(("A", 2), db)
+        assert (seat.row, seat.number) == ("A", 2)
+        seat.booked = True
+        await seat.update(db)
+        ticket = Ticket(holder="ann", seat=seat.key)
+        await ticket.insert(db)
+        assert (await Seat.get(Seat.row == Unsafe("B")).single(db)).number == 1
+        await (await Seat.find_by_key(("B", 1), db)).delete(db)
+        Seat.cache.clear()
+        rows = await RawSql("SELECT row, number, booked FROM table_Seat ORDER BY row, number").raw_all(db)
+        assert rows == [("A", 1, 0), ("A", 2, 1)]
+        await Ticket.seat.prefetch([ticket], db)
+        assert ticket.seat == ("A", 2)
+    run(main())
+
+
+class SlowSink:
+    def __init__(self, events):
+        self.events = events
+        self.data = b""
+
+    async def write(self, chunk):
+        self.events.append("chunk")
+        await asyncio.sleep(0.01)
+        self.data += chunk
+
+
+def test_exports_keep_the_connection_to_themselves():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        Seat.cache.clear()
+        await SparrowModel(None, {}, [Seat, Ticket], db=db).install()
+        for i in range(2500):
+            await Seat(row="C", number=i, booked=False).insert(db)
+        events = []
+        sink = SlowSink(events)
+
+        async def book():
+            await asyncio.sleep(0)  # Once the export has started
+            await RawSql("UPDATE table_Seat SET booked = 1", {}).exec(db)
+            events.append("update")
+
+        await asyncio.gather(Seat.get().export(sink, "csv", db), book())
+        assert events[-1] == "update"
+        lines = sink.data.decode().splitlines()
+        assert len(lines) == 2501 and all(l.endswith(",f") for l in lines[1:])
+    run(main())
+
+
+class Kind(Entity):
+    kind = Property(Enum("a", "b", "c", storage="smallint"))
+    label = Property(str)
+    key = Key(kind)
+
+
+class Item(Entity):
+    name = Property(str)
+    kind = Reference(Kind)
+    key = IID = KeyProperty()
+
+
+class Day(Entity):
+    day = Property(datetime.datetime)
+    key = Key(day)
+
+
+class Entry(Entity):
+    text = Property(str)
+    day = Reference(Day)
+    key = EID = KeyProperty()
+
+
+def test_encoded_keys():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        for c in (Kind, Item, Day, Entry):
+            c.cache.clear()
+        await SparrowModel(None, {}, [Kind, Item, Day, Entry], db=db).install()
+        for k in "abc":
+            await Kind(kind=k, label=k.upper()).insert(db)
+        items = [Item(name="i{}".format(i), kind="bc"[i % 2]) for i in range(4)]
+        for i in items:
+            await i.insert(db)
+        (stored,) = await RawSql("SELECT kind FROM table_Kind WHERE label = 'B'").raw(db)
+        assert stored == 1
+        Kind.cache.clear()
+        assert (await Kind.find_by_key("b", db)).label == "B"
+        Kind.cache.clear()
+        await Item.kind.prefetch(items, db)
+        assert [Item.kind.resolve(i).label for i in items] == ["B", "C", "B", "C"]
+        children = await Item.kind.load_referencing(list(Kind.cache.values()), db=db)
+        assert sorted([i.name for i in children["b"]]) == ["i0", "i2"]
+        assert await Item.get(Item.kind == Unsafe("c")).count(db) == 2
+        await (await Kind.find_by_key("a", db)).delete(db)
+        assert await Kind.get().count(db) == 2
+
+        start = datetime.datetime(2026, 5, 1, 8, 30)
+        days = [Day(day=start + datetime.timedelta(days=i)) for i in range(3)]
+        for d in days:
+            await d.insert(db)
+        entries = [Entry(text=str(i), day=days[i % 3].key) for i in range(6)]
+        for e in entries:
+            await e.insert(db)
+        Day.cache.clear()
+        del days
+        assert (await Day.find_by_key(start, db)).day == start
+        await Entry.day.prefetch(entries, db)
+        assert all(Entry.day.resolve(e) is not None for e in entries)
+    run(main())
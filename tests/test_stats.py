@@ -0,0 +1,62 @@
+from sparrow import *
+
+from . import run
+
+
+class Song(Entity):
+    title = Property(str)
+    plays = Property(int)
+    key = SID = KeyProperty()
+
+
+def test_normalize_sql():
+    assert normalize_sql("SELECT * FROM t WHERE a = %(123)s AND b = 'it''s'") == "SELECT * FROM t WHERE a = ? AND b = ?"
+    assert normalize_sql("SELECT *\n  FROM t\tLIMIT 10 OFFSET 2.5") == "SELECT * FROM t LIMIT ? OFFSET ?"
+    # Numbers inside names are kept
+    assert normalize_sql("SELECT a1 FROM table_t2") == "SELECT a1 FROM table_t2"
+
+
+def test_statistics():
+    stats = QueryStats()
+    query = Song.get(Song.plays > Unsafe(3))
+    for elapsed in (0.0005, 0.003, 0.003, 0.3):
+        stats.record(query, str(query), elapsed, rows=2)
+    stats.record(query, str(query), 0.001, error=ValueError())
+    [s] = stats.report()
+    assert s["class"] == "Song"
+    assert s["columns"] == ["plays >"]
+    assert (s["count"], s["errors"], s["rows"]) == (5, 1, 8)
+    assert (s["min_time"], s["max_time"]) == (0.0005, 0.3)
+    assert s["p50"] == 0.005 and s["p99"] == 0.3
+    assert sum(n for (bound, n) in s["histogram"]) == 5
+    stats.reset()
+    assert stats.report() == []
+
+
+def test_the_database_records_its_statements():
+    db = Database(None, ":memory:", backend=SqliteBackend(), slow_query_threshold=0.0)
+
+    async def main():
+        Song.cache.clear()
+        await SparrowModel(None, {}, [Song], db=db).install()
+        db.stats.reset()
+        for i in range(3):
+            await Song(title="s{}".format(i), plays=i).insert(db)
+        await Song.get(Song.plays >= Unsafe(1)).all(db)
+        report = db.stats.report()
+        assert sorted([(s["class"], s["count"]) for s in report]) == [("Song", 1), ("Song", 3)]
+        assert len(db.stats.slow_queries) == 4
+        assert str(db.stats.slow_queries[-1]).startswith("Slow query (")
+    run(main())
+
+
+def test_slow_queries_are_sampled():
+    stats = QueryStats(slow_threshold=0.1, slow_sample=0.0, slow_log_size=2)
+    stats.record(None, "SELECT 1", 1.0)
+    assert len(stats.slow_queries) == 0
+    stats = QueryStats(slow_threshold=0.1, slow_log_size=2)
+    for text in ("SELECT 1", "SELECT 2", "SELECT 3", "SELECT 4"):
+        stats.record(None, text, 1.0 if text != "SELECT 4" else 0.01)
+    assert [q.text for q in stats.slow_queries] == ["SELECT 2", "SELECT 3"]
+    [s] = stats.report()
+    assert s["shape"] == "SELECT ?" and s["class"] is None and s["count"] == 4
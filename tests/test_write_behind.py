@@ -0,0 +1,94 @@
+import asyncio
+
+from sparrow import *
+
+from . import run
+
+
+class Player(RTEntity):
+    __write_behind__ = WriteBehind(interval=0.05, max_pending=4, batch_size=3)
+
+    x = Property(float)
+    name = Property(str)
+    key = PID = KeyProperty()
+
+
+class Counter(Listener):
+    def __init__(self):
+        self.updates = 0
+
+    def update(self, obj):
+        self.updates += 1
+
+
+async def positions(db):
+    return dict(await RawSql("SELECT name, x FROM table_Player").raw_all(db))
+
+
+def test_updates_are_written_later_with_the_latest_state():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        Player.cache.clear()
+        model = SparrowModel(None, {}, [Player], db=db)
+        await model.install()
+        p = Player(x=0.0, name="ann")
+        await p.insert(db)
+        listener = Counter()
+        p.add_listener(listener)
+        for i in range(1, 6):
+            p.x = float(i)
+            await p.update(db)
+        assert listener.updates == 5  # Right away
+        assert await positions(db) == {"ann": 0.0}
+        await asyncio.sleep(0.1)
+        assert await positions(db) == {"ann": 5.0}
+        p.x = 6.0
+        await p.update(db)
+        await model.flush_writes()
+        assert await positions(db) == {"ann": 6.0}
+    run(main())
+
+
+def test_bursts_start_one_flush_at_a_time():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+    spawned = []
+    spawn = db.backend.spawn
+
+    def counting_spawn(coro):
+        spawned.append(coro)
+        return spawn(coro)
+    db.backend.spawn = counting_spawn
+
+    async def main():
+        Player.cache.clear()
+        await SparrowModel(None, {}, [Player], db=db).install()
+        players = [Player(x=0.0, name="p{}".format(i)) for i in range(12)]
+        for p in players:
+            await p.insert(db)
+        for p in players:
+            p.x = 1.0
+            await p.update(db)  # Only returns to the loop when another coroutine writes
+        assert len(spawned) == 1
+        await Player._write_behind.flush()
+        assert set((await positions(db)).values()) == {1.0}
+    run(main())
+
+
+def test_deleted_objects_are_not_written():
+    db = Database(None, ":memory:", backend=SqliteBackend())
+
+    async def main():
+        Player.cache.clear()
+        model = SparrowModel(None, {}, [Player], db=db)
+        await model.install()
+        (a, b) = (Player(x=0.0, name="a"), Player(x=0.0, name="b"))
+        await a.insert(db)
+        await b.insert(db)
+        a.x = b.x = 2.0
+        await a.update(db)
+        await b.update(db)
+        await a.delete(db)
+        await model.flush_writes()
+        assert await positions(db) == {"b": 2.0}
+    run(main())